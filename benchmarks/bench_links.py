@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Benchmark for the data path of the point-to-point L2 domains: compares
+# the packet rate between two TAP interfaces connected by a bridge (the
+# default) and cross-connected with tc mirred (gen.py --direct-links).
+# A process injects minimal VLAN-tagged frames into the first TAP
+# interface, as QEMU does for a node, and another one reads them from the
+# second TAP interface. The frames are forwarded in the context of the
+# writer, so the sent rate reflects the cost of the data path, and the
+# forwarded rate counts the frames which reached the second TAP interface
+# (including those dropped because the reader could not keep up).
+#
+# Run as root from the repository root (possibly in a separate network
+# namespace, e.g. with unshare -n):
+#
+#   $ python benchmarks/bench_links.py [--duration 5] [--repeat 3]
+#
+
+import multiprocessing
+import subprocess
+import argparse
+import select
+import struct
+import fcntl
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gen
+
+
+TUNSETIFF = 0x400454ca
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+taps = ['rbench.a', 'rbench.b']
+bridge = 'rbench.br'
+
+
+def sh(cmd):
+    subprocess.check_call(cmd, shell = True)
+
+
+def setup(mode):
+    for tap in taps:
+        sh('ip tuntap add mode tap name %s' % tap)
+        sh('ip link set %s up' % tap)
+
+    if mode == 'bridge':
+        sh('ip link add %s type bridge' % bridge)
+        sh('ip link set %s up' % bridge)
+        for tap in taps:
+            sh('ip link set %s master %s' % (tap, bridge))
+    else:
+        # The same commands as up.tc.batch
+        pl = gen.Plan(gen.Scenario(), gen.argparser.parse_args([]), dict())
+        pl.direct_links['300'] = [{'tap': tap} for tap in taps]
+        for cmd in gen.direct_link_commands(pl, '300'):
+            sh('tc %s' % cmd)
+
+
+def teardown():
+    for tap in taps:
+        subprocess.call('ip tuntap del mode tap name %s' % tap, shell = True,
+                        stderr = subprocess.DEVNULL)
+    subprocess.call('ip link del %s' % bridge, shell = True,
+                    stderr = subprocess.DEVNULL)
+
+
+# Frames transmitted (or dropped) by an interface, from /proc/net/dev,
+# which unlike sysfs belongs to the current network namespace
+def tap_forwarded(name):
+    fin = open('/proc/net/dev')
+    lines = fin.readlines()
+    fin.close()
+    for line in lines:
+        ifname, _, counters = line.partition(':')
+        if ifname.strip() == name:
+            counters = counters.split()
+            return int(counters[9]) + int(counters[11])
+    raise Exception('No counters for %s' % name)
+
+
+def open_tap(name):
+    fd = os.open('/dev/net/tun', os.O_RDWR)
+    fcntl.ioctl(fd, TUNSETIFF, struct.pack('16sH22x', name.encode('ascii'),
+                                           IFF_TAP | IFF_NO_PI))
+    return fd
+
+
+# An 802.1Q frame of the minimum size, as sent by the shim-eth-vlan IPCPs
+def frame():
+    return bytes.fromhex('000a0a0a0201' '000a0a0a0101' '8100012c' 'd1f0') +\
+           bytes(46)
+
+
+def sender(duration, sent):
+    fd = open_tap(taps[0])
+    data = frame()
+    count = 0
+    deadline = time.time() + duration
+    while True:
+        for i in range(1000):
+            os.write(fd, data)
+        count += 1000
+        if time.time() > deadline:
+            break
+    sent.value = count
+    os.close(fd)
+
+
+def receiver(duration, received, ready):
+    fd = open_tap(taps[1])
+    ready.set()
+    count = 0
+    deadline = time.time() + duration + 1.0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        r, _, _ = select.select([fd], [], [], remaining)
+        if r:
+            os.read(fd, 2048)
+            count += 1
+    received.value = count
+    os.close(fd)
+
+
+def bench(mode, duration):
+    teardown()
+    setup(mode)
+    try:
+        sent = multiprocessing.Value('l', 0)
+        received = multiprocessing.Value('l', 0)
+        ready = multiprocessing.Event()
+        rx = multiprocessing.Process(target = receiver,
+                                     args = (duration, received, ready))
+        rx.start()
+        ready.wait()
+        time.sleep(0.5)     # carrier up on the second TAP interface
+        forwarded = tap_forwarded(taps[1])
+        tx = multiprocessing.Process(target = sender, args = (duration, sent))
+        tx.start()
+        tx.join()
+        rx.join()
+        forwarded = tap_forwarded(taps[1]) - forwarded
+        return (sent.value / duration, forwarded / duration,
+                received.value / duration)
+    finally:
+        teardown()
+
+
+argparser = argparse.ArgumentParser(description = "point-to-point link "
+                                    "data path benchmark")
+argparser.add_argument('--duration', type = float, default = 5.0,
+                       help = "Seconds of traffic per run")
+argparser.add_argument('--repeat', type = int, default = 3,
+                       help = "Number of runs per data path (best is "
+                              "reported)")
+bargs = argparser.parse_args()
+
+print('%10s %14s %14s %14s' % ('path', 'sent pps', 'forwarded pps',
+                               'received pps'))
+for mode in ['bridge', 'direct']:
+    best = max([bench(mode, bargs.duration) for r in range(bargs.repeat)],
+               key = lambda result: result[1])
+    print('%10s %14.0f %14.0f %14.0f' % (mode, best[0], best[1], best[2]))
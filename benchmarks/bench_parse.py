@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Benchmark for the gen.conf parser: generates synthetic scenarios of
+# increasing size and reports the parsing throughput in lines/second.
+#
+# Run from the repository root:
+#
+#   $ python benchmarks/bench_parse.py [--sizes 1000,10000,100000]
+#
+
+import argparse
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gen
+
+
+def synthetic_conf(n):
+    """A ring of n nodes with one shim per link, a normal DIF over the
+       ring, and one policy and one netem directive per node"""
+    lines = ['# synthetic scenario with %d nodes\n' % n]
+    for i in range(n):
+        lines.append('eth %d 100Mbps n%d n%d\n' % (i + 1, i, (i + 1) % n))
+    for i in range(n):
+        lines.append('dif n1 n%d %d %d\n' % (i, (i - 1) % n + 1, i + 1))
+    for i in range(n):
+        lines.append('policy n1 n%d,n%d rmt.pff lfa qthresh = %d '
+                     'cbits=%d.5\n' % (i, (i + 1) % n, i, i))
+    for i in range(n):
+        lines.append('netem %d n%d delay %dms 1ms loss 0.1%%\n'
+                     % (i + 1, i, i % 50))
+    return lines
+
+
+def bench(lines, args, repeat):
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        gen.parse(args, lines)
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+
+argparser = argparse.ArgumentParser(description = "gen.conf parser benchmark")
+argparser.add_argument('--sizes', type = str, default = '250,2500,25000',
+                       help = "Comma-separated list of ring sizes (nodes); "
+                              "each node contributes four lines")
+argparser.add_argument('--repeat', type = int, default = 3,
+                       help = "Number of runs per size (best is reported)")
+argparser.add_argument('--manager', action='store_true',
+                       help = "Also inject the NMS DIF lines")
+bargs = argparser.parse_args()
+
+args = gen.argparser.parse_args(['--manager'] if bargs.manager else [])
+
+print('%10s %10s %12s %14s' % ('nodes', 'lines', 'seconds', 'lines/second'))
+for n in [int(x) for x in bargs.sizes.split(',')]:
+    lines = synthetic_conf(n)
+    elapsed = bench(lines, args, bargs.repeat)
+    print('%10d %10d %12.4f %14.0f' % (n, len(lines), elapsed,
+                                         len(lines) / elapsed))
@@ -3,6 +3,12 @@
 rm *.dif &> /dev/null
 rm *.ipcm.conf &> /dev/null
 rm *.map &> /dev/null
+rm addresses.*.json &> /dev/null
+rm enrollments.json &> /dev/null
+rm bundle.*.tar.gz overlay.*.tar.gz &> /dev/null
+rm initrd.*.cpio *.initrd &> /dev/null
 rm difs.png &> /dev/null
-rm up.sh down.sh &> /dev/null
+rm up.sh down.sh delta.sh enroll.sh up.host*.sh down.host*.sh *.batch gen.manifest &> /dev/null
+rm *.serial *.ssh &> /dev/null
+rm template.*.state template.*.pid &> /dev/null
 rm *.log
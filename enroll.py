@@ -5,22 +5,9 @@
 #
 
 import argparse
-import socket
-import time
-import re
+import sys
 
-def printalo(byt):
-    print(repr(byt).replace('\\n', '\n'))
-
-
-def get_response(s):
-    data = bytes()
-    while 1:
-        data += s.recv(1024)
-        lines = str(data).replace('\\n', '\n').split('\n')
-        #print(lines)
-        if lines[-1].find("IPCM") != -1:
-            return lines[:len(lines)-1]
+import ipcm_console
 
 
 description = "Python script to enroll IPCPs"
@@ -31,87 +18,72 @@ argparser = argparse.ArgumentParser(description = description,
 argparser.add_argument('--ipcm-conf', help = "Path to the IPCM configuration file",
                        type = str, required = True)
 argparser.add_argument('--enrollee-name', help = "Name of the enrolling IPCP",
-                       type = str, required = True)
+                       type = str)
 argparser.add_argument('--dif', help = "Name of DIF to enroll to",
-                       type = str, required = True)
+                       type = str)
 argparser.add_argument('--lower-dif', help = "Name of the lower level DIF",
-                       type = str, required = True)
+                       type = str)
 argparser.add_argument('--enroller-name', help = "Name of the remote neighbor IPCP to enroll to",
-                       type = str, required = True)
+                       type = str)
+argparser.add_argument('--batch', help = "File ('-' for standard input) with "
+                       "one enrollment per line, in the form "
+                       "'ENROLLEE_NAME DIF LOWER_DIF ENROLLER_NAME'; all the "
+                       "enrollments are carried out in the same session",
+                       type = str)
+argparser.add_argument('--timeout', help = "Seconds to wait for the IPCM console to be available",
+                       type = int, default = 30)
+argparser.add_argument('--response-timeout', help = "Seconds to wait for each response of the IPCM console",
+                       type = int, default = 60)
 args = argparser.parse_args()
 
-socket_name = None
-
-fin = open(args.ipcm_conf, 'r')
-while 1:
-    line = fin.readline()
-    if line == '':
-        break
-
-    m = re.search(r'"(\S+ipcm-console.sock)', line)
-    if m != None:
-        socket_name = m.group(1)
-        break
-fin.close()
-
-if socket_name == None:
-    print('Cannot find %s' % (socket_name))
-    quit(1)
-
-s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-connected = False
-trials = 0
-while trials < 4:
-    try:
-        s.connect(socket_name)
-        connected = True
-        break
-    except:
-        pass
-    trials += 1
-    time.sleep(1)
-
-if connected:
-    try:
-        # Receive the banner
-        get_response(s)
-
-        # Send the IPCP list command
-        cmd = 'list-ipcps\n'
-        s.sendall(bytes(cmd, 'ascii'))
-
-        # Get the list of IPCPs and parse it to look for the enroller ID
-        print('Looking up identifier for IPCP %s' % args.enrollee_name)
-        lines = get_response(s)
-        print(lines)
-        enrollee_id = None
-        for line in lines:
-            rs = r'^\s*(\d+)\s*\|\s*' + args.enrollee_name.replace('.', '\\.')
-            m = re.match(rs, line)
-            if m != None:
-                enrollee_id = m.group(1)
-
-        if enrollee_id == None:
-            print('Could not find the ID of enrollee IPCP %s' \
-                    % args.enrollee_name)
-            raise Exception()
-
-        # Send the enroll command
-        cmd = 'enroll-to-dif %s %s %s %s 1\n' \
-                % (enrollee_id, args.dif, args.lower_dif, args.enroller_name)
-        print(cmd)
-
-        s.sendall(bytes(cmd, 'ascii'))
-
-        # Get the enroll command answer
-        lines = get_response(s)
-        print(lines)
-    except:
-        s.close()
-        raise
+enrollments = []
+
+if args.batch:
+    fin = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+    linecnt = 0
+    for line in fin:
+        linecnt += 1
+        fields = line.split('#')[0].split()
+        if len(fields) == 0:
+            continue
+        if len(fields) != 4:
+            print('Invalid enrollment at line %d: %s' % (linecnt, line.strip()))
+            quit(1)
+        enrollments.append(fields)
+    if fin != sys.stdin:
+        fin.close()
+
+elif None in [args.enrollee_name, args.dif, args.lower_dif, args.enroller_name]:
+    argparser.error('--enrollee-name, --dif, --lower-dif and --enroller-name '
+                    'are required without --batch')
 
 else:
-    print('Failed to connect to "%s"' % socket_name)
+    enrollments.append([args.enrollee_name, args.dif, args.lower_dif,
+                        args.enroller_name])
+
+try:
+    console = ipcm_console.Console(ipcm_console.console_path(args.ipcm_conf),
+                                   args.timeout, args.response_timeout)
+except ipcm_console.ConsoleError as e:
+    print(e)
+    quit(1)
 
-s.close()
+failures = 0
+
+try:
+    for enrollee, dif, lower_dif, enroller in enrollments:
+        ok, lines, latency = console.enroll(enrollee, dif, lower_dif, enroller)
+        if not ok:
+            failures += 1
+        print('\n'.join(lines))
+        print('%s: enrollment of %s to DIF %s through %s against %s '
+              '(%.1f ms)' % ('OK' if ok else 'FAILED', enrollee, dif,
+                             lower_dif, enroller, latency * 1000))
+except ipcm_console.ConsoleError as e:
+    print(e)
+    failures += 1
+finally:
+    console.close()
+
+if failures:
+    quit(1)
@@ -18,57 +18,74 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 # A tool for live demonstrations and regression testing for the IRATI stack
+#
+# The scenario compiler is split in three stages, which can also be used
+# in-process (e.g. by a driver that compiles many scenario variants):
+#
+#   scenario = gen.parse(args)                 # gen.conf --> Scenario
+#   plan = gen.plan(scenario, args, env_dict)  # Scenario --> Plan
+#   artifacts = gen.emit(plan)                 # Plan --> {file name: text}
+#   gen.write_artifacts(artifacts)
+#
+# or, to stream the artifacts to disk without building them in memory,
+#
+#   gen.write_artifacts(gen.producers(plan), jobs = 4)
+#
+# where args can be obtained with gen.argparser.parse_args([...]) and
+# env_dict with gen.parse_env(args). Once the artifacts are written,
+# gen.write_bundles(plan) packs them into the per-node archives extracted
+# by up.sh (or, with --initrd-overlay, gen.write_initrds(plan) into the
+# per-node initramfs images); a plan can also be brought up directly,
+# without up.sh, with gen_run.run(plan).
+#
+# Artifacts that did not change since the previous run are not rewritten,
+# according to the content hashes stored in gen.manifest, and delta.sh
+# pushes the changed configurations to the running scenario.
 
 import multiprocessing
 import gen_templates
+import gen_netem
 import subprocess
+import collections
 import argparse
+import hashlib
+import tarfile
+import shutil
+import array
+import heapq
+import math
 import json
+import stat
+import glob
+import gzip
+import time
 import copy
 import re
 import os
 
 
+class GenError(Exception):
+    """A fatal error in the scenario description or in the environment"""
+    pass
+
+
 def which(program):
     FNULL = open(os.devnull, 'w')
     retcode = subprocess.call(['which', program], stdout = FNULL,
                               stderr = subprocess.STDOUT)
+    FNULL.close()
     if retcode != 0:
-        print('Fatal error: Cannot find "%s" program' % program)
-        quit(1)
+        raise GenError('Fatal error: Cannot find "%s" program' % program)
 
 
-def dict_dump_json(file_name, dictionary, env_dict):
-    dictionary_str = json.dumps(dictionary, indent = 4,
-                                sort_keys = True) % env_dict
-    fout = open(file_name, 'w')
-    fout.write(dictionary_str);
-    fout.close()
+def dict_dump_json(dictionary, env_dict):
+    return json.dumps(dictionary, indent = 4, sort_keys = True) % env_dict
 
 
 def joincat(haystack, needle):
     return ' '.join([needle, haystack])
 
 
-def netem_validate(netem_args):
-    ret = True
-
-    try:
-        fdevnull = open(os.devnull, 'w')
-        subprocess.check_call('sudo ip tuntap add mode tap name tapiratiprobe'.split())
-        subprocess.check_call(('sudo tc qdisc add dev '\
-                               'tapiratiprobe root netem %s'\
-                                % netem_args).split(), stdout=fdevnull,
-                                stderr=fdevnull)
-        fdevnull.close()
-    except:
-        ret = False
-
-    subprocess.call('sudo ip tuntap del mode tap name tapiratiprobe'.split())
-
-    return ret
-
-
 description = "Python script to generate IRATI deployments for Virtual Machines"
 epilog = "2016 Vincenzo Maffione <v.maffione@nextworks.it>"
 
@@ -86,8 +103,22 @@ argparser.add_argument('-m', '--memory',
                        default = '164')
 argparser.add_argument('-e', '--enrollment-strategy',
                        help = "Minimal uses a spanning tree of each DIF",
-                       type = str, choices = ['minimal', 'full-mesh', 'manual'],
+                       type = str, choices = ['minimal', 'full-mesh', 'manual',
+                                              'balanced'],
                        default = 'minimal')
+argparser.add_argument('--max-enrollees',
+                       help = "Maximum number of nodes enrolled by each node, "
+                              "with the balanced enrollment strategy",
+                       type = int, default = 4)
+argparser.add_argument('--redundant-enrollments',
+                       help = "Number of additional neighbors each node "
+                              "enrolls with, with the balanced enrollment "
+                              "strategy", type = int, default = 0)
+argparser.add_argument('--addressing',
+                       help = "Default address allocation scheme of the "
+                              "normal DIFs (see the addressing directive)",
+                       type = str, choices = ['flat', 'hierarchical'],
+                       default = 'flat')
 argparser.add_argument('--ring',
                        help = "Use ring topology with variable number of nodes",
                        type = int)
@@ -114,904 +145,3110 @@ argparser.add_argument('--manager-initramfs',
 argparser.add_argument('--overlay',
                        help = "Overlay the specified directory in the generated image",
                        type = str)
+argparser.add_argument('--shared-addresses', action='store_true',
+                       help = "Ship the IPCP addresses of each DIF in a single "
+                              "file, merged into the DIF templates on the nodes")
+argparser.add_argument('--initrd-overlay', action='store_true',
+                       help = "Bake the configuration of each node into an "
+                              "initramfs archive appended to its image, so "
+                              "that the nodes boot already configured")
+argparser.add_argument('--clone', action='store_true',
+                       help = "Boot a template VM once for each kind of node "
+                              "and save its state, then start the nodes by "
+                              "restoring that state rather than booting them")
+argparser.add_argument('--netem-probe', action='store_true',
+                       help = "Check the netem arguments rejected by the "
+                              "offline validator with tc (requires sudo)")
+argparser.add_argument('-j', '--jobs',
+                       help = "Number of processes used to write the "
+                              "configuration files", type = int,
+                       default = multiprocessing.cpu_count())
+argparser.add_argument('--run', action='store_true',
+                       help = "Bring up the scenario right away, pipelining "
+                              "boot, provisioning and enrollment, rather "
+                              "than only generating up.sh (needs Python 3.7)")
+argparser.add_argument('--boot-jobs', type = int,
+                       help = "Maximum number of VMs booting at the same "
+                              "time (default: half of the CPUs)")
+argparser.add_argument('--provision-jobs', type = int, default = 8,
+                       help = "Maximum number of VMs being provisioned at "
+                              "the same time with --run")
+argparser.add_argument('--enroll-jobs', type = int, default = 8,
+                       help = "Maximum number of concurrent enrollments")
+argparser.add_argument('--direct-links', action='store_true',
+                       help = "Connect the TAP interfaces of the L2 domains "
+                              "with two members to each other (with tc "
+                              "mirred), rather than with a bridge")
+argparser.add_argument('--hosts', type = str,
+                       help = "Comma separated addresses of the hosts to "
+                              "spread the nodes on: an up.hostN.sh and a "
+                              "down.hostN.sh script are generated for the "
+                              "N-th host, and an enroll.sh script to be run "
+                              "once all the hosts are up")
+argparser.add_argument('--tunnel', choices = ['vxlan', 'gretap'],
+                       default = 'vxlan',
+                       help = "Tunnels connecting the L2 domains which span "
+                              "several hosts, with --hosts")
+argparser.add_argument('--smp', type = int, default = 2,
+                       help = "Default number of vCPUs of each node (see "
+                              "the smp directive)")
+argparser.add_argument('--pin', action='store_true',
+                       help = "Pin each node to a set of host CPUs, placing "
+                              "the nodes which share L2 domains on the same "
+                              "CPUs (or on the same NUMA node)")
+argparser.add_argument('--host-cpus', type = str,
+                       help = "Host CPUs available to the nodes with --pin, "
+                              "as a list like 0-7,16-23 (default: all the "
+                              "CPUs of this machine, by NUMA node). With "
+                              "--hosts, either a list for all the hosts or "
+                              "one list for each host, separated by slashes "
+                              "(e.g. 0-7/0-15)")
+argparser.add_argument('--cgroups', action='store_true',
+                       help = "Run each node in its own cgroup v2 group, "
+                              "with CPU (and, with --pin, CPU set) and "
+                              "memory limits")
+argparser.add_argument('--cpu-max', type = int, default = 100,
+                       help = "CPU bandwidth limit of each node with "
+                              "--cgroups, as a percentage of its vCPUs")
 argparser.add_argument('--loglevel',
                        help = "Set verbosity level",
                        choices = ['DBG', 'INFO', 'NOTE', 'WARN', 'ERR', 'CRIT', 'ALERT', 'EMERG'],
                        default = 'DBG')
-args = argparser.parse_args()
-
-
-which('brctl')
-which('qemu-system-x86_64')
 
-subprocess.call(['chmod', '0400', 'buildroot/irati_rsa'])
 
-if args.overlay:
-    args.overlay = os.path.abspath(args.overlay)
-    if not os.path.isdir(args.overlay):
-        args.overlay = None
-
-if args.legacy:
-    sshopts = ''
-    sudo = 'sudo'
-else:
-    sshopts = '-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null '\
-              '-o IdentityFile=buildroot/irati_rsa'
-    sudo = ''
-
-
-if args.legacy:
-    ######################## Compile mac2ifname program ########################
-    try:
-        subprocess.call(['cc', '-Wall', '-o', 'mac2ifname', 'mac2ifname.c'])
-    except:
-        print('Cannot find a C compiler to compile mac2ifname program')
-        quit(1)
+# Some constants related to the RINA management
+mgmt_shim_dif_name = '3456'
+mgmt_dif_name = 'NMS'
+mgmt_node_name = 'mgr'
 
-env_dict = {}
-keywords = ['vmimgpath', 'installpath', 'username', 'baseport']
+env_keywords = ['vmimgpath', 'installpath', 'username', 'baseport']
+
+
+class Scenario:
+    """The scenario described by a gen.conf file, as produced by parse()"""
+
+    def __init__(self):
+        self.vms = dict()
+        self.shims = dict()
+        self.links = []
+        self.difs = dict()
+        self.dif_policies = dict()
+        self.app_mappings = []
+        self.overlays = dict()
+        self.netems = dict()
+        self.manual_enrollments = dict()
+        self.dif_addressing = dict()
+        self.vm_smp = dict()
+        # The lines after these ones are generated (e.g. by --manager)
+        self.conf_lines = 0
+
+
+class Plan:
+    """A Scenario with addresses, ports, enrollments and DIF/IPCM
+       configurations computed, as produced by plan()"""
+
+    def __init__(self, scenario, args, env_dict):
+        self.scenario = scenario
+        self.args = args
+        self.env_dict = env_dict
+        self.vms = dict()
+        self.ports = []
+        self.bridges = dict()
+        self.resources = None
+        self.hosts = []
+        self.tunnels = dict()
+        self.direct_links = dict()
+        self.dif_ordering = []
+        self.dif_graphs = dict()
+        self.enrollments = dict()
+        self.enrollment_tasks = []
+        self.critical_path = 0
+        self.ipcmconfs = dict()
+        self.difconfs = dict()
+        self.dif_templates = dict()
+        self.dif_addresses = dict()
+        self.addressing = dict()
+        self.da_map = None
+        self.bundles = dict()
+        self.overlay_archive = None
+        self.initrds = dict()
+        self.templates = dict()
+        # cgroup v2 groups of the nodes, with --cgroups
+        self.cgroup_root = '/sys/fs/cgroup'
+        self.cgroup_slice = 'rina.slice'
+        self.cgroup_period = 100000         # in microseconds
+        self.qemu_memory_overhead = 64      # in MB
+        # Boot admission: at most boot_ceiling VMs boot at the same time,
+        # and only while the host is not overloaded
+        self.boot_ceiling = args.boot_jobs
+        if self.boot_ceiling == None:
+            self.boot_ceiling = max(1, multiprocessing.cpu_count() // 2)
+        self.boot_max_load = 1.0                # per CPU
+        self.boot_max_cpu_pressure = 50.0       # PSI some avg10, in %
+        self.boot_max_memory_pressure = 10.0    # PSI some avg10, in %
+        self.boot_admission_timeout = 600       # in seconds
+        self.boot_marker = 'login:'
+        self.boot_timeout = 300     # in seconds
+        self.ssh_timeout = 120      # in seconds
+        self.console_timeout = 30   # in seconds
+        self.ssh_retries = 5
+
+        if args.legacy:
+            self.sshopts = ''
+            self.sudo = 'sudo'
+        else:
+            self.sshopts = '-o StrictHostKeyChecking=no '\
+                           '-o UserKnownHostsFile=/dev/null '\
+                           '-o IdentityFile=buildroot/irati_rsa'
+            self.sudo = ''
 
 
 ############################## Parse gen.env ###############################
-fin = open('gen.env', 'r')
-while 1:
-    line = fin.readline()
-    if line == '':
-        break
+def parse_env(args, env_file = 'gen.env'):
+    env_dict = {}
 
-    m = re.match(r'(\S+)\s*=\s*(\S+)', line)
-    if m == None:
-        continue
+    fin = open(env_file, 'r')
+    for line in fin:
+        m = re.match(r'(\S+)\s*=\s*(\S+)', line)
+        if m == None:
+            continue
 
-    key = m.group(1)
-    value = m.group(2)
+        key = m.group(1)
+        value = m.group(2)
 
-    if key not in keywords:
-        print('Unrecognized keyword %s' % (key))
-        continue
+        if key not in env_keywords:
+            print('Unrecognized keyword %s' % (key))
+            continue
 
-    env_dict[key] = value
-fin.close()
+        env_dict[key] = value
+    fin.close()
 
-for key in keywords:
-    if key not in env_dict:
-        print("Configuration variables missing")
-        quit(1)
+    for key in env_keywords:
+        if key not in env_dict:
+            raise GenError("Configuration variables missing")
 
-env_dict['baseport'] = int(env_dict['baseport'])
-env_dict['varpath'] = env_dict['installpath']
+    env_dict['baseport'] = int(env_dict['baseport'])
+    env_dict['varpath'] = env_dict['installpath']
 
+    if not args.legacy:
+        # overwrite vmimgpath, installpath, varpath, username
+        env_dict['vmimgpath'] = args.initramfs
+        env_dict['installpath'] = '/usr'
+        env_dict['varpath'] = ''
+        env_dict['username'] = 'root'
 
-if not args.legacy:
-    # overwrite vmimgpath, installpath, varpath, username
-    env_dict['vmimgpath'] = args.initramfs
-    env_dict['installpath'] = '/usr'
-    env_dict['varpath'] = ''
-    env_dict['username'] = 'root'
+    return env_dict
 
 
-# Possibly autogenerate ring topology
-if args.ring != None and args.ring > 0:
-    print("Ignoring %s, generating ring topology" % (args.conf,))
-    fout = open('ring.conf', 'w')
-    for i in range(args.ring):
+def ring_conf_lines(n):
+    lines = []
+    for i in range(n):
         i_next = i + 1
-        if i_next == args.ring:
+        if i_next == n:
             i_next = 0
-        fout.write('eth %(vlan)s 0Mbps m%(i)s m%(inext)s\n' % \
+        lines.append('eth %(vlan)s 0Mbps m%(i)s m%(inext)s\n' % \
                     {'i': i+1, 'inext': i_next+1, 'vlan': i+1+100})
-    for i in range(args.ring):
+    for i in range(n):
         i_prev = i - 1
         if i_prev < 0:
-            i_prev = args.ring - 1
-        fout.write('dif n m%(i)s %(vlan)s %(vprev)s\n' % \
+            i_prev = n - 1
+        lines.append('dif n m%(i)s %(vlan)s %(vprev)s\n' % \
                     {'i': i+1, 'vlan': i+1+100, 'vprev': i_prev+1+100})
-    fout.close()
-    args.conf = 'ring.conf'
+    return lines
 
 
-# Some constants related to the RINA management
-injected_lines = []
-mgmt_shim_dif_name = '3456'
-mgmt_dif_name = 'NMS'
-mgmt_node_name = 'mgr'
+def read_conf_lines(conf):
+    if not os.path.exists(conf):
+        raise GenError("Error: %s not found" % conf)
 
+    fin = open(conf, 'rb')
+    data = fin.read()
+    fin.close()
 
-if not os.path.exists(args.conf):
-    print("Error: %s not found" % args.conf)
-    quit()
+    try:
+        data = data.decode('ascii')
+    except UnicodeDecodeError:
+        raise GenError("Error: %s is not ASCII encoded" % conf)
 
-# Try to check that gen.conf is ASCII
-try:
-    o = subprocess.check_output(['file', args.conf])
-    o = str(o).upper()
-    if o.find('ASCII') == -1:
-        print("Error: %s is not ASCII encoded" % args.conf)
-        quit()
-except Exception as e:
-    print(e)
-    pass
+    return data.splitlines(True)
 
 
 ############################# Parse gen.conf ##############################
-fin = open(args.conf, 'r')
-
-vms = dict()
-shims = dict()
-links = []
-difs = dict()
-enrollments = dict()
-dif_policies = dict()
-dif_graphs = dict()
-app_mappings = []
-overlays = dict()
-netems = dict()
-manual_enrollments = dict()
-
-linecnt = 0
-conf_injection = True
-
-while 1:
-    try:
-        line = fin.readline()
-    except UnicodeDecodeError:
-        print("Error: demo.conf must be ASCII encoded")
-        quit()
 
-    if line == '':
-        # EOF, try to pick from injected lines
-        if len(injected_lines) > 0:
-            line = injected_lines.pop(0)
+# Each gen.conf line is split into whitespace separated tokens, and the
+# first token selects the directive. Each directive validates its own
+# tokens against the precompiled grammar elements below.
+name_re = re.compile(r'[\w-]+$')
+word_re = re.compile(r'\w')
+number_re = re.compile(r'\d+$')
+speed_re = re.compile(r'(\d+)([GMK])bps$')
+nodes_re = re.compile(r'\*$|(?:[\w-]+,)*[\w-]+$')
+path_re = re.compile(r'[*\w.-]+$')
+parm_re = re.compile(r'[\w.-]+=[/\w.-]+$')
+parm_eq_re = re.compile(r'\s*=\s*')
+apname_re = re.compile(r'[\w.]+$')
+opath_re = re.compile(r'[\w./-]+$')
+ipcp_re = re.compile(r'[\w.-]+$')
+
+
+def parse_eth(sc, args, tokens, linecnt):
+    if len(tokens) < 4 or not number_re.match(tokens[1]) or \
+            not word_re.match(tokens[3]):
+        return 'invalid eth directive'
+    m = speed_re.match(tokens[2])
+    if m == None:
+        return 'invalid link speed "%s"' % tokens[2]
 
-    if line == '':
-        if not conf_injection:
-            # Injection already done, let's stop now
-            break
-        # Inject new lines and continue
-        conf_injection = False
-        if args.manager:
-            vm_list = [vmname for vmname in sorted(vms)]
-            vm_list.append(mgmt_node_name)  # a VM for the manager
-            injected_lines.append('eth %s 0Mbps %s' % (mgmt_shim_dif_name, ' '.join(vm_list)))
-            for vmname in vm_list:
-                injected_lines.append('dif %s %s %s' % (mgmt_dif_name, vmname, mgmt_shim_dif_name))
-        continue
-
-    linecnt += 1
-
-    line = line.replace('\n', '')
-
-    if line.startswith('#'):
-        continue
-
-    if re.match(r'\s*$', line):
-        continue
-
-    m = re.match(r'\s*eth\s+(\d+)\s+(\d+)([GMK])bps\s+(\w.*)$', line)
-    if m:
-        vlan = m.group(1)
-        speed = int(m.group(2))
-        speed_unit = m.group(3).lower()
-        vm_list = m.group(4).split()
-
-        if vlan in shims:
-            print('Error: Line %d: shim %s already defined' \
-                                            % (linecnt, vlan))
-            continue
+    vlan = tokens[1]
+    vm_list = tokens[3:]
 
-        shims[vlan] = {'bridge': 'rbr' + vlan, 'vlan': vlan, 'speed': speed,
-                       'speed_unit': speed_unit}
+    if not 1 <= int(vlan) <= 4095:
+        return 'invalid VLAN id %s (must be between 1 and 4095)' % vlan
 
-        for vm in vm_list:
-            if vm not in vms:
-                vms[vm] = {'name': vm, 'ports': []}
-            links.append((vlan, vm))
+    if vlan in sc.shims:
+        print('Error: Line %d: shim %s already defined' \
+                                        % (linecnt, vlan))
+        return None
 
-        #for i in range(len(vm_list)-1):
-        #    for j in range(i + 1, len(vm_list)):
-        #        print(vm_list[i], vm_list[j])
-        continue
+    sc.shims[vlan] = {'vlan': vlan,
+                      'speed': int(m.group(1)),
+                      'speed_unit': m.group(2).lower(),
+                      'linecnt': linecnt}
 
-    m = re.match(r'\s*dif\s+([\w-]+)\s+([\w-]+)\s+([\w-].*)$', line)
-    if m:
-        dif = m.group(1)
-        vm = m.group(2)
-        dif_list = m.group(3).split()
+    for vm in vm_list:
+        if vm not in sc.vms:
+            sc.vms[vm] = {'name': vm}
+        sc.links.append((vlan, vm))
 
-        if vm not in vms:
-            vms[vm] = {'name': vm, 'ports': []}
+    return None
 
-        if dif not in difs:
-            difs[dif] = dict()
 
-        if vm in difs[dif]:
-            print('Error: Line %d: vm %s in dif %s already specified' \
-                                            % (linecnt, vm, dif))
-            continue
+def parse_dif(sc, args, tokens, linecnt):
+    if len(tokens) < 4 or not name_re.match(tokens[1]) or \
+            not name_re.match(tokens[2]) or not name_re.match(tokens[3][0]):
+        return 'invalid dif directive'
 
-        difs[dif][vm] = dif_list
+    dif = tokens[1]
+    vm = tokens[2]
 
-        continue
+    if vm not in sc.vms:
+        sc.vms[vm] = {'name': vm}
 
-    m = re.match(r'\s*policy\s+([\w-]+)\s+(\*|(?:(?:[\w-]+,)*[\w-]+))\s+([*\w.-]+)\s+([\w-]+)((?:\s+[\w.-]+\s*=\s*[/\w.-]+)*)\s*$', line)
-    if m:
-        dif = m.group(1)
-        nodes = m.group(2)
-        path = m.group(3)
-        ps = m.group(4)
-        parms = list()
-        if m.group(5) != None:
-            parms_str = m.group(5).strip()
-            if parms_str != '':
-                parms = parms_str.split(' ')
+    if dif not in sc.difs:
+        sc.difs[dif] = dict()
 
-        if dif not in dif_policies:
-            dif_policies[dif] = []
+    if vm in sc.difs[dif]:
+        print('Error: Line %d: vm %s in dif %s already specified' \
+                                        % (linecnt, vm, dif))
+        return None
 
-        if nodes == '*':
-            nodes = []
-        else:
-            nodes = nodes.split(',')
+    sc.difs[dif][vm] = tokens[3:]
 
-        dif_policies[dif].append({'path': path, 'nodes': nodes,
-                                  'ps': ps, 'parms' : parms})
-        if not gen_templates.policy_path_valid(path):
-            print('Unknown component path "%s"' % path)
-            quit(1)
-        continue
+    return None
 
-    m = re.match(r'\s*appmap\s+([\w-]+)\s+([\w.]+)\s+(\d+)\s*$', line)
-    if m:
-        dif = m.group(1)
-        apname = m.group(2)
-        apinst = m.group(3)
 
-        app_mappings.append({'name': '%s-%s--' % (apname, apinst), 'dif' : dif})
+def parse_policy(sc, args, tokens, linecnt):
+    if len(tokens) < 5 or not name_re.match(tokens[1]) or \
+            not nodes_re.match(tokens[2]) or not path_re.match(tokens[3]) or \
+            not name_re.match(tokens[4]):
+        return 'invalid policy directive'
 
-        continue
+    dif = tokens[1]
+    nodes = tokens[2]
+    path = tokens[3]
+    ps = tokens[4]
 
-    m = re.match(r'\s*overlay\s+([\w-]+)\s+([\w.-/]+\s*$)', line)
-    if m:
-        vmname = m.group(1)
-        opath = m.group(2)
+    # Policy parameters may have spaces around the '=' sign
+    parms = parm_eq_re.sub('=', ' '.join(tokens[5:])).split()
+    for parm in parms:
+        if not parm_re.match(parm):
+            return 'invalid policy parameter "%s"' % parm
 
-        opath = os.path.abspath(opath)
+    if not gen_templates.policy_path_valid(path):
+        return 'unknown component path "%s"' % path
 
-        if not os.path.isdir(opath):
-            print("Error: line %d: no such overlay path" % linecnt)
-            continue
+    if dif not in sc.dif_policies:
+        sc.dif_policies[dif] = []
+
+    if nodes == '*':
+        nodes = []
+    else:
+        nodes = nodes.split(',')
+
+    sc.dif_policies[dif].append({'path': path, 'nodes': nodes,
+                                 'ps': ps, 'parms' : parms})
+
+    return None
+
+
+def parse_appmap(sc, args, tokens, linecnt):
+    if len(tokens) != 4 or not name_re.match(tokens[1]) or \
+            not apname_re.match(tokens[2]) or not number_re.match(tokens[3]):
+        return 'invalid appmap directive'
+
+    sc.app_mappings.append({'name': '%s-%s--' % (tokens[2], tokens[3]),
+                            'dif' : tokens[1]})
+
+    return None
+
+
+def parse_overlay(sc, args, tokens, linecnt):
+    if len(tokens) != 3 or not name_re.match(tokens[1]) or \
+            not opath_re.match(tokens[2]):
+        return 'invalid overlay directive'
+
+    opath = os.path.abspath(tokens[2])
+
+    if not os.path.isdir(opath):
+        print("Error: line %d: no such overlay path" % linecnt)
+        return None
 
-        overlays[vmname] = opath
+    sc.overlays[tokens[1]] = opath
 
-        continue
+    return None
 
-    m = re.match(r'\s*netem\s+(\d+)\s+([\w-]+)\s+(\w.*)$', line)
-    if m:
-        dif = m.group(1)
-        vmname = m.group(2)
-        netem_args = m.group(3)
 
-        if dif not in netems:
-            netems[dif] = dict()
-        netems[dif][vmname] = {'args': netem_args, 'linecnt': linecnt}
+def parse_netem(sc, args, tokens, linecnt):
+    if len(tokens) < 4 or not number_re.match(tokens[1]) or \
+            not name_re.match(tokens[2]) or not word_re.match(tokens[3]):
+        return 'invalid netem directive'
 
-        continue
+    dif = tokens[1]
 
-    m = re.match(r'\s*enroll\s+([\w.-]+)\s+([\w.-]+)\s+([\w.-]+)\s+([\w.-]+)\s*$', line)
-    if m:
-        if args.enrollment_strategy != 'manual':
-            print('Warning: ignoring enroll directive at line %d' % linecnt)
+    if dif not in sc.netems:
+        sc.netems[dif] = dict()
+    sc.netems[dif][tokens[2]] = {'args': ' '.join(tokens[3:]),
+                                 'linecnt': linecnt}
+
+    return None
+
+
+def parse_enroll(sc, args, tokens, linecnt):
+    if len(tokens) != 5 or not all(ipcp_re.match(t) for t in tokens[1:]):
+        return 'invalid enroll directive'
+
+    if args.enrollment_strategy != 'manual':
+        print('Warning: ignoring enroll directive at line %d' % linecnt)
+        return None
+
+    dif_name = tokens[1]
+
+    if dif_name not in sc.manual_enrollments:
+        sc.manual_enrollments[dif_name] = []
+    sc.manual_enrollments[dif_name].append({
+                               'enrollee': tokens[2],
+                               'enroller': tokens[3],
+                               'lower_dif': tokens[4],
+                               'linecnt': linecnt})
+    return None
+
+
+def parse_addressing(sc, args, tokens, linecnt):
+    if len(tokens) != 3 or not name_re.match(tokens[1]) or \
+            tokens[2] not in address_allocators:
+        return 'invalid addressing directive'
+
+    sc.dif_addressing[tokens[1]] = {'scheme': tokens[2], 'linecnt': linecnt}
+
+    return None
+
+
+def parse_smp(sc, args, tokens, linecnt):
+    if len(tokens) != 3 or not name_re.match(tokens[1]) or \
+            not number_re.match(tokens[2]) or int(tokens[2]) == 0:
+        return 'invalid smp directive'
+
+    sc.vm_smp[tokens[1]] = {'smp': int(tokens[2]), 'linecnt': linecnt}
+
+    return None
+
+
+directive_parsers = {
+    'eth': parse_eth,
+    'dif': parse_dif,
+    'policy': parse_policy,
+    'appmap': parse_appmap,
+    'overlay': parse_overlay,
+    'netem': parse_netem,
+    'enroll': parse_enroll,
+    'addressing': parse_addressing,
+    'smp': parse_smp,
+}
+
+
+def manager_lines(sc):
+    vm_list = [vmname for vmname in sorted(sc.vms)]
+    vm_list.append(mgmt_node_name)  # a VM for the manager
+    lines = ['eth %s 0Mbps %s' % (mgmt_shim_dif_name, ' '.join(vm_list))]
+    for vmname in vm_list:
+        lines.append('dif %s %s %s' % (mgmt_dif_name, vmname, mgmt_shim_dif_name))
+    return lines
+
+
+def parse_lines(sc, args, lines, linecnt, errors):
+    for line in lines:
+        linecnt += 1
+
+        tokens = line.split()
+        if len(tokens) == 0 or tokens[0].startswith('#'):
             continue
 
-        dif_name = m.group(1)
-        enrollee = m.group(2)
-        enroller = m.group(3)
-        n_1_dif = m.group(4)
+        parser = directive_parsers.get(tokens[0])
+        if parser == None:
+            errors.append("Error: line %d not recognized" % linecnt)
+            continue
 
-        if dif_name not in manual_enrollments:
-            manual_enrollments[dif_name] = []
-        manual_enrollments[dif_name].append({
-                                   'enrollee': enrollee,
-                                   'enroller': enroller,
-                                   'lower_dif': n_1_dif,
-                                   'linecnt': linecnt})
-        continue
+        err = parser(sc, args, tokens, linecnt)
+        if err != None:
+            errors.append("Error: line %d: %s" % (linecnt, err))
 
-    print("Error: line %d not recognized" % linecnt)
-    quit()
+    return linecnt
 
-fin.close()
 
-for dif in difs:
-    if dif not in dif_policies:
-        dif_policies[dif] = []
+def parse(args, lines = None):
+    """Parse the scenario description, either from the list of
+       lines specified or from the args.conf file. All the errors
+       found are reported together by a single GenError"""
+    if lines == None:
+        lines = read_conf_lines(args.conf)
 
-boot_batch_size = max(1, multiprocessing.cpu_count() / 2)
-wait_for_boot = 12  # in seconds
-if len(vms) > 8:
-    print("You want to run a lot of nodes, so it's better if I give "
-          "each node some time to boot (since the boot is CPU-intensive)")
+    sc = Scenario()
+    errors = []
 
-############ Compute registration/enrollment order for DIFs ###############
+    linecnt = parse_lines(sc, args, lines, 0, errors)
+    sc.conf_lines = linecnt
+    if args.manager:
+        # The NMS DIF spans all the nodes, so it can only be added
+        # once all the nodes are known
+        parse_lines(sc, args, manager_lines(sc), linecnt, errors)
 
-# Compute DIFs dependency graph, as both adjacency and incidence list.
-difsdeps_adj = dict()
-difsdeps_inc = dict()
-for dif in difs:
-    difsdeps_inc[dif] = set()
-    difsdeps_adj[dif] = set()
-for shim in shims:
-    difsdeps_inc[shim] = set()
-    difsdeps_adj[shim] = set()
-
-for dif in difs:
-    for vmname in difs[dif]:
-        for lower_dif in difs[dif][vmname]:
-            difsdeps_inc[dif].add(lower_dif)
-            difsdeps_adj[lower_dif].add(dif)
-
-# Kahn's algorithm below only needs per-node count of
-# incident edges, so we compute these counts from the
-# incidence list and drop the latter.
-difsdeps_inc_cnt = dict()
-for dif in difsdeps_inc:
-    difsdeps_inc_cnt[dif] = len(difsdeps_inc[dif])
-del difsdeps_inc
-
-#print(difsdeps_adj)
-#print(difsdeps_inc_cnt)
-
-# Run Kahn's algorithm to compute topological ordering on the DIFs graph.
-frontier = set()
-dif_ordering = []
-for dif in difsdeps_inc_cnt:
-    if difsdeps_inc_cnt[dif] == 0:
-        frontier.add(dif)
-
-while len(frontier):
-    cur = frontier.pop()
-    dif_ordering.append(cur)
-    for nxt in difsdeps_adj[cur]:
-        difsdeps_inc_cnt[nxt] -= 1
-        if difsdeps_inc_cnt[nxt] == 0:
-            frontier.add(nxt)
-    difsdeps_adj[cur] = set()
-
-circular_set = [dif for dif in difsdeps_inc_cnt if difsdeps_inc_cnt[dif] != 0]
-if len(circular_set):
-    print("Fatal error: The specified DIFs topology has one or more"\
-          "circular dependencies, involving the following"\
-          " DIFs: %s" % circular_set)
-    print("             DIFs dependency graph: %s" % difsdeps_adj);
-    quit(1)
+    if len(errors):
+        raise GenError('\n'.join(errors))
+
+    for dif in sc.difs:
+        if dif not in sc.dif_policies:
+            sc.dif_policies[dif] = []
+
+    return sc
+
+
+############ Compute registration/enrollment order for DIFs ###############
+def compute_dif_ordering(sc):
+    difs = sc.difs
+
+    # Compute DIFs dependency graph, as both adjacency and incidence list.
+    difsdeps_adj = dict()
+    difsdeps_inc = dict()
+    for dif in difs:
+        difsdeps_inc[dif] = set()
+        difsdeps_adj[dif] = set()
+    for shim in sc.shims:
+        difsdeps_inc[shim] = set()
+        difsdeps_adj[shim] = set()
+
+    for dif in difs:
+        for vmname in difs[dif]:
+            for lower_dif in difs[dif][vmname]:
+                difsdeps_inc[dif].add(lower_dif)
+                difsdeps_adj[lower_dif].add(dif)
+
+    # Kahn's algorithm below only needs per-node count of
+    # incident edges, so we compute these counts from the
+    # incidence list and drop the latter.
+    difsdeps_inc_cnt = dict()
+    for dif in difsdeps_inc:
+        difsdeps_inc_cnt[dif] = len(difsdeps_inc[dif])
+    del difsdeps_inc
+
+    # Run Kahn's algorithm to compute topological ordering on the DIFs graph.
+    # The frontier is a heap, so that the ordering is deterministic.
+    frontier = []
+    dif_ordering = []
+    for dif in difsdeps_inc_cnt:
+        if difsdeps_inc_cnt[dif] == 0:
+            heapq.heappush(frontier, dif)
+
+    while len(frontier):
+        cur = heapq.heappop(frontier)
+        dif_ordering.append(cur)
+        for nxt in difsdeps_adj[cur]:
+            difsdeps_inc_cnt[nxt] -= 1
+            if difsdeps_inc_cnt[nxt] == 0:
+                heapq.heappush(frontier, nxt)
+        difsdeps_adj[cur] = set()
+
+    circular_set = [dif for dif in difsdeps_inc_cnt if difsdeps_inc_cnt[dif] != 0]
+    if len(circular_set):
+        raise GenError("Fatal error: The specified DIFs topology has one or more"\
+                       "circular dependencies, involving the following"\
+                       " DIFs: %s\n"\
+                       "             DIFs dependency graph: %s"
+                       % (circular_set, difsdeps_adj))
+
+    return dif_ordering
 
 
 ####################### Compute DIF graphs #######################
-for dif in difs:
-    neighsets = dict()
-    dif_graphs[dif] = dict()
-    first = None
-
-    # For each N-1-DIF supporting this DIF, compute the set of nodes that
-    # share such N-1-DIF. This set will be called the 'neighset' of
-    # the N-1-DIF for the current DIF.
-
-    for vmname in difs[dif]:
-        dif_graphs[dif][vmname] = [] # init for later use
-        if first == None: # pick any node for later use
-            first = vmname
-        for lower_dif in difs[dif][vmname]:
-            if lower_dif not in neighsets:
-                neighsets[lower_dif] = []
-            neighsets[lower_dif].append(vmname)
-
-    # Build the graph, represented as adjacency list
-    for lower_dif in neighsets:
-        # Each neighset corresponds to a complete (sub)graph.
-        for vm1 in neighsets[lower_dif]:
-            for vm2 in neighsets[lower_dif]:
-                if vm1 != vm2:
-                    dif_graphs[dif][vm1].append((vm2, lower_dif))
-
-    enrollments[dif] = []
-
-    if args.manager and dif == mgmt_dif_name:
-        # Enrollment in the NMS DIF is managed as a special case:
-        # each node is enrolled against the manager node
-        for vmname in vms:
-            if vmname != mgmt_node_name:
-                enrollments[dif].append({'enrollee': vmname,
-                                         'enroller': mgmt_node_name,
-                                         'lower_dif': mgmt_shim_dif_name})
-
-    elif args.enrollment_strategy == 'minimal':
-        # To generate the list of enrollments, we simulate one,
-        # using breadth-first trasversal.
-        enrolled = set([first])
-        frontier = set([first])
+class DIFGraph:
+    """The graph of a normal DIF. Two nodes are neighbors if they share an
+       N-1-DIF, so each N-1-DIF would be a complete subgraph: the graph is
+       rather stored as the bipartite node <--> N-1-DIF membership relation,
+       in compressed sparse row form, and neighbors are enumerated lazily"""
+
+    def __init__(self, members):
+        # members maps each node name to the list of its N-1-DIFs
+        self.nodes = list(members)
+        self.node_idx = dict()
+        self.lower_difs = []
+        self.lower_idx = dict()
+
+        node_lowers = []
+        for i in range(len(self.nodes)):
+            self.node_idx[self.nodes[i]] = i
+            lows = set()
+            for lower_dif in members[self.nodes[i]]:
+                j = self.lower_idx.get(lower_dif)
+                if j == None:
+                    j = len(self.lower_difs)
+                    self.lower_idx[lower_dif] = j
+                    self.lower_difs.append(lower_dif)
+                lows.add(j)
+            node_lowers.append(sorted(lows))
+
+        # node --> N-1-DIFs rows
+        self.node_ptr = array.array('l', [0])
+        self.node_adj = array.array('l')
+        for lows in node_lowers:
+            self.node_adj.extend(lows)
+            self.node_ptr.append(len(self.node_adj))
+        del node_lowers
+
+        # N-1-DIF --> nodes rows, filled in node order
+        counts = [0] * len(self.lower_difs)
+        for j in self.node_adj:
+            counts[j] += 1
+        self.lower_ptr = array.array('l', [0])
+        for j in range(len(counts)):
+            self.lower_ptr.append(self.lower_ptr[-1] + counts[j])
+        fill = array.array('l', self.lower_ptr[:-1])
+        self.lower_adj = array.array('l', [0] * len(self.node_adj))
+        for i in range(len(self.nodes)):
+            for k in range(self.node_ptr[i], self.node_ptr[i + 1]):
+                j = self.node_adj[k]
+                self.lower_adj[fill[j]] = i
+                fill[j] += 1
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, vmname):
+        return vmname in self.node_idx
+
+    def lower_difs_of(self, vmname):
+        i = self.node_idx[vmname]
+        return [self.lower_difs[self.node_adj[k]]
+                for k in range(self.node_ptr[i], self.node_ptr[i + 1])]
+
+    def members_of(self, lower_dif):
+        j = self.lower_idx[lower_dif]
+        return [self.nodes[self.lower_adj[k]]
+                for k in range(self.lower_ptr[j], self.lower_ptr[j + 1])]
+
+    def is_member(self, vmname, lower_dif):
+        i = self.node_idx.get(vmname)
+        j = self.lower_idx.get(lower_dif)
+        if i == None or j == None:
+            return False
+        return j in self.node_adj[self.node_ptr[i]:self.node_ptr[i + 1]]
+
+    def neighbors(self, vmname, skip = None):
+        """Generate the (neighbor, N-1-DIF) pairs of a node. N-1-DIFs whose
+           index is in the skip set are not traversed."""
+        i = self.node_idx[vmname]
+        for k in range(self.node_ptr[i], self.node_ptr[i + 1]):
+            j = self.node_adj[k]
+            if skip != None:
+                if j in skip:
+                    continue
+                skip.add(j)
+            lower_dif = self.lower_difs[j]
+            for h in range(self.lower_ptr[j], self.lower_ptr[j + 1]):
+                if self.lower_adj[h] != i:
+                    yield (self.nodes[self.lower_adj[h]], lower_dif)
+
+    def edges(self):
+        """Generate each (node, neighbor, N-1-DIF) edge once"""
+        for vmname in self.nodes:
+            for (neigh, lower_dif) in self.neighbors(vmname):
+                if vmname < neigh:
+                    yield (vmname, neigh, lower_dif)
+
+    def depths(self, root, limit = None):
+        """Return the distance of each node reachable from root, or None
+           as soon as a node at distance limit is found"""
+        depth = {root: 0}
+        frontier = [root]
+        traversed = set()
         while len(frontier):
-            cur = frontier.pop()
-            for edge in dif_graphs[dif][cur]:
-                if edge[0] not in enrolled:
-                    enrolled.add(edge[0])
-                    enrollments[dif].append({'enrollee': edge[0],
-                                             'enroller': cur,
-                                             'lower_dif': edge[1]})
-                    frontier.add(edge[0])
-
-    elif args.enrollment_strategy == 'full-mesh':
-        for cur in dif_graphs[dif]:
-            for edge in dif_graphs[dif][cur]:
-                if cur < edge[0]:
-                    enrollments[dif].append({'enrollee': cur,
-                                             'enroller': edge[0],
-                                             'lower_dif': edge[1]})
-
-    elif args.enrollment_strategy == 'manual':
-        if dif not in manual_enrollments:
-            continue
+            following = []
+            for cur in frontier:
+                for (neigh, lower_dif) in self.neighbors(cur, traversed):
+                    if neigh not in depth:
+                        depth[neigh] = depth[cur] + 1
+                        following.append(neigh)
+            if len(following) and limit != None and \
+                    depth[following[0]] >= limit:
+                return None
+            frontier = following
+        return depth
+
+    def center(self):
+        """Return a node close to the minimum eccentricity, i.e. the root
+           of shallow spanning trees: the middle of a longest shortest path
+           found by a double sweep (exact on trees)"""
+        if len(self.nodes) == 0:
+            return None
+
+        def farthest(depth):
+            d = max(depth.values())
+            return min([v for v in depth if depth[v] == d])
+
+        # Two visits find the ends of a long path, and a third one the
+        # nodes in its middle
+        start = farthest(self.depths(min(self.nodes)))
+        from_start = self.depths(start)
+        end = farthest(from_start)
+        from_end = self.depths(end)
+        diameter = from_start[end]
+        return min([(max(from_start[v], from_end[v]), v) for v in from_start
+                    if from_start[v] + from_end[v] == diameter])[1]
+
+
+# The balanced enrollment strategy: a spanning tree of the DIF graph rooted
+# at its center, built level by level, where each node enrolls at most
+# max_enrollees nodes (unless some node can only be enrolled by full nodes).
+# Each node may then enroll with up to 'redundant' more neighbors, which
+# are not full, for resilience.
+def balanced_enrollments(graph, max_enrollees, redundant):
+    root = graph.center()
+    depth = {root: 0}
+    load = collections.Counter()
+    adjacent = set()
+    enrollments = []
+
+    def enroll(enrollee, enroller, lower_dif):
+        enrollments.append({'enrollee': enrollee, 'enroller': enroller,
+                            'lower_dif': lower_dif})
+        load[enroller] += 1
+        adjacent.add((enrollee, enroller))
+        adjacent.add((enroller, enrollee))
+
+    # Candidates are the nodes adjacent to the ones enrolled in the
+    # previous round, and the ones which could not be enrolled yet
+    frontier = [root]
+    candidates = set()
+    while len(frontier) or len(candidates):
+        traversed = set()
+        for cur in frontier:
+            for (neigh, lower_dif) in graph.neighbors(cur, traversed):
+                if neigh not in depth:
+                    candidates.add(neigh)
+        if len(candidates) == 0:
+            break
 
-        for e in manual_enrollments[dif]:
-            if e['enrollee'] not in difs[dif]:
-                print('Warning: ignoring line %d because VM %s does '\
-                      'not belong to DIF %s' % (e['linecnt'],
-                      e['enrollee'],  dif))
+        options = dict()
+        for vmname in candidates:
+            options[vmname] = sorted([(depth[neigh], neigh, lower_dif)
+                                      for (neigh, lower_dif)
+                                          in graph.neighbors(vmname)
+                                      if neigh in depth])
+
+        # The most constrained candidates choose first, and each one picks
+        # the least loaded enroller, closest to the root
+        frontier = []
+        for vmname in sorted(candidates, key = lambda v: (len(options[v]), v)):
+            choices = [(load[e], d, e, lower_dif)
+                       for (d, e, lower_dif) in options[vmname]
+                       if load[e] < max_enrollees]
+            if len(choices) == 0:
                 continue
-
-            if e['enroller'] not in difs[dif]:
-                print('Warning: ignoring line %d because VM %s does '\
-                      'not belong to DIF %s' % (e['linecnt'],
-                      e['enroller'],  dif))
+            (l, d, enroller, lower_dif) = min(choices)
+            enroll(vmname, enroller, lower_dif)
+            depth[vmname] = depth[enroller] + 1
+            frontier.append(vmname)
+        candidates -= set(frontier)
+
+        if len(frontier) == 0:
+            # All the possible enrollers are full: exceed the limit for
+            # the least loaded one
+            vmname = sorted(candidates)[0]
+            (l, d, enroller, lower_dif) = min([(load[e], d, e, lower_dif)
+                                               for (d, e, lower_dif)
+                                                   in options[vmname]])
+            enroll(vmname, enroller, lower_dif)
+            depth[vmname] = depth[enroller] + 1
+            frontier.append(vmname)
+            candidates.remove(vmname)
+
+    for vmname in sorted(depth, key = lambda v: (depth[v], v)):
+        choices = sorted([(load[neigh], depth[neigh], neigh, lower_dif)
+                          for (neigh, lower_dif) in graph.neighbors(vmname)
+                          if neigh in depth and
+                              (vmname, neigh) not in adjacent])
+        added = 0
+        for (l, d, enroller, lower_dif) in choices:
+            if added == redundant:
+                break
+            if load[enroller] >= max_enrollees or \
+                    (vmname, enroller) in adjacent:
                 continue
-
-            if e['lower_dif'] not in neighsets or \
-                    e['enrollee'] not in neighsets[e['lower_dif']]:
-                print('Warning: ignoring line %d because VM %s cannot '\
-                      'use N-1-DIF %s' % (e['linecnt'], e['enrollee'],
-                                          e['lower_dif']))
+            enroll(vmname, enroller, lower_dif)
+            added += 1
+
+    return enrollments
+
+
+def compute_enrollments(pl):
+    sc = pl.scenario
+    difs = sc.difs
+    args = pl.args
+
+    for dif in difs:
+        graph = pl.dif_graphs[dif] = DIFGraph(difs[dif])
+        first = graph.nodes[0] # pick any node for later use
+
+        enrollments = pl.enrollments[dif] = []
+
+        if args.manager and dif == mgmt_dif_name:
+            # Enrollment in the NMS DIF is managed as a special case:
+            # each node is enrolled against the manager node
+            for vmname in sc.vms:
+                if vmname != mgmt_node_name:
+                    enrollments.append({'enrollee': vmname,
+                                        'enroller': mgmt_node_name,
+                                        'lower_dif': mgmt_shim_dif_name})
+
+        elif args.enrollment_strategy == 'minimal':
+            # To generate the list of enrollments, we simulate one,
+            # using breadth-first trasversal. All the members of an N-1-DIF
+            # are enrolled the first time it is traversed, so each N-1-DIF
+            # needs to be traversed only once.
+            enrolled = set([first])
+            frontier = collections.deque([first])
+            traversed = set()
+            while len(frontier):
+                cur = frontier.popleft()
+                for edge in graph.neighbors(cur, traversed):
+                    if edge[0] not in enrolled:
+                        enrolled.add(edge[0])
+                        enrollments.append({'enrollee': edge[0],
+                                            'enroller': cur,
+                                            'lower_dif': edge[1]})
+                        frontier.append(edge[0])
+
+        elif args.enrollment_strategy == 'full-mesh':
+            for cur in graph:
+                for edge in graph.neighbors(cur):
+                    if cur < edge[0]:
+                        enrollments.append({'enrollee': cur,
+                                            'enroller': edge[0],
+                                            'lower_dif': edge[1]})
+
+        elif args.enrollment_strategy == 'balanced':
+            enrollments.extend(balanced_enrollments(graph, args.max_enrollees,
+                                                    args.redundant_enrollments))
+
+        elif args.enrollment_strategy == 'manual':
+            if dif not in sc.manual_enrollments:
                 continue
 
-            if e['lower_dif'] not in neighsets or \
-                    e['enroller'] not in neighsets[e['lower_dif']]:
-                print('Warning: ignoring line %d because VM %s cannot '\
-                      'use N-1-DIF %s' % (e['linecnt'], e['enroller'],
-                                          e['lower_dif']))
+            for e in sc.manual_enrollments[dif]:
+                if e['enrollee'] not in difs[dif]:
+                    print('Warning: ignoring line %d because VM %s does '\
+                          'not belong to DIF %s' % (e['linecnt'],
+                          e['enrollee'],  dif))
+                    continue
+
+                if e['enroller'] not in difs[dif]:
+                    print('Warning: ignoring line %d because VM %s does '\
+                          'not belong to DIF %s' % (e['linecnt'],
+                          e['enroller'],  dif))
+                    continue
+
+                if not graph.is_member(e['enrollee'], e['lower_dif']):
+                    print('Warning: ignoring line %d because VM %s cannot '\
+                          'use N-1-DIF %s' % (e['linecnt'], e['enrollee'],
+                                              e['lower_dif']))
+                    continue
+
+                if not graph.is_member(e['enroller'], e['lower_dif']):
+                    print('Warning: ignoring line %d because VM %s cannot '\
+                          'use N-1-DIF %s' % (e['linecnt'], e['enroller'],
+                                              e['lower_dif']))
+                    continue
+
+                enrollments.append(e)
+
+        else:
+            # This is a bug
+            assert(False)
+
+    for shim in sc.shims:
+        pl.enrollments[shim] = []
+
+
+# Compute the dependencies among the enrollments, which form a DAG. An
+# enrollment only needs the enrollee and the enroller to be members of the
+# N-1-DIF it goes through, and the enroller to be a member of the N-DIF.
+# Moreover, the enrollments of a node into the same DIF are carried out in
+# the order of the plan.
+def compute_enrollment_dag(pl):
+    tasks = pl.enrollment_tasks = []
+    joined = dict()     # (dif, vmname) --> task making vmname join dif
+
+    for dif in pl.dif_ordering:
+        last = dict()   # vmname --> last task enrolling vmname into dif
+
+        for enrollment in pl.enrollments[dif]:
+            depends = set()
+            for vmname in [enrollment['enrollee'], enrollment['enroller']]:
+                key = (enrollment['lower_dif'], vmname)
+                if key in joined:
+                    depends.add(joined[key])
+
+            # The enroller only needs to have joined the DIF, so that the
+            # additional enrollments of the nodes do not queue behind each
+            # other
+            enrollee = enrollment['enrollee']
+            if enrollee in last:
+                depends.add(last[enrollee])
+            if (dif, enrollment['enroller']) in joined:
+                depends.add(joined[(dif, enrollment['enroller'])])
+
+            task = {'id': len(tasks), 'dif': dif,
+                    'enrollee': enrollment['enrollee'],
+                    'enroller': enrollment['enroller'],
+                    'lower_dif': enrollment['lower_dif'],
+                    'depends': sorted(depends)}
+            task['depth'] = 1 + max([tasks[t]['depth'] for t in depends] + [0])
+            tasks.append(task)
+
+            last[enrollment['enrollee']] = task['id']
+            if (dif, enrollment['enrollee']) not in joined:
+                joined[(dif, enrollment['enrollee'])] = task['id']
+
+    # Length of the longest chain of dependent enrollments, i.e. the minimum
+    # number of enrollment rounds needed with unbounded parallelism
+    pl.critical_path = max([task['depth'] for task in tasks] + [0])
+
+
+################## Assign VM identifiers and TAP ports ####################
+# Maximum length of a network interface name (IFNAMSIZ - 1)
+ifname_max = 15
+
+
+class Resources:
+    """The resources handed out to the nodes of a Plan and to the host
+       (MAC addresses, interface names, forwarded ports and pidfiles). No
+       resource is handed out twice, and a GenError is raised as soon as a
+       resource space runs out."""
+
+    def __init__(self, baseport):
+        self.baseport = baseport
+        self.used = collections.defaultdict(set)
+        self.ifname_cnt = 0
+
+    def claim(self, space, value, what):
+        if value in self.used[space]:
+            raise GenError('%s %s is assigned twice' % (what, value))
+        self.used[space].add(value)
+        return value
+
+    def mac(self, vmid, nic):
+        # The fourth byte only changes beyond 255 nodes, so that the MAC
+        # addresses of the smaller scenarios do not change
+        high = 0x0a + (vmid >> 8)
+        if high > 0xff or nic > 0xff:
+            raise GenError('No MAC address left for interface %d of node '
+                           '%d' % (nic, vmid))
+        return self.claim('mac', '00:0a:0a:%02x:%02x:%02x'
+                                 % (high, vmid & 0xff, nic), 'MAC address')
+
+    def forward_port(self, vmid):
+        port = self.baseport + vmid
+        if port > 65535:
+            raise GenError('No forwarded port left for node %d (baseport '
+                           'is %d)' % (vmid, self.baseport))
+        return self.claim('port', port, 'Forwarded port')
+
+    def ifname(self, preferred, prefix):
+        """Return the preferred interface name if it is valid and not in
+           use, or else the first free one made of the prefix followed by
+           a counter"""
+        if len(preferred) <= ifname_max and \
+                preferred not in self.used['ifname']:
+            return self.claim('ifname', preferred, 'Interface name')
+
+        while True:
+            self.ifname_cnt += 1
+            name = '%s%x' % (prefix, self.ifname_cnt)
+            if len(name) > ifname_max:
+                raise GenError('No interface name left for %s' % preferred)
+            if name not in self.used['ifname']:
+                return self.claim('ifname', name, 'Interface name')
+
+    def pidfile(self, vmid):
+        return self.claim('pidfile', 'rina-%d.pid' % vmid, 'Pidfile')
+
+
+def compute_ports(pl):
+    sc = pl.scenario
+    shims = sc.shims
+    vms = pl.vms
+    resources = pl.resources = Resources(pl.env_dict['baseport'])
+
+    for vmname in sc.vms:
+        vms[vmname] = {'name': vmname, 'ports': [], 'host': 0}
+
+    for shim in sorted(shims):
+        pl.bridges[shim] = resources.ifname('rbr' + shim, 'rbr.')
+
+    for l in sorted(sc.links):
+        shim, vm = l
+        b = pl.bridges[shim]
+        idx = len(vms[vm]['ports']) + 1
+        tap = resources.ifname('%s.%02x' % (vm, idx), 'rtap.')
+
+        netem = None
+        if shim in sc.netems:
+            if vm in sc.netems[shim]:
+                err = gen_netem.netem_validate(sc.netems[shim][vm]['args'],
+                                               pl.args.netem_probe)
+                if err == None:
+                    netem = sc.netems[shim][vm]['args']
+                else:
+                    print('Warning: line %s is invalid (%s) and '\
+                          'will be ignored' % (sc.netems[shim][vm]['linecnt'],
+                                               err))
+
+        port = {'tap': tap, 'br': b, 'idx': idx, 'vlan': shim,
+                'netem': netem, 'vm': vm}
+        vms[vm]['ports'].append(port)
+        pl.ports.append(port)
+
+    vmid = 1
+    for vmname in sorted(vms):
+        vm = vms[vmname]
+        vm['id'] = vmid
+        vm['ssh'] = resources.forward_port(vmid)
+        vm['pidfile'] = resources.pidfile(vmid)
+        # The management interface is the 99th, so the data interfaces
+        # skip it
+        vm['mac'] = resources.mac(vmid, 99)
+        for port in vm['ports']:
+            port['mac'] = resources.mac(vmid, port['idx'] +
+                                              (port['idx'] >= 99))
+        vmid += 1
+
+
+###################### Spread the nodes on hosts ######################
+# Return the number of hosts spanned by an L2 domain, given the number of
+# its members on each host
+def hosts_spanned(counts):
+    return len([h for h in counts if counts[h] > 0])
+
+
+# Assign each node to one of nhosts hosts, trying to minimize the number of
+# L2 domains spanning several hosts (and then the number of hosts spanned),
+# with about the same number of nodes on each host. Return a dictionary
+# mapping each node to the index of its host. Only the nodes in 'nodes'
+# are assigned, if specified.
+def partition_nodes(sc, nhosts, nodes = None, max_passes = 10):
+    nodes = sorted(sc.vms if nodes == None else nodes)
+    node_set = set(nodes)
+    members = collections.defaultdict(list)
+    node_shims = collections.defaultdict(list)
+    for (shim, vm) in sorted(sc.links):
+        if vm not in node_set:
+            continue
+        members[shim].append(vm)
+        node_shims[vm].append(shim)
+
+    # Start from consecutive chunks of a breadth-first order of the nodes,
+    # where the members of an L2 domain are adjacent
+    order = []
+    seen = set()
+    visited = set()
+    for root in nodes:
+        if root in seen:
+            continue
+        seen.add(root)
+        order.append(root)
+        i = len(order) - 1
+        while i < len(order):
+            for shim in node_shims[order[i]]:
+                if shim in visited:
+                    continue
+                visited.add(shim)
+                for vm in members[shim]:
+                    if vm not in seen:
+                        seen.add(vm)
+                        order.append(vm)
+            i += 1
+
+    size = -(-len(nodes) // nhosts)
+    part = dict()
+    for i in range(len(order)):
+        part[order[i]] = i // size
+
+    # Then move single nodes to the host which reduces the crossing domains
+    # the most, allowing hosts to exceed the average size by 10%
+    max_nodes = size + size // 10
+    load = collections.Counter(part.values())
+    span = dict()
+    for shim in members:
+        span[shim] = collections.Counter([part[vm] for vm in members[shim]])
+
+    for p in range(max_passes):
+        moved = False
+        for vm in order:
+            src = part[vm]
+            targets = set([h for shim in node_shims[vm] for h in span[shim]
+                           if span[shim][h] > 0 and h != src])
+            best = None
+            best_gain = (0, 0)
+            for dst in sorted(targets):
+                if load[dst] >= max_nodes:
+                    continue
+                crossing = 0
+                spanned = 0
+                for shim in node_shims[vm]:
+                    before = hosts_spanned(span[shim])
+                    after = before - (span[shim][src] == 1) + \
+                                     (span[shim][dst] == 0)
+                    crossing += (before > 1) - (after > 1)
+                    spanned += before - after
+                if (crossing, spanned) > best_gain:
+                    best = dst
+                    best_gain = (crossing, spanned)
+            if best == None:
                 continue
+            for shim in node_shims[vm]:
+                span[shim][src] -= 1
+                span[shim][best] += 1
+            load[src] -= 1
+            load[best] += 1
+            part[vm] = best
+            moved = True
+        if not moved:
+            break
+
+    return part
+
+
+# With --hosts, spread the nodes on the hosts, and stitch the parts of each
+# L2 domain spanning several hosts with tunnels, one for each domain, so
+# that the domains stay isolated
+def compute_hosts(pl):
+    sc = pl.scenario
+    args = pl.args
 
-            enrollments[dif].append(e)
+    if args.hosts == None:
+        return
 
+    pl.hosts = [host for host in args.hosts.split(',') if host != '']
+    if len(pl.hosts) == 0:
+        raise GenError('No hosts specified with --hosts')
+    if args.run:
+        raise GenError('--run cannot be used with --hosts')
+
+    part = partition_nodes(sc, len(pl.hosts))
+    for vmname in pl.vms:
+        pl.vms[vmname]['host'] = part[vmname]
+
+    shim_hosts = collections.defaultdict(set)
+    for (shim, vm) in sc.links:
+        shim_hosts[shim].add(part[vm])
+
+    for shim in sorted(sc.shims):
+        hosts = sorted(shim_hosts[shim])
+        if len(hosts) < 2:
+            continue
+
+        tunnel = pl.tunnels[shim] = {'hosts': hosts, 'ifnames': dict()}
+        if args.tunnel == 'vxlan':
+            # Each host floods the domain traffic to all the other ones
+            ifname = pl.resources.ifname('rvx' + shim, 'rvx.')
+            for host in hosts:
+                tunnel['ifnames'][host] = ifname
+        else:
+            # GRETAP tunnels are point to point: the other hosts are
+            # connected to the first one, to avoid loops
+            for host in hosts[1:]:
+                tunnel['ifnames'][host] = pl.resources.ifname(
+                                    'rgt%s.%d' % (shim, host + 1), 'rgt.')
+
+
+###################### Place the nodes on CPUs #######################
+# Parse a CPU list like 0-3,8,10-11
+def parse_cpulist(cpulist):
+    cpus = []
+    for item in cpulist.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        bounds = item.split('-')
+        if len(bounds) > 2 or not all(b.isdigit() for b in bounds):
+            raise GenError('Invalid CPU list "%s"' % cpulist)
+        cpus.extend(range(int(bounds[0]), int(bounds[-1]) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in cpus:
+        if len(ranges) and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join([('%d' % a) if a == b else ('%d-%d' % (a, b))
+                     for (a, b) in ranges])
+
+
+# Return the CPUs of this machine, grouped by NUMA node, so that
+# consecutive CPUs are likely to share a NUMA node
+def host_cpu_list():
+    cpus = []
+    nodes = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(nodes, key = lambda p: int(re.findall(r'\d+', p)[-1])):
+        fin = open(path, 'r')
+        cpus.extend([cpu for cpu in parse_cpulist(fin.read())
+                     if cpu not in cpus])
+        fin.close()
+    if len(cpus) == 0:
+        cpus = list(range(multiprocessing.cpu_count()))
+    return cpus
+
+
+# Return the host CPUs available to the nodes of each host with --pin. The
+# CPUs of remote hosts cannot be found out here, so they must be specified.
+def host_cpu_lists(pl):
+    args = pl.args
+    nhosts = max(1, len(pl.hosts))
+
+    if args.host_cpus == None:
+        if len(pl.hosts):
+            raise GenError('--pin needs the CPUs of each host (see '
+                           '--host-cpus) with --hosts')
+        return [host_cpu_list()]
+
+    lists = args.host_cpus.split('/')
+    if len(lists) == 1:
+        lists = lists * nhosts
+    if len(lists) != nhosts:
+        raise GenError('%d CPU lists specified with --host-cpus for %d hosts'
+                       % (len(lists), nhosts))
+
+    cpu_lists = [parse_cpulist(cpulist) for cpulist in lists]
+    if not all(cpu_lists):
+        raise GenError('No host CPUs to pin the nodes to')
+    return cpu_lists
+
+
+# Set the number of vCPUs of each node, and with --pin the host CPUs each
+# node is pinned to. The nodes of each host are partitioned like the nodes
+# of a multi-host scenario (see partition_nodes()), with a part for each
+# CPU (or for each node, if there are more CPUs than nodes), so that the
+# nodes sharing L2 domains end up on the same CPUs. Each part gets a range
+# of consecutive CPUs, proportional to the vCPUs of its nodes, and
+# consecutive parts are close to each other in the topology.
+def compute_cpus(pl):
+    sc = pl.scenario
+    args = pl.args
+
+    for vmname in sorted(sc.vm_smp):
+        if vmname not in pl.vms:
+            print('Warning: ignoring line %d because VM %s does not exist'
+                  % (sc.vm_smp[vmname]['linecnt'], vmname))
+
+    for vmname in pl.vms:
+        vm = pl.vms[vmname]
+        vm['smp'] = args.smp
+        if vmname in sc.vm_smp:
+            vm['smp'] = sc.vm_smp[vmname]['smp']
+        vm['cpus'] = None
+
+    if not args.pin:
+        return
+
+    cpu_lists = host_cpu_lists(pl)
+    for host in range(max(1, len(pl.hosts))):
+        cpus = cpu_lists[host]
+        nodes = [vmname for vmname in pl.vms if pl.vms[vmname]['host'] == host]
+        if len(nodes) == 0:
+            continue
+
+        nparts = min(len(nodes), len(cpus))
+        part = partition_nodes(sc, nparts, nodes)
+        weights = [0] * nparts
+        for vmname in nodes:
+            weights[part[vmname]] += pl.vms[vmname]['smp']
+        total = sum(weights)
+
+        done = 0
+        for i in range(nparts):
+            start = min(done * len(cpus) // total, len(cpus) - 1)
+            done += weights[i]
+            end = max(done * len(cpus) // total, start + 1)
+            cpulist = format_cpulist(sorted(cpus[start:end]))
+            for vmname in nodes:
+                if part[vmname] == i:
+                    pl.vms[vmname]['cpus'] = cpulist
+
+
+###################### Template VMs for --clone ######################
+# MAC address of an interface of the template VMs. The third byte differs
+# from the one of the node MAC addresses (see Resources.mac()), and the
+# template interfaces are never connected, so the templates share them.
+def template_mac(nic):
+    return '00:0a:0b:00:00:%02x' % nic
+
+
+# With --clone, the nodes which would boot the same way (same kernel,
+# image, vCPUs, memory and interfaces) share a template VM, which is booted
+# once and whose state is saved to a file, restored by each node with its
+# own interfaces. The template name depends on all these, and on the
+# modification time of the images, so that a state file is reused across
+# runs until the nodes change.
+def compute_templates(pl):
+    args = pl.args
+
+    for vmname in pl.vms:
+        pl.vms[vmname]['template'] = None
+
+    if not args.clone:
+        return
+
+    if args.legacy:
+        raise GenError('--clone cannot be used with --legacy')
+    if args.initrd_overlay:
+        raise GenError('--clone cannot be used with --initrd-overlay')
+
+    for vmname in sorted(pl.vms):
+        vm = pl.vms[vmname]
+        kernel, image = vm_boot_files(pl, vmname)
+        shape = [kernel, image, vm['smp'], args.memory, args.frontend,
+                 len(vm['ports'])]
+        for path in [kernel, image]:
+            if os.path.exists(path):
+                shape.append(os.path.getmtime(path))
+        name = 'template.%s' % content_hash(json.dumps(shape))[:12]
+
+        if name not in pl.templates:
+            pl.templates[name] = {'name': name, 'kernel': kernel,
+                    'image': image, 'smp': vm['smp'], 'ssh': None,
+                    'mac': template_mac(99), 'pidfile': name + '.pid',
+                    'qmp': name + '.qmp', 'state': name + '.state',
+                    'ports': [{'idx': port['idx'], 'tap': None,
+                               'mac': template_mac(port['idx'] +
+                                                   (port['idx'] >= 99))}
+                              for port in vm['ports']]}
+        vm['template'] = name
+
+
+# With --direct-links, the L2 domains with two members (on the same host)
+# have no bridge: the frames received on the TAP interface of a member are
+# redirected to the TAP interface of the other one
+def compute_links(pl):
+    if not pl.args.direct_links:
+        return
+
+    members = collections.defaultdict(list)
+    for port in pl.ports:
+        members[port['vlan']].append(port)
+
+    for shim in sorted(members):
+        if len(members[shim]) != 2 or shim in pl.tunnels:
+            continue
+        pl.direct_links[shim] = members[shim]
+        del pl.bridges[shim]
+        for port in members[shim]:
+            port['br'] = None
+
+
+# Address used to reach the forwarded ports of a VM
+def vm_address(pl, vm):
+    if len(pl.hosts):
+        return pl.hosts[vm['host']]
+    return 'localhost'
+
+
+####################### Compute IPCP addresses #######################
+# An address allocator assigns the addresses of the members of a normal
+# DIF, given its DIFGraph. It returns the address and the region of each
+# member (regions may be None), and the address prefixes to be declared in
+# the DIF configuration (None to keep the ones of the template).
+def allocate_flat_addresses(pl, graph):
+    addresses = dict()
+    for vmname in graph:
+        addresses[vmname] = (16 + pl.vms[vmname]['id'], None)
+    return addresses, None
+
+
+# Partition the DIF graph into regions of about sqrt(N) neighboring nodes,
+# each one with its own address prefix: the address of a node is made of
+# the number of its region, followed by its index in the region.
+def allocate_hierarchical_addresses(pl, graph):
+    nodes = sorted(graph)
+    region_size = max(1, int(math.ceil(math.sqrt(len(nodes)))))
+    # Region numbers start from 1, so that all the addresses are above
+    # the ones reserved by the template address prefixes
+    host_bits = max(4, region_size.bit_length())
+
+    # Regions are seeded in breadth-first order from the first node, so
+    # that each region is grown around the previous ones. All the members
+    # of an N-1-DIF are visited the first time it is traversed.
+    order = [nodes[0]]
+    visited = set(order)
+    traversed = set()
+    for cur in order:
+        for (neigh, lower_dif) in graph.neighbors(cur, traversed):
+            if neigh not in visited:
+                visited.add(neigh)
+                order.append(neigh)
+    order += [vmname for vmname in nodes if vmname not in visited]
+
+    addresses = dict()
+    prefixes = []
+    region = 0
+    for seed in order:
+        if seed in addresses:
+            continue
+        region += 1
+        prefixes.append({'addressPrefix': region << host_bits,
+                         'organization': 'region-%d' % region})
+        members = [seed]
+        addresses[seed] = None
+        for cur in members:
+            for (neigh, lower_dif) in graph.neighbors(cur):
+                if len(members) == region_size:
+                    break
+                if neigh not in addresses:
+                    addresses[neigh] = None
+                    members.append(neigh)
+        for host in range(len(members)):
+            addresses[members[host]] = ((region << host_bits) | (host + 1),
+                                        region)
+
+    return addresses, prefixes
+
+
+address_allocators = {
+    'flat': allocate_flat_addresses,
+    'hierarchical': allocate_hierarchical_addresses,
+}
+
+
+def compute_addresses(pl):
+    sc = pl.scenario
+    address_length = gen_templates.normal_dif_base['dataTransferConstants']\
+                                                  ['addressLength']
+
+    for dif in sorted(sc.dif_addressing):
+        if dif not in sc.difs:
+            print('Warning: ignoring line %d because DIF %s does not exist'
+                  % (sc.dif_addressing[dif]['linecnt'], dif))
+
+    for dif in pl.dif_ordering:
+        if dif in sc.shims:
+            continue
+
+        scheme = pl.args.addressing
+        if dif in sc.dif_addressing:
+            scheme = sc.dif_addressing[dif]['scheme']
+
+        addresses, prefixes = address_allocators[scheme](pl, pl.dif_graphs[dif])
+
+        highest = max([address for (address, region) in addresses.values()])
+        if highest >= 1 << (8 * address_length):
+            raise GenError('The %s addresses of DIF %s do not fit in %d bytes '
+                           '(the highest one is %d)' % (scheme, dif,
+                                                        address_length,
+                                                        highest))
+
+        pl.addressing[dif] = {'scheme': scheme, 'addresses': addresses,
+                              'prefixes': prefixes}
+
+
+################## Compute IPCM/DIF configurations ##################
+# Return the name of the normal DIF configuration file shared by the
+# members of a DIF to which the given policies apply. The nodes only
+# affected by the policies that apply to all the members of the DIF use
+# normal.DIF.dif, the others a file named after their node-scoped policies.
+def normal_template_name(dif, policies):
+    scoped = [[policy['path'], policy['ps'], policy['parms']]
+              for policy in policies if policy['nodes'] != []]
+    if len(scoped) == 0:
+        return 'normal.%s.dif' % (dif,)
+
+    signature = json.dumps(scoped, sort_keys = True)
+    return 'normal.%s.%s.dif' % (dif, content_hash(signature)[:8])
+
+
+def compute_confs(pl):
+    sc = pl.scenario
+    difs = sc.difs
+    vms = pl.vms
+    args = pl.args
+
+    # Work on private copies of the templates, so that the same process
+    # can compile more scenarios. The IPCM and DIF configurations of the
+    # nodes share with the templates all the parts they don't modify.
+    pl.da_map = copy.deepcopy(gen_templates.da_map_base)
+    ipcmconf_base = dict(gen_templates.ipcmconf_base)
+
+    # If some app directives were specified, use those to build da.map.
+    # Otherwise, assume the standard applications are to be mapped in
+    # the DIF with the highest rank.
+    if len(sc.app_mappings) == 0:
+        if len(pl.dif_ordering) > 0:
+            for adm in pl.da_map["applicationToDIFMappings"]:
+                adm["difName"] = "%s" % (pl.dif_ordering[-1],)
     else:
-        # This is a bug
-        assert(False)
+        pl.da_map["applicationToDIFMappings"] = []
+        for apm in sc.app_mappings:
+            pl.da_map["applicationToDIFMappings"].append({
+                                                "encodedAppName": apm['name'],
+                                                "difName": "%s" % (apm['dif'])
+                                            })
 
-    #print(neighsets)
-    #print(dif_graphs[dif])
+    if args.manager:
+        # Add MAD/Manager configuration
+        ipcmconf_base["addons"] = {
+                        "mad": {
+                                "managerConnections" : [ {
+                                            "managerAppName" : "manager-1--",
+                                            "DIF": "%s" % (mgmt_dif_name)
+                                        }
+                                    ]
+                        }
+                    }
 
-for shim in shims:
-    enrollments[shim] = dict()
+    for vmname in vms:
+        ipcmconf = pl.ipcmconfs[vmname] = dict(ipcmconf_base)
+        ipcmconf["ipcProcessesToCreate"] = []
+        ipcmconf["difConfigurations"] = []
 
+    for dif in difs:
+        pl.difconfs[dif] = dict()
 
-###################### Generate UP script ########################
-fout = open('up.sh', 'w')
-
-outs =  '#!/bin/bash\n'             \
-        '\n'                        \
-        'set -x\n'                  \
-        '\n';
-
-for shim in sorted(shims):
-    outs += 'sudo brctl addbr %(br)s\n'         \
-            'sudo ip link set %(br)s up\n'      \
-            '\n' % {'br': shims[shim]['bridge']}
-
-for l in sorted(links):
-    shim, vm = l
-    b = shims[shim]['bridge']
-    idx = len(vms[vm]['ports']) + 1
-    tap = '%s.%02x' % (vm, idx)
-
-    outs += 'sudo ip tuntap add mode tap name %(tap)s\n'    \
-            'sudo ip link set %(tap)s up\n'                 \
-            'sudo brctl addif %(br)s %(tap)s\n\n'           \
-                % {'tap': tap, 'br': b}
-
-    if shims[shim]['speed'] > 0:
-        speed = '%d%sbit' % (shims[shim]['speed'], shims[shim]['speed_unit'])
-
-        # Rate limit the traffic transmitted on the TAP interface
-        outs += 'sudo tc qdisc add dev %(tap)s handle 1: root '     \
-                                'htb default 11\n'                  \
-                'sudo tc class add dev %(tap)s parent 1: classid '  \
-                                '1:1 htb rate 10gbit\n'             \
-                'sudo tc class add dev %(tap)s parent 1:1 classid ' \
-                                '1:11 htb rate %(speed)s\n'         \
-                % {'tap': tap, 'speed': speed}
-
-    if shim in netems:
-        if vm in netems[shim]:
-            if not netem_validate(netems[shim][vm]['args']):
-                print('Warning: line %(linecnt)s is invalid and '\
-                      'will be ignored' % netems[shim][vm])
+    for vmname in sorted(vms):
+        vm = vms[vmname]
+        ipcmconf = pl.ipcmconfs[vmname]
+
+        for port in vm['ports']:
+            ipcmconf["ipcProcessesToCreate"].append({
+                                    "difName": port['vlan']
+                                    })
+
+            template_file_name = 'shimeth.%s.%s.dif' % (vm['name'], port['vlan'])
+            ipcmconf["difConfigurations"].append({
+                                    "name": port['vlan'],
+                                    "template": template_file_name
+                                    })
+
+    # Run over dif_ordering array, to make sure each IPCM config has
+    # the correct ordering for the ipcProcessesToCreate list of operations.
+    # If we iterated over the difs map, the order would be randomic, and so
+    # some IPCP registrations in lower DIFs may fail. This would happen because
+    # at the moment of registration, it may be that the IPCP of the lower DIF
+    # has not been created yet.
+    for dif in pl.dif_ordering:
+
+        if dif in sc.shims:
+            # Shims are managed separately, in the previous loop
+            continue
+
+        # The map of IPCP addresses is the same for all the members of the
+        # DIF, so it is built once and shared by all the DIF configurations
+        known_addresses = pl.dif_addresses[dif] = []
+        addresses = pl.addressing[dif]['addresses']
+        for vmname in difs[dif]:
+            known_addresses.append({
+                                    "apName":  "%s.%s" % (vmname, dif),
+                                    "apInstance": "1",
+                                    "address": addresses[vmname][0]
+                                })
+
+        dif_base = dict(gen_templates.normal_dif_base)
+        dif_base["knownIPCProcessAddresses"] = known_addresses
+        if pl.addressing[dif]['prefixes'] != None:
+            dif_base["addressPrefixes"] = pl.addressing[dif]['prefixes']
+
+        templates = pl.dif_templates[dif] = dict()
+
+        for vmname in difs[dif]:
+            vm = vms[vmname]
+            ipcmconf = pl.ipcmconfs[vmname]
+
+            normal_ipcp = { "difName": "%s" % (dif,) }
+
+            normal_ipcp["difsToRegisterAt"] = []
+            for lower_dif in difs[dif][vmname]:
+                normal_ipcp["difsToRegisterAt"].append(lower_dif)
+
+            ipcmconf["ipcProcessesToCreate"].append(normal_ipcp)
+
+            # Nodes to which the same policies apply share the same DIF
+            # configuration, so that the policies are translated (and the
+            # configuration written) only once for each of these groups
+            policies = [policy for policy in sc.dif_policies[dif]
+                        if policy['nodes'] == [] or vmname in policy['nodes']]
+            template = normal_template_name(dif, policies)
+            templates[vmname] = template
+
+            ipcmconf["difConfigurations"].append({
+                                    "name": "%s" % (dif),
+                                    "template": template
+                                    })
+
+            if template in pl.difconfs[dif]:
                 continue
-            outs += 'sudo tc qdisc add dev %(tap)s root netem '\
-                    '%(args)s\n'\
-                    % {'tap': tap, 'args': netems[shim][vm]['args']}
 
-    vms[vm]['ports'].append({'tap': tap, 'br': b, 'idx': idx,
-                             'vlan': shim})
+            # Nodes without policies share the whole configuration
+            difconf = gen_templates.CowConf(dif_base)
+            for policy in policies:
+                gen_templates.translate_policy(difconf, policy['path'],
+                                               policy['ps'], policy['parms'])
+            pl.difconfs[dif][template] = difconf.data
+
+
+# Content hash of a directory tree (paths, modes and contents)
+def tree_digest(path):
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            fpath = os.path.join(root, name)
+            st = os.lstat(fpath)
+            h.update(('%s %o\n' % (os.path.relpath(fpath, path),
+                                   st.st_mode)).encode('utf-8'))
+            if os.path.islink(fpath):
+                h.update(os.readlink(fpath).encode('utf-8'))
+            elif os.path.isfile(fpath):
+                fin = open(fpath, 'rb')
+                for block in iter(lambda: fin.read(1 << 16), b''):
+                    h.update(block)
+                fin.close()
+    return h.hexdigest()
+
+
+# Compute the content of the bundle shipped to each node: the node
+# configuration files (to be extracted in /etc), the helper programs (in
+# /usr/bin) and the per-node overlay. The global overlay is shipped as a
+# separate archive, named after its content, which is shared by all nodes.
+def compute_bundles(pl):
+    sc = pl.scenario
+    args = pl.args
+
+    for vmname in pl.vms:
+        vm = pl.vms[vmname]
+        vm_difs = vm_normal_difs(pl, vmname)
+
+        confs = ['shimeth.%s.%s.dif' % (vmname, port['vlan'])
+                 for port in vm['ports']]
+        confs += ['da.map', '%s.ipcm.conf' % vmname]
+        confs += sorted(set([pl.dif_templates[dif][vmname]
+                             for dif in vm_difs]))
+
+        bins = ['enroll.py', 'ipcm_console.py']
+        if args.legacy:
+            bins.append('mac2ifname')
+
+        if args.shared_addresses and len(vm_difs):
+            confs += ['addresses.%s.json' % dif for dif in vm_difs]
+            bins.append('mergeaddrs.py')
+
+        pl.bundles[vmname] = {'confs': confs, 'bins': bins,
+                              'overlay': sc.overlays.get(vmname)}
+
+    if args.overlay:
+        pl.overlay_archive = 'overlay.%s.tar.gz' % tree_digest(args.overlay)[:16]
+
+
+# With --initrd-overlay, each node boots from its base image followed by an
+# initramfs archive with the node bundle and an init hook which configures
+# the node, so that nothing needs to be copied to the nodes once they boot
+def compute_initrds(pl):
+    args = pl.args
+
+    if not args.initrd_overlay:
+        return
+
+    if args.legacy:
+        raise GenError('--initrd-overlay needs the buildroot images, it '
+                       'cannot be used with --legacy')
+
+    for vmname in pl.vms:
+        base = pl.env_dict['vmimgpath']
+        if vmname == mgmt_node_name:
+            base = args.manager_initramfs
+        pl.initrds[vmname] = {'base': base,
+                              'overlay': 'initrd.%s.cpio' % vmname,
+                              'image': '%s.initrd' % vmname}
+
+
+def plan(sc, args, env_dict):
+    """Compute the deployment plan for a parsed Scenario"""
+    pl = Plan(sc, args, env_dict)
+    pl.dif_ordering = compute_dif_ordering(sc)
+    compute_enrollments(pl)
+    compute_enrollment_dag(pl)
+    compute_ports(pl)
+    compute_hosts(pl)
+    compute_links(pl)
+    compute_cpus(pl)
+    compute_templates(pl)
+    compute_addresses(pl)
+    compute_confs(pl)
+    compute_bundles(pl)
+    compute_initrds(pl)
+
+    return pl
 
 
-vmid = 1
-budget = boot_batch_size
+###################### Generate UP script ########################
+# The scripts for a host (with --hosts) only deal with the nodes of that
+# host, and with the L2 domains they belong to. The scripts for host None
+# deal with all of them.
+def host_vms(pl, host):
+    return [vmname for vmname in sorted(pl.vms)
+            if host == None or pl.vms[vmname]['host'] == host]
+
+
+def host_shims(pl, host):
+    shims = set([port['vlan'] for port in pl.ports
+                 if host == None or pl.vms[port['vm']]['host'] == host])
+    return sorted(shims)
+
+
+# Return the (tunnel interface, remote host address) pairs of the tunnels
+# of an L2 domain on a host. A VXLAN interface reaches all the other
+# hosts, so its remote address is None.
+def host_tunnels(pl, shim, host):
+    tunnel = pl.tunnels.get(shim)
+    if host == None or tunnel == None:
+        return []
+
+    if pl.args.tunnel == 'vxlan':
+        return [(tunnel['ifnames'][host], None)]
+
+    hub = tunnel['hosts'][0]
+    if host != hub:
+        return [(tunnel['ifnames'][host], pl.hosts[hub])]
+    return [(tunnel['ifnames'][spoke], pl.hosts[spoke])
+            for spoke in tunnel['hosts'][1:]]
+
+
+# Return where the configuration of an L2 domain (or of the netem
+# emulation of a node on it) comes from, to map the commands that set up
+# the host network back to the scenario
+def shim_origin(pl, shim, vmname = None):
+    sc = pl.scenario
+    if vmname == None:
+        linecnt = sc.shims[shim]['linecnt']
+        what = 'eth %s' % shim
+    else:
+        linecnt = sc.netems[shim][vmname]['linecnt']
+        what = 'netem %s %s' % (shim, vmname)
+
+    if linecnt > sc.conf_lines:
+        return 'generated by --manager (%s)' % what
+
+    return '%s:%d (%s)' % (pl.args.conf, linecnt, what)
+
+
+def tunnel_commands(pl, shim, host):
+    vars_dict = {'local': pl.hosts[host] if host != None else None,
+                 'br': pl.bridges[shim], 'key': shim}
+
+    for (ifname, remote) in host_tunnels(pl, shim, host):
+        vars_dict['tun'] = ifname
+        if remote == None:
+            # The domain traffic is flooded to the other hosts
+            yield ('ip', 'link add %(tun)s type vxlan id %(key)s '
+                         'local %(local)s dstport 4789' % vars_dict)
+            for other in pl.tunnels[shim]['hosts']:
+                if other != host:
+                    yield ('bridge', 'fdb append 00:00:00:00:00:00 '
+                                     'dev %(tun)s dst %(remote)s'
+                                     % {'tun': ifname,
+                                        'remote': pl.hosts[other]})
+        else:
+            vars_dict['remote'] = remote
+            yield ('ip', 'link add %(tun)s type gretap local %(local)s '
+                         'remote %(remote)s key %(key)s' % vars_dict)
+        yield ('ip', 'link set %(tun)s up' % vars_dict)
+        yield ('ip', 'link set %(tun)s master %(br)s' % vars_dict)
 
-for vmname in sorted(vms):
-    vm = vms[vmname]
 
-    vm['id'] = vmid
+# Cross-connect the TAP interfaces of the two members of an L2 domain: the
+# frames sent by a node go through the egress qdiscs (rate limiting and
+# netem) of the TAP interface of the other node, as with a bridge
+def direct_link_commands(pl, shim):
+    cmds = []
+    a, b = pl.direct_links[shim]
 
-    fwdp = env_dict['baseport'] + vmid
-    mac = '00:0a:0a:0a:%02x:%02x' % (vmid, 99)
+    for (src, dst) in [(a, b), (b, a)]:
+        cmds.append('qdisc add dev %(src)s handle ffff: ingress'
+                        % {'src': src['tap']})
+        cmds.append('filter add dev %(src)s parent ffff: protocol all '
+                    'u32 match u32 0 0 action mirred egress redirect '
+                    'dev %(dst)s' % {'src': src['tap'], 'dst': dst['tap']})
 
-    vm['ssh'] = fwdp
+    return cmds
 
-    vars_dict = {'fwdp': fwdp, 'id': vmid, 'mac': mac,
-                 'vmimgpath': env_dict['vmimgpath'],
-                 'memory': args.memory, 'kernel': args.kernel,
-                 'frontend': args.frontend, 'vmname': vmname}
 
+# Return the commands that set up the host network, as (tool, command,
+# origin) tuples, where tool is 'ip', 'tc' or 'bridge'
+def up_network_commands(pl, host = None):
+    shims = pl.scenario.shims
+
+    for shim in host_shims(pl, host):
+        if shim in pl.direct_links:
+            continue
+        origin = shim_origin(pl, shim)
+        yield ('ip', 'link add %s type bridge' % pl.bridges[shim], origin)
+        yield ('ip', 'link set %s up' % pl.bridges[shim], origin)
+        for (tool, cmd) in tunnel_commands(pl, shim, host):
+            yield (tool, cmd, origin)
+
+    for port in pl.ports:
+        if host != None and pl.vms[port['vm']]['host'] != host:
+            continue
+        shim = port['vlan']
+        tap = port['tap']
+        origin = shim_origin(pl, shim)
+
+        yield ('ip', 'tuntap add mode tap name %s' % tap, origin)
+        yield ('ip', 'link set %s up' % tap, origin)
+        if port['br'] != None:
+            yield ('ip', 'link set %s master %s' % (tap, port['br']), origin)
+
+        if shims[shim]['speed'] > 0:
+            speed = '%d%sbit' % (shims[shim]['speed'], shims[shim]['speed_unit'])
+
+            # Rate limit the traffic transmitted on the TAP interface
+            yield ('tc', 'qdisc add dev %s handle 1: root htb default 11'
+                             % tap, origin)
+            yield ('tc', 'class add dev %s parent 1: classid 1:1 '
+                             'htb rate 10gbit' % tap, origin)
+            yield ('tc', 'class add dev %s parent 1:1 classid 1:11 '
+                             'htb rate %s' % (tap, speed), origin)
+
+        if port['netem'] != None:
+            yield ('tc', 'qdisc add dev %s root netem %s'
+                             % (tap, port['netem']),
+                   shim_origin(pl, shim, port['vm']))
+
+    for shim in host_shims(pl, host):
+        if shim in pl.direct_links:
+            for cmd in direct_link_commands(pl, shim):
+                yield ('tc', cmd, shim_origin(pl, shim))
+
+
+def down_network_commands(pl, host = None):
+    for vmname in host_vms(pl, host):
+        for port in pl.vms[vmname]['ports']:
+            origin = shim_origin(pl, port['vlan'])
+
+            # The qdiscs and the redirections of a TAP interface are
+            # removed together with it, which also leaves its bridge
+            yield ('ip', 'link set %s down' % port['tap'], origin)
+            yield ('ip', 'tuntap del mode tap name %s' % port['tap'], origin)
+
+    for shim in host_shims(pl, host):
+        if shim in pl.direct_links:
+            continue
+        origin = shim_origin(pl, shim)
+        for (ifname, remote) in host_tunnels(pl, shim, host):
+            yield ('ip', 'link del %s' % ifname, origin)
+        yield ('ip', 'link set %s down' % pl.bridges[shim], origin)
+        yield ('ip', 'link del %s' % pl.bridges[shim], origin)
+
+
+def batch_name(script, host, tool):
+    if host == None:
+        return '%s.%s.batch' % (script, tool)
+
+    return '%s.host%d.%s.batch' % (script, host + 1, tool)
+
+
+# An ip or tc batch file, with the origin of each command in a comment
+def batch_chunks(commands, tool):
+    for (t, cmd, origin) in commands:
+        if t == tool:
+            yield '%s # %s\n' % (cmd, origin)
+
+
+# Apply a batch file with a single privileged invocation of ip or tc,
+# going on after the failed commands, and show the scenario line each
+# failed command comes from
+run_batch_function = ''\
+        'run_batch() {\n'\
+        '   sudo $1 -force -batch $2 2>&1 | while read -r LINE; do\n'\
+        '       echo "$LINE"\n'\
+        '       case "$LINE" in\n'\
+        '       "Command failed $2:"*)\n'\
+        '           echo "    from $(sed -n "${LINE##*:}s/.* # //p" $2)"\n'\
+        '       esac\n'\
+        '   done\n'\
+        '   return ${PIPESTATUS[0]}\n'\
+        '}\n\n'
+
+
+def up_network_chunks(pl, host = None):
+    yield run_batch_function
+    yield 'run_batch ip %s\n' % batch_name('up', host, 'ip')
+
+    # The forwarding entries of the VXLAN tunnels
+    for (tool, cmd, origin) in up_network_commands(pl, host):
+        if tool == 'bridge':
+            yield 'sudo bridge %s\n' % cmd
+
+    yield 'run_batch tc %s\n' % batch_name('up', host, 'tc')
+    yield '\n'
+
+    if pl.args.cgroups:
+        yield emit_slice(pl)
+
+
+
+# Return the kernel and the image (initramfs, or disk for legacy VMs)
+# booted by a node
+def vm_boot_files(pl, vmname):
+    args = pl.args
+
+    kernel = args.kernel
+    image = pl.env_dict['vmimgpath']
     if vmname == mgmt_node_name:
-        vars_dict['vmimgpath'] = args.manager_initramfs
-        vars_dict['kernel'] = args.manager_kernel
+        kernel, image = args.manager_kernel, args.manager_initramfs
+    # The image of a node with an initramfs overlay starts with the same
+    # base image (see compute_initrds())
+    if vmname in pl.initrds:
+        image = pl.initrds[vmname]['image']
+    return kernel, image
+
 
-    outs += 'qemu-system-x86_64 '
+# The QEMU command line of a node, or of a template VM. The interfaces of a
+# template VM are not connected to anything.
+def qemu_command(pl, vm, kernel, image):
+    args = pl.args
+
+    vars_dict = {'pidfile': vm['pidfile'], 'mac': vm['mac'],
+                 'vmimgpath': image, 'memory': args.memory, 'kernel': kernel,
+                 'frontend': args.frontend, 'vmname': vm['name'],
+                 'smp': vm['smp'], 'mgmt': 'user,id=mgmt'}
+
+    if vm['ssh'] != None:
+        vars_dict['mgmt'] += ',hostfwd=tcp::%d-:22' % vm['ssh']
+
+    outs = 'qemu-system-x86_64 '
     if not args.legacy:
-        outs += '-kernel %(kernel)s '                                   \
-                '-append "console=ttyS0" '                              \
-                '-initrd %(vmimgpath)s '                                \
+        outs += '-kernel %(kernel)s '                                     \
+                '-append "console=ttyS0" '                                \
+                '-initrd %(vmimgpath)s '                                  \
                         % vars_dict
     else:
-        outs += '"%(vmimgpath)s" '                                      \
+        outs += '"%(vmimgpath)s" '                                        \
                 '-snapshot ' % vars_dict
 
-    outs += '-display none '                                            \
-            '--enable-kvm '                                             \
-            '-smp 2 '                                                   \
-            '-m %(memory)sM '                                           \
-            '-device %(frontend)s,mac=%(mac)s,netdev=mgmt '             \
-            '-netdev user,id=mgmt,hostfwd=tcp::%(fwdp)s-:22 '           \
-            '-vga std '                                                 \
-            '-pidfile rina-%(id)s.pid '                                 \
-            '-serial file:%(vmname)s.log '                              \
+    outs += '-display none '                                              \
+            '--enable-kvm '                                               \
+            '-smp %(smp)d '                                               \
+            '-m %(memory)sM '                                             \
+            '-device %(frontend)s,mac=%(mac)s,netdev=mgmt '               \
+            '-netdev %(mgmt)s '                                           \
+            '-vga std '                                                   \
+            '-pidfile %(pidfile)s '                                       \
+            '-chardev socket,id=serial0,path=%(vmname)s.serial,'          \
+                    'server=on,wait=off,logfile=%(vmname)s.log '          \
+            '-serial chardev:serial0 '                                    \
                                 % vars_dict
 
-    del vars_dict
-
     for port in vm['ports']:
-        tap = port['tap']
-        mac = '00:0a:0a:0a:%02x:%02x' % (vmid, port['idx'])
-        port['mac'] = mac
-
-        outs += ''                                                      \
+        outs += ''                                                          \
         '-device %(frontend)s,mac=%(mac)s,netdev=data%(idx)s '                 \
+            % {'mac': port['mac'], 'idx': port['idx'],
+               'frontend': args.frontend}
+        if port['tap'] == None:
+            outs += '-netdev user,id=data%(idx)s,restrict=on '\
+                        % {'idx': port['idx']}
+            continue
+        outs += ''                                                          \
         '-netdev tap,ifname=%(tap)s,id=data%(idx)s,script=no,downscript=no'\
         '%(vhost)s '\
-            % {'mac': mac, 'tap': tap, 'idx': port['idx'],
-               'frontend': args.frontend,
+            % {'tap': port['tap'], 'idx': port['idx'],
                'vhost': ',vhost=on' if args.vhost else ''}
 
-    outs += '&\n\n'
-
-    budget -= 1
-    if budget <= 0:
-        outs += 'sleep %s\n' % wait_for_boot
-        budget = boot_batch_size
+    return outs
 
-    vmid += 1
 
+def emit_qemu(pl, vmname):
+    vm = pl.vms[vmname]
+    args = pl.args
 
-for vmname in sorted(vms):
-    vm = vms[vmname]
+    kernel, image = vm_boot_files(pl, vmname)
+    outs = qemu_command(pl, vm, kernel, image)
 
-    gen_files_conf = 'shimeth.%(name)s.*.dif da.map %(name)s.ipcm.conf' % {'name': vmname}
-    if any(vmname in difs[difname] for difname in difs):
-        gen_files_conf = joincat(gen_files_conf, 'normal.%(name)s.*.dif' % {'name': vmname})
-    gen_files_bin = 'enroll.py'
-    overlay = ''
-    per_vm_overlay = ''
+    # With --clone, the node is restored from the state of its template
+    if vm['template'] != None:
+        outs += '-incoming "exec:cat %s" ' \
+                    % pl.templates[vm['template']]['state']
+
+    # QEMU is started in a subshell which moves itself to the cgroup of the
+    # node. The affinity and the cgroup are inherited by all the QEMU
+    # threads, and by the vhost workers.
+    if vm['cpus'] != None:
+        outs = 'taskset -c %s %s' % (vm['cpus'], outs)
+
+    if args.cgroups:
+        outs = emit_cgroup(pl, vmname) +\
+               '(PID=$BASHPID; '\
+               'echo $PID | sudo tee %(cgroup)s/cgroup.procs > /dev/null; '\
+               'exec %(qemu)s) ' % {'cgroup': vm_cgroup(pl, vmname),
+                                    'qemu': outs}
+
+    # The serial console log of a previous run would tell the probes that
+    # the node has already booted
+    return 'rm -f %s.log\n' % vmname + outs
+
+
+def slice_cgroup(pl):
+    return '%s/%s' % (pl.cgroup_root, pl.cgroup_slice)
+
+
+def vm_cgroup(pl, vmname):
+    return '%s/%s' % (slice_cgroup(pl), vmname)
+
+
+# Create the cgroup slice of the nodes, delegating to it the controllers
+# used to limit them
+def emit_slice(pl):
+    controllers = '+cpu +memory'
+    if pl.args.pin:
+        controllers += ' +cpuset'
+    return 'sudo mkdir -p %(slice)s\n'\
+           'echo "%(controllers)s" | sudo tee %(root)s/cgroup.subtree_control '\
+                    '%(slice)s/cgroup.subtree_control > /dev/null\n\n'\
+                    % {'slice': slice_cgroup(pl), 'root': pl.cgroup_root,
+                       'controllers': controllers}
+
+
+# Create the cgroup of a node, with the limits of the node
+def emit_cgroup(pl, vmname):
+    vm = pl.vms[vmname]
+    limits = [('cpu.max', '%d %d' % (vm['smp'] * pl.cgroup_period *
+                                     pl.args.cpu_max // 100,
+                                     pl.cgroup_period)),
+              ('memory.max', '%dM' % (pl.args.memory +
+                                      pl.qemu_memory_overhead))]
+    if vm['cpus'] != None:
+        limits.append(('cpuset.cpus', vm['cpus']))
+
+    outs = 'sudo mkdir -p %s\n' % vm_cgroup(pl, vmname)
+    for (name, value) in limits:
+        outs += 'echo "%(value)s" | sudo tee %(cgroup)s/%(name)s > /dev/null\n'\
+                    % {'value': value, 'name': name,
+                       'cgroup': vm_cgroup(pl, vmname)}
+    return outs
+
+
+# Wait for the SSH server of a VM to be reachable
+def emit_ssh_probe(pl, vm):
+    host = ''
+    if len(pl.hosts):
+        host = '--host %s ' % vm_address(pl, vm)
+    return './probe.py ssh %(ssh)d %(host)s--timeout %(timeout)d || exit 1\n'\
+                % {'ssh': vm['ssh'], 'host': host, 'timeout': pl.ssh_timeout}
+
+
+# Wait for a VM to boot, looking for the boot marker on its serial console.
+# The console of legacy images is not redirected to the serial port.
+def emit_boot_probe(pl, vmname):
+    if pl.args.legacy or pl.vms[vmname]['template'] != None:
+        return emit_ssh_probe(pl, pl.vms[vmname])
+
+    return emit_serial_probe(pl, vmname)
+
+
+# A node restored from a template does not print the boot marker again
+def emit_serial_probe(pl, vmname):
+    return './probe.py serial %(vmname)s.serial %(vmname)s.log '\
+                '--marker "%(marker)s" --timeout %(timeout)d || exit 1\n'\
+                % {'vmname': vmname, 'marker': pl.boot_marker,
+                   'timeout': pl.boot_timeout}
+
+
+# How probe.py tells whether a VM is still booting
+def boot_spec(pl, vmname):
+    if pl.args.legacy or pl.vms[vmname]['template'] != None:
+        return '%d' % pl.vms[vmname]['ssh']
+    return '%s.log' % vmname
+
+
+# Wait until the host can afford to boot a VM, according to its load and
+# the VMs still booting, which are listed in the 'booting' arguments
+def emit_boot_admission(pl, vmname, booting):
+    return './probe.py admit %(vmname)s %(booting)s --marker "%(marker)s" '\
+                '--ceiling %(ceiling)d --max-load %(load).2f '\
+                '--max-cpu-pressure %(cpu).1f --max-memory-pressure %(mem).1f '\
+                '--min-memory %(memory)s --timeout %(timeout)d '\
+                '--record boot-admission.log'\
+                % {'vmname': vmname, 'booting': booting,
+                   'marker': pl.boot_marker, 'ceiling': pl.boot_ceiling,
+                   'load': pl.boot_max_load, 'cpu': pl.boot_max_cpu_pressure,
+                   'mem': pl.boot_max_memory_pressure,
+                   'memory': pl.args.memory,
+                   'timeout': pl.boot_admission_timeout}
+
+
+# Boot the template VMs of the nodes of a host (all at once), and save
+# their state, unless already saved by a previous run
+def template_chunks(pl, host = None):
+    templates = sorted(set([pl.vms[vmname]['template']
+                            for vmname in host_vms(pl, host)
+                            if pl.vms[vmname]['template'] != None]))
+
+    for name in templates:
+        template = pl.templates[name]
+        yield 'if [ ! -f %(state)s ]; then\n'\
+              '    rm -f %(name)s.log\n'\
+              '    %(qemu)s-qmp unix:%(qmp)s,server=on,wait=off &\n'\
+              'fi\n' % {'state': template['state'], 'qmp': template['qmp'],
+                        'name': name,
+                        'qemu': qemu_command(pl, template, template['kernel'],
+                                             template['image'])}
+
+    for name in templates:
+        template = pl.templates[name]
+        yield 'if [ ! -f %(state)s ]; then\n'\
+              '    %(probe)s'\
+              '    ./probe.py snapshot %(qmp)s %(state)s --timeout %(timeout)d '\
+                            '|| exit 1\n'\
+              'fi\n\n' % {'state': template['state'], 'qmp': template['qmp'],
+                          'probe': emit_serial_probe(pl, name),
+                          'timeout': pl.ssh_timeout}
+
+
+def up_vms_chunks(pl, host = None):
+    for chunk in template_chunks(pl, host):
+        yield chunk
+
+    yield 'BOOTING=""\n\n'
+
+    for vmname in host_vms(pl, host):
+        yield 'BOOTING=$(%s) || exit 1\n' % emit_boot_admission(pl, vmname,
+                                                                 '$BOOTING')
+        yield emit_qemu(pl, vmname)
+        yield '&\n'
+        yield 'BOOTING="$BOOTING %s"\n\n' % boot_spec(pl, vmname)
+
+
+# Return the normal DIFs a node belongs to
+def vm_normal_difs(pl, vmname):
+    sc = pl.scenario
+    return sorted([difname for difname in sc.difs if vmname in sc.difs[difname]])
+
+
+# Stream an archive to a node, extracting it into the root directory
+def emit_archive_push(pl, vm, archive):
+    return emit_retry(pl, 'ssh %(sshopts)s -p %(ssh)s %(username)s@%(host)s '\
+                            '"%(tar)s" < %(archive)s\n'\
+                            % {'ssh': vm['ssh'], 'archive': archive,
+                               'host': vm_address(pl, vm),
+                               'username': pl.env_dict['username'],
+                               'sshopts': vm_sshopts(pl, vm),
+                               'tar': ' '.join([pl.sudo, 'tar -xzf - -C /'])
+                                                .strip()},
+                      'Copying %s to %s' % (archive, vm['name']))
+
+
+# SSH options for the connections to a VM, which share the master
+# connection to the VM, if any
+def vm_sshopts(pl, vm):
+    return ' '.join([opt for opt in [pl.sshopts,
+                                     '-o ControlPath=%s.ssh' % vm['name']]
+                     if opt != ''])
+
+
+# Run a command (possibly with a here document) until it succeeds, at most
+# ssh_retries times, backing off exponentially between the attempts
+def emit_retry(pl, command, what):
+    return  'DELAY=1\n'\
+            'for TRY in $(seq %d); do\n' % pl.ssh_retries +\
+            '   ' + command +\
+            '   DONE=$?\n'\
+            '   if [ $DONE == "0" ]; then\n'\
+            '       break\n'\
+            '   fi\n'\
+            '   sleep $DELAY\n'\
+            '   DELAY=$((DELAY * 2))\n'\
+            'done\n'\
+            'if [ $DONE != "0" ]; then\n'\
+            '   echo "%(what)s failed after %(retries)d attempts"\n'\
+            '   exit 1\n'\
+            'fi\n' % {'retries': pl.ssh_retries, 'what': what}
+
+
+# Open the master connection to a VM, unless it is already open. All the
+# later connections to the VM are multiplexed over it, until down.sh
+# closes it.
+def emit_ssh_master(pl, vm):
+    vars_dict = {'ssh': vm['ssh'], 'username': pl.env_dict['username'],
+                 'sshopts': vm_sshopts(pl, vm), 'host': vm_address(pl, vm)}
+
+    return  'if ! ssh %(sshopts)s -O check -p %(ssh)s %(username)s@%(host)s '\
+                    '2> /dev/null; then\n' % vars_dict +\
+            emit_retry(pl, 'ssh %(sshopts)s -o ControlMaster=yes '\
+                                '-o ControlPersist=yes -f -N '\
+                                '-p %(ssh)s %(username)s@%(host)s\n'\
+                                % vars_dict,
+                       'Connecting to %s' % vm['name']) +\
+            'fi\n'
+
+
+def emit_merge_addresses(pl, vm, vm_difs):
+    if pl.args.shared_addresses and len(vm_difs):
+        return '$SUDO mergeaddrs.py %s\n' % ' '.join(sorted(set(
+                    ['/etc/' + pl.dif_templates[dif][vm['name']]
+                     for dif in vm_difs])))
+    return ''
+
+
+# The interfaces of a node restored from a template still have the MAC
+# addresses of the template ones: give them the node MAC addresses
+def emit_clone_macs(pl, vm):
+    if vm['template'] == None:
+        return ''
+
+    outs = ''
+    template = pl.templates[vm['template']]
+    for (port, tport) in zip(vm['ports'], template['ports']):
+        outs += '$SUDO ip link set $(mac2ifname %(tmac)s) address %(mac)s\n'\
+                    % {'tmac': tport['mac'], 'mac': port['mac']}
+    return outs
+
+
+# Replace the interface placeholders in the shim DIF templates with the
+# actual names of the node interfaces, possibly creating the VLAN
+# interfaces on top of them
+def emit_port_setup(vm, create_vlans):
+    outs = ''
 
-    if args.legacy:
-        gen_files_bin = joincat(gen_files_bin, 'mac2ifname')
+    for port in vm['ports']:
+        outs += 'PORT=$(mac2ifname %(mac)s)\n' % {'mac': port['mac']}
+        if create_vlans:
+            # The VLAN interface is still there if the provisioning is
+            # carried out again
+            outs += '$SUDO ip link set $PORT up\n'\
+                    'ip link show $PORT.%(vlan)s > /dev/null 2>&1 || '\
+                        '$SUDO ip link add link $PORT name $PORT.%(vlan)s type vlan id %(vlan)s\n'\
+                    '$SUDO ip link set $PORT.%(vlan)s up\n'\
+                        % {'vlan': port['vlan']}
+        outs += '$SUDO sed -i "s|ifc%(idx)s|$PORT|g" /etc/shimeth.%(vmname)s.%(vlan)s.dif\n'\
+                    % {'idx': port['idx'], 'vlan': port['vlan'],
+                       'vmname': vm['name']}
 
-    if args.overlay:
-        overlay = args.overlay
+    return outs
 
-    if vmname in overlays:
-        per_vm_overlay = overlays[vmname]
 
+def emit_ipcm_start(pl, vm):
     ipcm_components = ['scripting', 'console']
-    if args.manager:
+    if pl.args.manager:
         ipcm_components.append('mad')
     ipcm_components = ', '.join(ipcm_components)
 
-    gen_files = ' '.join([gen_files_conf, gen_files_bin, overlay, per_vm_overlay])
+    return  '$SUDO %(installpath)s/bin/ipcm -a \"%(ipcmcomps)s\" '\
+                        '-c /etc/%(vmname)s.ipcm.conf -l %(verb)s &> log &\n'\
+                % {'installpath': pl.env_dict['installpath'],
+                   'vmname': vm['name'], 'verb': pl.args.loglevel,
+                   'ipcmcomps': ipcm_components}
 
-    outs += ''\
-            'DONE=255\n'\
-            'while [ $DONE != "0" ]; do\n'\
-            '   scp %(sshopts)s -r -P %(ssh)s %(genfiles)s %(username)s@localhost: \n'\
-            '   DONE=$?\n'\
-            '   if [ $DONE != "0" ]; then\n'\
-            '       sleep 1\n'\
-            '   fi\n'\
-            'done\n\n'\
-            'ssh %(sshopts)s -p %(ssh)s %(username)s@localhost << \'ENDSSH\'\n'\
-                'set -x\n'\
+
+def emit_provisioning(pl, vmname):
+    vm = pl.vms[vmname]
+    vm_difs = vm_normal_difs(pl, vmname)
+
+    outs = emit_ssh_probe(pl, vm)
+    outs += emit_ssh_master(pl, vm)
+
+    # Nodes booted with an initramfs overlay configure themselves at boot
+    if vmname in pl.initrds:
+        return outs + '\n'
+
+    # The global overlay goes first, so that the node bundle can override it
+    if pl.overlay_archive != None:
+        outs += emit_archive_push(pl, vm, pl.overlay_archive)
+    outs += emit_archive_push(pl, vm, bundle_name(vmname))
+    outs += '\n'
+
+    # The provisioning fails (and is retried) as soon as a step fails,
+    # before IPCM is started
+    cmd = ''\
+            'ssh %(sshopts)s -p %(ssh)s %(username)s@%(host)s << \'ENDSSH\'\n'\
+                'set -ex\n'\
                 'SUDO=%(sudo)s\n'\
                 '$SUDO hostname %(name)s\n'\
                 '$SUDO modprobe rina-irati-core\n'\
                 '$SUDO chmod a+rw /dev/irati\n'\
-                '\n'\
-                '$SUDO mv %(genfilesconf)s /etc\n'\
-                '$SUDO mv %(genfilesbin)s /usr/bin\n'\
-            '\n' % {'name': vm['name'], 'ssh': vm['ssh'], 'id': vm['id'],
-                    'username': env_dict['username'],
-                    'genfiles': gen_files, 'genfilesconf': gen_files_conf,
-                    'genfilesbin': gen_files_bin, 'vmname': vm['name'],
-                    'sshopts': sshopts, 'sudo': sudo}
-
-    for ov in [overlay, per_vm_overlay]:
-        if ov != '':
-            outs += '$SUDO cp -r %(ov)s/* /\n'\
-                    '$SUDO rm -rf %(ov)s\n'\
-                        % {'ov': os.path.basename(ov)}
+            '\n' % {'name': vm['name'], 'ssh': vm['ssh'],
+                    'username': pl.env_dict['username'],
+                    'host': vm_address(pl, vm),
+                    'sshopts': vm_sshopts(pl, vm), 'sudo': pl.sudo}
 
-    for port in vm['ports']:
-        outs += 'PORT=$(mac2ifname %(mac)s)\n'\
-                '$SUDO ip link set $PORT up\n'\
-                '$SUDO ip link add link $PORT name $PORT.%(vlan)s type vlan id %(vlan)s\n'\
-                '$SUDO ip link set $PORT.%(vlan)s up\n'\
-                '$SUDO sed -i "s|ifc%(idx)s|$PORT|g" /etc/shimeth.%(vmname)s.%(vlan)s.dif\n'\
-                    % {'mac': port['mac'], 'idx': port['idx'],
-                       'id': vm['id'], 'vlan': port['vlan'],
-                       'vmname': vm['name']}
+    cmd += emit_merge_addresses(pl, vm, vm_difs)
+    cmd += emit_clone_macs(pl, vm)
+    cmd += emit_port_setup(vm, True)
 
-    outs +=     '$SUDO modprobe shim-eth-vlan\n'\
+    cmd +=      '$SUDO modprobe shim-eth-vlan\n'\
                 '$SUDO modprobe normal-ipcp\n'
-    outs +=     '$SUDO modprobe rina-default-plugin\n'\
-                '$SUDO %(installpath)s/bin/ipcm -a \"%(ipcmcomps)s\" '\
-                            '-c /etc/%(vmname)s.ipcm.conf -l %(verb)s &> log &\n'\
-                'sleep 1\n'\
-                'true\n'\
-            'ENDSSH\n' % {'installpath': env_dict['installpath'],
-                          'vmname': vm['name'], 'verb': args.loglevel,
-                          'ipcmcomps': ipcm_components}
-
-
-# Run the enrollment operations in an order which respect the dependencies
-for dif in dif_ordering:
-    for enrollment in enrollments[dif]:
-        vm = vms[enrollment['enrollee']]
-
-        print('I am going to enroll %s to DIF %s against neighbor %s, through '\
-                'lower DIF %s' % (enrollment['enrollee'], dif,
-                                  enrollment['enroller'],
-                                  enrollment['lower_dif']))
-
-        outs += 'sleep 2\n' # important!!
-        outs += ''\
-            'DONE=255\n'\
-            'while [ $DONE != "0" ]; do\n'\
-            '   ssh %(sshopts)s -p %(ssh)s %(username)s@localhost << \'ENDSSH\'\n'\
-            'set -x\n'\
-            'SUDO=%(sudo)s\n'\
-            '$SUDO enroll.py --lower-dif %(ldif)s --dif %(dif)s '\
-                        '--ipcm-conf /etc/%(vmname)s.ipcm.conf '\
-                        '--enrollee-name %(vmname)s.%(dif)s '\
-                        '--enroller-name %(enroller)s.%(dif)s\n'\
-            'sleep 1\n'\
-            'true\n'\
-            'ENDSSH\n'\
-            '   DONE=$?\n'\
-            '   if [ $DONE != "0" ]; then\n'\
-            '       sleep 1\n'\
-            '   fi\n'\
-            'done\n\n' % {'ssh': vm['ssh'], 'id': vm['id'],
-                          'pvid': vms[enrollment['enroller']]['id'],
-                          'username': env_dict['username'],
-                          'vmname': vm['name'],
-                          'enroller': enrollment['enroller'],
-                          'dif': dif, 'ldif': enrollment['lower_dif'],
-                          'sshopts': sshopts, 'sudo': sudo}
-
-fout.write(outs)
-
-fout.close()
-
-subprocess.call(['chmod', '+x', 'up.sh'])
+    cmd +=      '$SUDO modprobe rina-default-plugin\n'
+    cmd += emit_ipcm_start(pl, vm)
+    cmd +=  'ENDSSH\n'
+
+    return outs + emit_retry(pl, cmd, 'Provisioning of %s' % vmname) + '\n'
+
+
+# The init hook of the initramfs overlay of a node (see compute_initrds()),
+# run as root by the init scripts of the buildroot image. It carries out the
+# same steps as the provisioning of the node over ssh.
+initrd_hook = 'etc/init.d/S99rina'
+
+
+def emit_init_hook(pl, vmname):
+    vm = pl.vms[vmname]
+
+    outs =  '#!/bin/sh\n'\
+            '\n'\
+            '[ "$1" = "start" ] || exit 0\n'\
+            '\n'\
+            'SUDO=\n'\
+            'cd /root\n'\
+            'hostname %(name)s\n'\
+            'modprobe rina-irati-core\n'\
+            'chmod a+rw /dev/irati\n'\
+            '\n' % {'name': vmname}
+
+    outs += emit_merge_addresses(pl, vm, vm_normal_difs(pl, vmname))
+    outs += emit_port_setup(vm, True)
+
+    outs += 'modprobe shim-eth-vlan\n'\
+            'modprobe normal-ipcp\n'\
+            'modprobe rina-default-plugin\n'
+    outs += emit_ipcm_start(pl, vm)
+
+    return outs
+
+
+# Run enroll.py on the enrollee node of an enrollment, through ssh
+def emit_enroll_command(pl, dif, enrollment):
+    vm = pl.vms[enrollment['enrollee']]
+
+    return ''\
+        'ssh %(sshopts)s -p %(ssh)s %(username)s@%(host)s << \'ENDSSH\'\n'\
+        'set -x\n'\
+        'SUDO=%(sudo)s\n'\
+        '$SUDO enroll.py --lower-dif %(ldif)s --dif %(dif)s '\
+                    '--ipcm-conf /etc/%(vmname)s.ipcm.conf '\
+                    '--enrollee-name %(vmname)s.%(dif)s '\
+                    '--enroller-name %(enroller)s.%(dif)s '\
+                    '--timeout %(timeout)d\n'\
+        'ENDSSH\n' % {'ssh': vm['ssh'],
+                      'username': pl.env_dict['username'],
+                      'host': vm_address(pl, vm),
+                      'vmname': vm['name'],
+                      'enroller': enrollment['enroller'],
+                      'dif': dif, 'ldif': enrollment['lower_dif'],
+                      'sshopts': vm_sshopts(pl, vm), 'sudo': pl.sudo,
+                      'timeout': pl.console_timeout}
+
+
+def emit_enrollment(pl, dif, enrollment):
+    return emit_retry(pl, emit_enroll_command(pl, dif, enrollment),
+                      'Enrollment of %s to DIF %s' % (enrollment['enrollee'],
+                                                      dif)) + '\n'
+
+
+# Carry out some independent enrollments in parallel, failing if any of
+# them fails
+def emit_enrollment_batch(pl, tasks):
+    if len(tasks) == 1:
+        return emit_enrollment(pl, tasks[0]['dif'], tasks[0])
+
+    outs = 'PIDS=""\n'
+    for task in tasks:
+        outs += '(\n' + emit_enrollment(pl, task['dif'], task) +\
+                ') &\n'\
+                'PIDS="$PIDS $!"\n'
+
+    return outs +\
+           'FAILED=0\n'\
+           'for PID in $PIDS; do\n'\
+           '   wait $PID || FAILED=1\n'\
+           'done\n'\
+           'if [ $FAILED != "0" ]; then\n'\
+           '   exit 1\n'\
+           'fi\n\n'
+
+
+def enrollment_chunks(pl):
+    # Run the enrollment operations in waves, one for each level of the
+    # enrollment DAG: the enrollments of a wave only depend on the ones of
+    # the previous waves, and run in parallel (--enroll-jobs at a time)
+    waves = collections.defaultdict(list)
+    for task in pl.enrollment_tasks:
+        waves[task['depth']].append(task)
+
+    jobs = max(1, pl.args.enroll_jobs)
+    for depth in sorted(waves):
+        tasks = waves[depth]
+        for i in range(0, len(tasks), jobs):
+            yield emit_enrollment_batch(pl, tasks[i:i + jobs])
+
+
+def up_script_chunks(pl, host = None):
+    yield   '#!/bin/bash\n'             \
+            '\n'                        \
+            'set -x\n'                  \
+            '\n'
+
+    for chunk in up_network_chunks(pl, host):
+        yield chunk
+    for chunk in up_vms_chunks(pl, host):
+        yield chunk
+
+    for vmname in host_vms(pl, host):
+        yield emit_provisioning(pl, vmname)
+
+    # With --hosts, the enrollments are carried out by enroll.sh, once
+    # all the hosts are up
+    if host == None:
+        for chunk in enrollment_chunks(pl):
+            yield chunk
+
+
+def enroll_script_chunks(pl):
+    yield   '#!/bin/bash\n'             \
+            '\n'                        \
+            'set -x\n'                  \
+            '\n'
+
+    for chunk in enrollment_chunks(pl):
+        yield chunk
 
 
 ###################### Generate DOWN script ########################
-fout = open('down.sh', 'w')
-
-outs =  '#!/bin/bash\n'             \
-        '\n'                        \
-        'set -x\n'                  \
-        '\n'                        \
-        'kill_qemu() {\n'           \
-        '   PIDFILE=$1\n'           \
-        '   PID=$(cat $PIDFILE)\n'  \
-        '   if [ -n $PID ]; then\n' \
-        '       kill $PID\n'        \
-        '       while [ -n "$(ps -p $PID -o comm=)" ]; do\n'    \
-        '           sleep 1\n'                                  \
-        '       done\n'                                         \
-        '   fi\n'                                               \
-        '\n'                                                    \
-        '   rm $PIDFILE\n'                                      \
-        '}\n\n'
-
-for vmname in sorted(vms):
-    vm = vms[vmname]
-    outs += 'kill_qemu rina-%(id)s.pid\n' % {'id': vm['id']}
-
-outs += '\n'
-
-for vmname in sorted(vms):
-    vm = vms[vmname]
-    for port in vm['ports']:
-        tap = port['tap']
-        b = port['br']
+def down_script_chunks(pl, host = None):
+    vms = pl.vms
+
+    yield '#!/bin/bash\n'             \
+          '\n'                        \
+          'set -x\n'                  \
+          '\n'                        \
+          'kill_qemu() {\n'           \
+          '   PIDFILE=$1\n'           \
+          '   PID=$(cat $PIDFILE)\n'  \
+          '   if [ -n $PID ]; then\n' \
+          '       kill $PID\n'        \
+          '       while [ -n "$(ps -p $PID -o comm=)" ]; do\n'    \
+          '           sleep 1\n'                                  \
+          '       done\n'                                         \
+          '   fi\n'                                               \
+          '\n'                                                    \
+          '   rm $PIDFILE\n'                                      \
+          '}\n\n'
+
+    for vmname in host_vms(pl, host):
+        vm = vms[vmname]
+        yield 'ssh %(sshopts)s -O exit -p %(ssh)s %(username)s@%(host)s '\
+                    '2> /dev/null\n' % {'ssh': vm['ssh'],
+                                        'username': pl.env_dict['username'],
+                                        'host': vm_address(pl, vm),
+                                        'sshopts': vm_sshopts(pl, vm)}
+        yield 'kill_qemu %(pidfile)s\n' % {'pidfile': vm['pidfile']}
+        if pl.args.cgroups:
+            yield 'sudo rmdir %s\n' % vm_cgroup(pl, vmname)
+        if not pl.args.legacy:
+            yield 'rm -f %(vmname)s.serial\n' % {'vmname': vmname}
 
-        outs += 'sudo brctl delif %(br)s %(tap)s\n'             \
-                'sudo ip link set %(tap)s down\n'               \
-                'sudo ip tuntap del mode tap name %(tap)s\n\n'  \
-                    % {'tap': tap, 'br': b}
+    # The template VMs are still running if their state was not saved
+    for name in sorted(set([vms[vmname]['template']
+                            for vmname in host_vms(pl, host)
+                            if vms[vmname]['template'] != None])):
+        yield 'if [ -f %(pidfile)s ]; then kill_qemu %(pidfile)s; fi\n'\
+              'rm -f %(name)s.serial %(qmp)s\n'\
+                    % pl.templates[name]
 
-for shim in sorted(shims):
-    outs += 'sudo ip link set %(br)s down\n'        \
-            'sudo brctl delbr %(br)s\n'             \
-            '\n' % {'br': shims[shim]['bridge']}
+    yield '\n'
 
-fout.write(outs)
+    yield run_batch_function
+    yield 'run_batch ip %s\n\n' % batch_name('down', host, 'ip')
 
-fout.close()
+    if pl.args.cgroups:
+        yield 'sudo rmdir %s\n' % slice_cgroup(pl)
 
-subprocess.call(['chmod', '+x', 'down.sh'])
 
 
 ################## Generate IPCM/DIF configuration files ##################
-ipcmconfs = dict()
-
-# If some app directives were specified, use those to build da.map.
-# Otherwise, assume the standard applications are to be mapped in
-# the DIF with the highest rank.
-if len(app_mappings) == 0:
-    if len(dif_ordering) > 0:
-        for adm in gen_templates.da_map_base["applicationToDIFMappings"]:
-            adm["difName"] = "%s" % (dif_ordering[-1],)
-else:
-    gen_templates.da_map_base["applicationToDIFMappings"] = []
-    for apm in app_mappings:
-        gen_templates.da_map_base["applicationToDIFMappings"].append({
-                                                    "encodedAppName": apm['name'],
-                                                    "difName": "%s" % (apm['dif'])
-                                            })
-
-if args.manager:
-    # Add MAD/Manager configuration
-    gen_templates.ipcmconf_base["addons"] = {
-                    "mad": {
-                            "managerConnections" : [ {
-                                        "managerAppName" : "manager-1--",
-                                        "DIF": "%s" % (mgmt_dif_name)
-                                    }
-                                ]
-                    }
-                }
-
-for vmname in vms:
-    ipcmconfs[vmname] = copy.deepcopy(gen_templates.ipcmconf_base)
-
-difconfs = dict()
-for dif in difs:
-    difconfs[dif] = dict()
-    for vmname in difs[dif]:
-        difconfs[dif][vmname] = copy.deepcopy(gen_templates.normal_dif_base)
+known_addresses_placeholder = '@knownIPCProcessAddresses@'
 
-for vmname in sorted(vms):
-    vm = vms[vmname]
-    ipcmconf = ipcmconfs[vmname]
 
-    for port in vm['ports']:
-        ipcmconf["ipcProcessesToCreate"].append({
-                                "difName": port['vlan']
-                                })
-
-        template_file_name = 'shimeth.%s.%s.dif' % (vm['name'], port['vlan'])
-        ipcmconf["difConfigurations"].append({
-                                "name": port['vlan'],
-                                "template": template_file_name
-                                })
+# Return a dictionary mapping the name of each configuration file to a
+# function that serializes it
+def conf_producers(pl):
+    producers = dict()
+    env_dict = pl.env_dict
 
-        fout = open(template_file_name, 'w')
-        fout.write(json.dumps({"difType": "shim-eth-vlan",
-                               "configParameters": {
+    def shim_producer(port):
+        return lambda: [json.dumps({
+                                "difType": "shim-eth-vlan",
+                                "configParameters": {
                                     "interface-name": "ifc%d" % (port['idx'],)
                                     }
-                              },
-                              indent=4, sort_keys=True))
+                                },
+                                indent=4, sort_keys=True)]
+
+    def ipcm_producer(vmname):
+        return lambda: [dict_dump_json(pl.ipcmconfs[vmname],
+                                       dict(env_dict, sysname = vmname))]
+
+    def normal_producer(dif, template, addresses_str):
+        def produce():
+            difconf = dict(pl.difconfs[dif][template])
+            if addresses_str == None:
+                del difconf["knownIPCProcessAddresses"]
+                difconf["knownIPCProcessAddressesFile"] = '/etc/addresses.%s.json' % (dif,)
+                difconf_str = json.dumps(difconf, indent = 4, sort_keys = True)
+            else:
+                difconf["knownIPCProcessAddresses"] = known_addresses_placeholder
+                difconf_str = json.dumps(difconf, indent = 4, sort_keys = True)
+                difconf_str = difconf_str.replace('"%s"' % known_addresses_placeholder,
+                                                  addresses_str, 1)
+            return [difconf_str % env_dict]
+        return produce
+
+    for vmname in sorted(pl.vms):
+        vm = pl.vms[vmname]
+        for port in vm['ports']:
+            template_file_name = 'shimeth.%s.%s.dif' % (vm['name'], port['vlan'])
+            producers[template_file_name] = shim_producer(port)
+
+    # Dump the DIF Allocator map
+    producers['da.map'] = lambda: [dict_dump_json(pl.da_map, env_dict)]
+
+    for vmname in pl.vms:
+        # Dump the IPCM configuration files
+        producers['%s.ipcm.conf' % (vmname)] = ipcm_producer(vmname)
+
+    for dif in pl.difconfs:
+        # The map of IPCP addresses is serialized only once per DIF, and
+        # either spliced into each DIF configuration file or shipped as a
+        # separate file, to be merged by the node itself
+        if pl.args.shared_addresses:
+            addresses_str = None
+            producers['addresses.%s.json' % (dif,)] = \
+                (lambda dif: lambda: [json.dumps(pl.dif_addresses[dif],
+                                                 sort_keys = True,
+                                                 separators = (',', ':'))])(dif)
+        else:
+            addresses_str = json.dumps(pl.dif_addresses[dif], indent = 4,
+                                       sort_keys = True).replace('\n', '\n    ')
+
+        for template in pl.difconfs[dif]:
+            # Dump the normal DIF configuration files
+            producers[template] = normal_producer(dif, template,
+                                                  addresses_str)
+
+    # Dump the enrollment DAG, for the runners
+    producers['enrollments.json'] = lambda: [json.dumps({
+                                    'tasks': pl.enrollment_tasks,
+                                    'critical_path': pl.critical_path},
+                                    indent = 4, sort_keys = True)]
+
+    # Dump the addresses of the nodes in each normal DIF, with the
+    # addressing scheme and the region of each node
+    def addresses_map():
+        for dif in sorted(pl.addressing):
+            addressing = pl.addressing[dif]
+            addresses = addressing['addresses']
+            for vmname in sorted(addresses, key = lambda v: addresses[v]):
+                address, region = addresses[vmname]
+                yield '%s %s %d %s %s\n' % (dif, addressing['scheme'],
+                                            address, vmname,
+                                            region if region != None else '-')
+    producers['addresses.map'] = addresses_map
+
+    # Dump the mapping from nodes to SSH ports
+    producers['gen.map'] = lambda: ['%s %d\n' % (vmname, pl.vms[vmname]['ssh'])
+                                    for vmname in sorted(pl.vms)]
+
+    return producers
+
+
+# The ip and tc batch files applied by the up and down scripts
+def batch_producers(pl, host = None):
+    return {batch_name('up', host, 'ip'):
+                lambda: batch_chunks(up_network_commands(pl, host), 'ip'),
+            batch_name('up', host, 'tc'):
+                lambda: batch_chunks(up_network_commands(pl, host), 'tc'),
+            batch_name('down', host, 'ip'):
+                lambda: batch_chunks(down_network_commands(pl, host), 'ip')}
+
+
+def producers(pl):
+    """Return a dictionary mapping the name of each deployment artifact
+       of a Plan to a function producing its content, as an iterable of
+       strings"""
+    artifacts = conf_producers(pl)
+
+    # Dump the vCPUs and the host CPUs of each node
+    if pl.args.pin:
+        artifacts['cpus.map'] = lambda: ['%s %d %s\n' % (vmname,
+                                                        pl.vms[vmname]['smp'],
+                                                        pl.vms[vmname]['cpus'])
+                                         for vmname in sorted(pl.vms)]
+
+    if len(pl.hosts) == 0:
+        artifacts['up.sh'] = lambda: up_script_chunks(pl)
+        artifacts['down.sh'] = lambda: down_script_chunks(pl)
+        artifacts.update(batch_producers(pl))
+        return artifacts
+
+    for host in range(len(pl.hosts)):
+        artifacts['up.host%d.sh' % (host + 1)] = \
+                    (lambda host: lambda: up_script_chunks(pl, host))(host)
+        artifacts['down.host%d.sh' % (host + 1)] = \
+                    (lambda host: lambda: down_script_chunks(pl, host))(host)
+        artifacts.update(batch_producers(pl, host))
+    artifacts['enroll.sh'] = lambda: enroll_script_chunks(pl)
+
+    # Dump the mapping from nodes to hosts
+    artifacts['hosts.map'] = lambda: ['%s %d %s\n' % (vmname,
+                                                     pl.vms[vmname]['host'] + 1,
+                                                     vm_address(pl, pl.vms[vmname]))
+                                      for vmname in sorted(pl.vms)]
+
+    return artifacts
+
+
+def emit(pl):
+    """Produce all the deployment artifacts for a Plan, as a dictionary
+       mapping file names to their content"""
+    artifacts = producers(pl)
+    for name in artifacts:
+        artifacts[name] = ''.join(artifacts[name]())
+
+    return artifacts
+
+
+############################ Write artifacts ############################
+def executable_artifact(name):
+    return name.endswith('.sh')
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """Content hashes of the artifacts written by a generation run, and of
+       the part of the scenario that can only be changed by a reboot (the
+       emulated network and the VMs), and the enrollments of the run"""
+
+    file_name = 'gen.manifest'
+
+    def __init__(self, outdir = '.'):
+        self.path = os.path.join(outdir, self.file_name)
+        self.artifacts = dict()
+        self.topology = None
+        self.enrollments = None
+
+        try:
+            fin = open(self.path, 'r')
+            d = json.load(fin)
+            fin.close()
+            self.artifacts = d['artifacts']
+            self.topology = d['topology']
+            self.enrollments = d.get('enrollments')
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        fout = open(self.path, 'w')
+        fout.write(json.dumps({'artifacts': self.artifacts,
+                               'topology': self.topology,
+                               'enrollments': self.enrollments},
+                              indent = 4, sort_keys = True))
         fout.close()
 
 
-# Run over dif_ordering array, to make sure each IPCM config has
-# the correct ordering for the ipcProcessesToCreate list of operations.
-# If we iterated over the difs map, the order would be randomic, and so
-# some IPCP registrations in lower DIFs may fail. This would happen because
-# at the moment of registration, it may be that the IPCP of the lower DIF
-# has not been created yet.
-for dif in dif_ordering:
+def topology_hash(pl):
+    h = hashlib.sha256()
+    for host in [None] + list(range(len(pl.hosts))):
+        for gen in [up_network_chunks(pl, host), up_vms_chunks(pl, host),
+                    down_script_chunks(pl, host),
+                    batch_chunks(up_network_commands(pl, host), 'ip'),
+                    batch_chunks(up_network_commands(pl, host), 'tc'),
+                    batch_chunks(down_network_commands(pl, host), 'ip')]:
+            for chunk in gen:
+                h.update(chunk.encode('utf-8'))
+    return h.hexdigest()
+
+
+# Stream the chunks of an artifact to a temporary file, which is then
+# atomically renamed, unless the content hash of the artifact matches
+# old_hash and the artifact is already there. Return the content hash,
+# and whether the artifact has been written.
+def write_artifact(outdir, name, chunks, old_hash = None):
+    path = os.path.join(outdir, name)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    h = hashlib.sha256()
 
-    if dif in shims:
-        # Shims are managed separately, in the previous loop
-        continue
+    try:
+        fout = open(tmp_path, 'w')
+        for chunk in chunks:
+            fout.write(chunk)
+            h.update(chunk.encode('utf-8'))
+        fout.close()
 
-    for vmname in difs[dif]:
-        vm = vms[vmname]
-        ipcmconf = ipcmconfs[vmname]
+        h = h.hexdigest()
+        if h == old_hash and os.path.exists(path):
+            os.unlink(tmp_path)
+            return h, False
 
-        normal_ipcp = { "difName": "%s" % (dif,) }
+        if executable_artifact(name):
+            os.chmod(tmp_path, os.stat(tmp_path).st_mode | 0o111)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
-        normal_ipcp["difsToRegisterAt"] = []
-        for lower_dif in difs[dif][vmname]:
-            if lower_dif not in shims:
-                lower_dif = lower_dif
-            normal_ipcp["difsToRegisterAt"].append(lower_dif)
+    return h, True
 
-        ipcmconf["ipcProcessesToCreate"].append(normal_ipcp)
 
-        ipcmconf["difConfigurations"].append({
-                                "name": "%s" % (dif),
-                                "template": "normal.%s.%s.dif" % (vmname, dif)
-                                })
+# Worker processes are forked, so they inherit the artifacts to be written
+# (closures cannot be pickled) through this global variable
+pool_job = None
 
-        # Fill in the map of IPCP addresses. This could be moved at difconfs
-        # deepcopy-time
-        for ovm in difs[dif]:
-            difconfs[dif][ovm]["knownIPCProcessAddresses"].append({
-                                        "apName":  "%s.%s" % (vmname, dif),
-                                        "apInstance": "1",
-                                        "address": 16 + vm['id']
-                                    })
 
-        for policy in dif_policies[dif]:
-            if policy['nodes'] == [] or vmname in policy['nodes']:
-                gen_templates.translate_policy(difconfs[dif][vmname], policy['path'],
-                                               policy['ps'], policy['parms'])
+def pool_write_artifacts(names):
+    artifacts, outdir, old_hashes = pool_job
+    return [(name,) + write_artifact(outdir, name, artifacts[name](),
+                                     old_hashes.get(name))
+            for name in names]
 
 
-# Dump the DIF Allocator map
-dict_dump_json('da.map', gen_templates.da_map_base, env_dict)
+# Don't bother forking workers for small scenarios
+pool_min_artifacts = 256
 
-for vmname in vms:
-    # Dump the IPCM configuration files
-    env_dict['sysname'] = '%s' %(vmname)
-    dict_dump_json('%s.ipcm.conf' % (vmname), ipcmconfs[vmname], env_dict)
 
-for dif in difs:
-    for vmname in difs[dif]:
-        # Dump the normal DIF configuration files
-        dict_dump_json('normal.%s.%s.dif' % (vmname, dif,),
-                       difconfs[dif][vmname], env_dict)
+def write_artifacts(artifacts, outdir = '.', manifest = None, jobs = 1,
+                    timings = None):
+    """Write the artifacts into outdir. The artifacts are specified as a
+       dictionary mapping file names either to their content or to a
+       function producing it as an iterable of strings (see producers()).
+       The scripts are streamed to disk by this process, while the other
+       artifacts are written by a pool of 'jobs' processes.
+       If a manifest is specified, the artifacts whose content did not
+       change since the run recorded in the manifest are not rewritten,
+       and the manifest is updated.
+       If a timings dictionary is specified, the time spent writing
+       scripts and configuration files is stored there.
+       Return the names of the artifacts that have been written."""
+    global pool_job
 
+    old_hashes = dict()
+    if manifest != None:
+        old_hashes = manifest.artifacts
 
-# Dump the mapping from nodes to SSH ports
-fout = open('gen.map', 'w')
-for vmname in sorted(vms):
-    fout.write('%s %d\n' % (vmname, env_dict['baseport'] + vms[vmname]['id']))
-fout.close()
+    funcs = dict()
+    for name in artifacts:
+        if callable(artifacts[name]):
+            funcs[name] = artifacts[name]
+        else:
+            funcs[name] = (lambda text: lambda: [text])(artifacts[name])
+
+    scripts = sorted([name for name in funcs if executable_artifact(name)])
+    confs = sorted([name for name in funcs if not executable_artifact(name)])
+    results = []
+
+    start = time.time()
+    if jobs > 1 and len(confs) >= pool_min_artifacts and \
+            'fork' in multiprocessing.get_all_start_methods():
+        pool_job = (funcs, outdir, old_hashes)
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+        try:
+            batch = max(1, len(confs) // (jobs * 4))
+            for r in pool.imap_unordered(pool_write_artifacts,
+                                         [confs[i:i + batch] for i in
+                                          range(0, len(confs), batch)]):
+                results.extend(r)
+        finally:
+            pool.close()
+            pool.join()
+            pool_job = None
+    else:
+        for name in confs:
+            results.append((name,) + write_artifact(outdir, name, funcs[name](),
+                                                    old_hashes.get(name)))
+    middle = time.time()
+
+    for name in scripts:
+        results.append((name,) + write_artifact(outdir, name, funcs[name](),
+                                                old_hashes.get(name)))
+    end = time.time()
+
+    if timings != None:
+        timings['configurations'] = middle - start
+        timings['scripts'] = end - middle
+
+    if manifest != None:
+        manifest.artifacts = dict([(name, h) for (name, h, w) in results])
+        manifest.save()
+
+    return sorted([name for (name, h, w) in results if w])
+
+
+##################### Generate per-node bundles ######################
+def bundle_name(vmname):
+    return 'bundle.%s.tar.gz' % vmname
+
+
+def tar_filter(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+
+# Return the (source path, archive path) pairs for the content of an
+# overlay directory. Only files, symbolic links and empty directories are
+# archived, so that the existing directories of the nodes keep their modes.
+def overlay_members(path):
+    members = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        if root != path and len(dirs) == 0 and len(files) == 0:
+            members.append((root, os.path.relpath(root, path)))
+        for name in sorted(files) + sorted([d for d in dirs if
+                                os.path.islink(os.path.join(root, d))]):
+            fpath = os.path.join(root, name)
+            members.append((fpath, os.path.relpath(fpath, path)))
+    return members
+
+
+# Write a compressed tar archive, keeping the file modes. The archives do not
+# depend on when they are written, so that unchanged content gives identical
+# archives.
+def write_archive(path, members):
+    tmp = path + '.tmp'
+    fout = open(tmp, 'wb')
+    gz = gzip.GzipFile(filename = '', mode = 'wb', fileobj = fout, mtime = 0)
+    tar = tarfile.open(fileobj = gz, mode = 'w', format = tarfile.GNU_FORMAT)
+    for src, arcname in members:
+        tar.add(src, arcname, recursive = False, filter = tar_filter)
+    tar.close()
+    gz.close()
+    fout.close()
+    os.replace(tmp, path)
+
+
+def write_bundles(pl, outdir = '.'):
+    """Write the bundle of each node of a Plan into outdir, with the
+       configuration files previously written there, and the global overlay
+       archive. Bundles are only rewritten if any of their sources is newer,
+       and the global overlay archive only if no archive with the same
+       content exists. Return the names of the archives written."""
+    written = []
+
+    if pl.overlay_archive != None:
+        path = os.path.join(outdir, pl.overlay_archive)
+        if not os.path.exists(path):
+            write_archive(path, overlay_members(pl.args.overlay))
+            written.append(pl.overlay_archive)
+
+    for vmname in sorted(pl.bundles):
+        bundle = pl.bundles[vmname]
+        members = [(os.path.join(outdir, name), 'etc/' + name)
+                   for name in bundle['confs']]
+        members += [(name, 'usr/bin/' + name) for name in bundle['bins']]
+        if bundle['overlay'] != None:
+            members += overlay_members(bundle['overlay'])
+
+        # Removing files from an overlay updates its directories
+        sources = [src for src, _ in members]
+        if bundle['overlay'] != None:
+            sources += [root for root, dirs, files in os.walk(bundle['overlay'])]
+
+        path = os.path.join(outdir, bundle_name(vmname))
+        try:
+            if os.path.exists(path):
+                mtime = os.path.getmtime(path)
+                if all(os.path.getmtime(src) < mtime for src in sources):
+                    continue
+
+            write_archive(path, members)
+        except (IOError, OSError) as e:
+            raise GenError('Cannot write %s: %s' % (bundle_name(vmname), e))
+        written.append(bundle_name(vmname))
+
+    return written
+
+
+################# Generate per-node initramfs overlays #################
+cpio_magic = b'070701'
+
+
+# Serialize an entry of a cpio archive in the "newc" format understood by
+# the kernel, owned by root and with no timestamp
+def cpio_entry(name, mode, data = b'', ino = 0, nlink = 1):
+    name = name.encode('utf-8') + b'\0'
+    fields = [ino, mode, 0, 0, nlink, 0, len(data), 0, 0, 0, 0, len(name), 0]
+    entry = cpio_magic + ''.join(['%08x' % f for f in fields]).encode('ascii')
+    entry += name + b'\0' * (-(len(entry) + len(name)) % 4)
+    return entry + data + b'\0' * (-len(data) % 4)
+
+
+# Return the set of paths in an uncompressed "newc" cpio archive (possibly
+# made of several concatenated archives), or None if the archive is in
+# another format
+def cpio_names(path):
+    fin = open(path, 'rb')
+    data = fin.read()
+    fin.close()
+
+    names = set()
+    pos = 0
+    while pos < len(data):
+        # Archives can be padded with zeros
+        if data[pos:pos + 4] == b'\0\0\0\0':
+            pos += 4
+            continue
+        if data[pos:pos + 6] != cpio_magic:
+            return None if pos == 0 else names
+        filesize = int(data[pos + 54:pos + 62], 16)
+        namesize = int(data[pos + 94:pos + 102], 16)
+        name = data[pos + 110:pos + 110 + namesize - 1].decode('utf-8',
+                                                               'replace')
+        if name.startswith('./'):
+            name = name[2:]
+        if name not in ['TRAILER!!!', '.']:
+            names.add(name)
+        pos += 110 + namesize
+        pos += -pos % 4
+        pos += filesize
+        pos += -pos % 4
+
+    return names
+
+
+# Build the initramfs overlay of a node, with the same content as its bundle
+# plus the init hook. Only the directories missing from the base image (whose
+# paths are base_names) are created, so that the existing ones keep their
+# modes.
+def initrd_overlay(pl, vmname, base_names, outdir = '.'):
+    bundle = pl.bundles[vmname]
+
+    members = []
+    if pl.args.overlay:
+        members += overlay_members(pl.args.overlay)
+    members += [(os.path.join(outdir, name), 'etc/' + name)
+                for name in bundle['confs']]
+    members += [(name, 'usr/bin/' + name) for name in bundle['bins']]
+    if bundle['overlay'] != None:
+        members += overlay_members(bundle['overlay'])
+
+    dirs = set()
+    for _, arcname in members + [(None, initrd_hook)]:
+        parent = os.path.dirname(arcname)
+        while parent != '':
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    dirs -= base_names
+
+    entries = [(d, stat.S_IFDIR | 0o755, b'') for d in sorted(dirs)]
+    for src, arcname in members:
+        st = os.lstat(src)
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(src).encode('utf-8')
+        elif stat.S_ISDIR(st.st_mode):
+            data = b''
+        else:
+            fin = open(src, 'rb')
+            data = fin.read()
+            fin.close()
+        entries.append((arcname, st.st_mode, data))
+    entries.append((initrd_hook, stat.S_IFREG | 0o755,
+                    emit_init_hook(pl, vmname).encode('utf-8')))
+
+    archive = [cpio_entry(name, mode, data, ino + 1,
+                          2 if stat.S_ISDIR(mode) else 1)
+               for ino, (name, mode, data) in enumerate(entries)]
+    archive.append(cpio_entry('TRAILER!!!', 0))
+
+    return b''.join(archive)
+
+
+def write_initrds(pl, outdir = '.'):
+    """Write the initramfs overlay of each node of a Plan (with
+       --initrd-overlay) into outdir, with the configuration files
+       previously written there, followed by the image booted by the node:
+       its base image with the overlay appended. Images are only rewritten
+       if their overlay or their base image changed. Return the names of
+       the images written."""
+    written = []
+    base_names = dict()
+
+    for vmname in sorted(pl.initrds):
+        initrd = pl.initrds[vmname]
+        base = initrd['base']
+        overlay_path = os.path.join(outdir, initrd['overlay'])
+        image_path = os.path.join(outdir, initrd['image'])
+
+        try:
+            if base not in base_names:
+                base_names[base] = cpio_names(base)
+            if base_names[base] == None:
+                raise GenError('%s is not an uncompressed newc cpio archive, '
+                               'which --initrd-overlay needs' % base)
+            overlay = initrd_overlay(pl, vmname, base_names[base], outdir)
+
+            if os.path.exists(overlay_path) and os.path.exists(image_path) \
+                    and os.path.getmtime(image_path) >= os.path.getmtime(base):
+                fin = open(overlay_path, 'rb')
+                unchanged = fin.read() == overlay
+                fin.close()
+                if unchanged:
+                    continue
+
+            fout = open(overlay_path + '.tmp', 'wb')
+            fout.write(overlay)
+            fout.close()
+            os.replace(overlay_path + '.tmp', overlay_path)
+
+            # The kernel unpacks the concatenated archives in order, and
+            # expects each of them to start at a multiple of 4 bytes
+            fout = open(image_path + '.tmp', 'wb')
+            fin = open(base, 'rb')
+            shutil.copyfileobj(fin, fout)
+            fin.close()
+            fout.write(b'\0' * (-fout.tell() % 4))
+            fout.write(overlay)
+            fout.close()
+            os.replace(image_path + '.tmp', image_path)
+        except (IOError, OSError) as e:
+            raise GenError('Cannot write %s: %s' % (initrd['image'], e))
+        written.append(initrd['image'])
+
+    return written
+
+
+##################### Generate DELTA script ######################
+def vm_artifacts(pl, vmname):
+    vm = pl.vms[vmname]
+    names = ['da.map', '%s.ipcm.conf' % vmname]
+    for port in vm['ports']:
+        names.append('shimeth.%s.%s.dif' % (vmname, port['vlan']))
+    for dif in pl.scenario.difs:
+        if vmname in pl.scenario.difs[dif]:
+            names.append(pl.dif_templates[dif][vmname])
+            names.append('addresses.%s.json' % dif)
+    return names
+
+
+# The enrollments of a Plan, as stored in the manifest
+def enrollment_plan(pl):
+    return sorted([[dif, e['enrollee'], e['enroller'], e['lower_dif']]
+                   for dif in pl.enrollments for e in pl.enrollments[dif]])
+
+
+def emit_delta_script(pl, changed, topology_changed,
+                       old_enrollments = None):
+    """Generate a script that applies to a running scenario the changes
+       to the artifacts in the 'changed' list: the configuration files are
+       pushed again only to the affected nodes, where IPCM is restarted,
+       and all the enrollments involving those nodes are carried out again.
+       The nodes of the enrollments added or removed since old_enrollments
+       (the enrollment_plan() of the running scenario) are also affected."""
+    outs =  '#!/bin/bash\n'             \
+            '\n'                        \
+            'set -x\n'                  \
+            '\n'
+
+    if topology_changed:
+        return outs + 'echo "The emulated network or the VMs changed: '\
+                      'run down.sh and up.sh"\n'\
+                      'exit 1\n'
+
+    changed = set(changed)
+    changed_vms = set()
+    for vmname in pl.vms:
+        if any(name in changed for name in vm_artifacts(pl, vmname)):
+            changed_vms.add(vmname)
+
+    # A node is restarted to drop an enrollment, and the enrollments
+    # of the restarted nodes are all carried out again
+    if old_enrollments != None:
+        for (dif, enrollee, enroller, lower_dif) in \
+                set(map(tuple, enrollment_plan(pl))) ^ \
+                set(map(tuple, old_enrollments)):
+            changed_vms.update([vmname for vmname in [enrollee, enroller]
+                                if vmname in pl.vms])
+
+    if len(changed_vms) == 0:
+        return outs + 'echo "Nothing changed"\n'
+
+    for vmname in sorted(changed_vms):
+        vm = pl.vms[vmname]
+        vm_difs = vm_normal_difs(pl, vmname)
+        vars_dict = {'ssh': vm['ssh'], 'username': pl.env_dict['username'],
+                     'sshopts': vm_sshopts(pl, vm), 'sudo': pl.sudo,
+                     'host': vm_address(pl, vm)}
+
+        outs += emit_ssh_master(pl, vm)
+        outs += ''\
+                'ssh %(sshopts)s -p %(ssh)s %(username)s@%(host)s << \'ENDSSH\'\n'\
+                    'set -x\n'\
+                    'SUDO=%(sudo)s\n'\
+                    '$SUDO killall ipcm\n'\
+                    'while pidof ipcm > /dev/null; do sleep 1; done\n'\
+                    'true\n'\
+                'ENDSSH\n' % vars_dict
+        outs += emit_archive_push(pl, vm, bundle_name(vmname))
+        outs += ''\
+                'ssh %(sshopts)s -p %(ssh)s %(username)s@%(host)s << \'ENDSSH\'\n'\
+                    'set -x\n'\
+                    'SUDO=%(sudo)s\n' % vars_dict
+        outs += emit_merge_addresses(pl, vm, vm_difs)
+        outs += emit_port_setup(vm, False)
+        outs += emit_ipcm_start(pl, vm)
+        outs +=     'true\n'\
+                'ENDSSH\n'
 
+    for dif in pl.dif_ordering:
+        for enrollment in pl.enrollments[dif]:
+            if enrollment['enrollee'] in changed_vms or \
+                    enrollment['enroller'] in changed_vms:
+                outs += emit_enrollment(pl, dif, enrollment)
 
-if args.graphviz:
+    return outs
+
+
+def emit_graphviz(pl, file_name = 'difs.png'):
     try:
         import pydot
 
@@ -1020,45 +3257,146 @@ if args.graphviz:
 
         gvizg = pydot.Dot(graph_type = 'graph')
         i = 0
-        for dif in difs:
-            for vmname in dif_graphs[dif]:
+        for dif in pl.scenario.difs:
+            for vmname in pl.dif_graphs[dif]:
                 node = pydot.Node(dif + vmname,
                                   label = "%s(%s)" % (vmname, dif),
                                   style = "filled", fillcolor = colors[i],
                                   fontcolor = fcolors[i])
                 gvizg.add_node(node)
 
-            for vmname in dif_graphs[dif]:
-                for (neigh, lower_dif) in dif_graphs[dif][vmname]:
-                    if vmname > neigh:
-                        # Use lexicographical filter to avoid duplicate edges
-                        continue
-
-                    color = 'black'
-                    # If enrollment is going to happen on this edge, color
-                    # it in red
-                    for enrollment in enrollments[dif]:
-                        ee = enrollment['enrollee']
-                        er = enrollment['enroller']
-                        lo = enrollment['lower_dif']
-                        if lo.endswith(".DIF"):
-                            lo = lo[:-4]
-                        if lower_dif == lo and \
-                                ((vmname == ee and neigh == er) or \
-                                (vmname == er and neigh == ee)):
-                            color = 'red'
-                            break
-
-                    edge = pydot.Edge(dif + vmname, dif + neigh,
-                                      label = lower_dif, color = color)
-                    gvizg.add_edge(edge)
+            # Edges where enrollment is going to happen are colored in red
+            enrolled_edges = set()
+            for enrollment in pl.enrollments[dif]:
+                lo = enrollment['lower_dif']
+                if lo.endswith(".DIF"):
+                    lo = lo[:-4]
+                enrolled_edges.add((enrollment['enrollee'],
+                                    enrollment['enroller'], lo))
+                enrolled_edges.add((enrollment['enroller'],
+                                    enrollment['enrollee'], lo))
+
+            for (vmname, neigh, lower_dif) in pl.dif_graphs[dif].edges():
+                color = 'black'
+                if (vmname, neigh, lower_dif) in enrolled_edges:
+                    color = 'red'
+
+                edge = pydot.Edge(dif + vmname, dif + neigh,
+                                  label = lower_dif, color = color)
+                gvizg.add_edge(edge)
 
             i += 1
             if i == len(colors):
                 i = 0
 
-        gvizg.write_png('difs.png')
+        gvizg.write_png(file_name)
     except:
         print("Warning: pydot module not installed, cannot produce DIF "\
               "graphs images")
 
+
+def check_host_env(args):
+    which('ip')
+    which('tc')
+    which('qemu-system-x86_64')
+
+    subprocess.call(['chmod', '0400', 'buildroot/irati_rsa'])
+
+    if args.legacy:
+        ######################## Compile mac2ifname program ########################
+        try:
+            subprocess.call(['cc', '-Wall', '-o', 'mac2ifname', 'mac2ifname.c'])
+        except:
+            raise GenError('Cannot find a C compiler to compile mac2ifname program')
+
+
+def main():
+    args = argparser.parse_args()
+
+    if args.overlay:
+        args.overlay = os.path.abspath(args.overlay)
+        if not os.path.isdir(args.overlay):
+            args.overlay = None
+
+    try:
+        check_host_env(args)
+
+        env_dict = parse_env(args)
+
+        lines = None
+        # Possibly autogenerate ring topology
+        if args.ring != None and args.ring > 0:
+            print("Ignoring %s, generating ring topology" % (args.conf,))
+            lines = ring_conf_lines(args.ring)
+            fout = open('ring.conf', 'w')
+            fout.write(''.join(lines))
+            fout.close()
+            args.conf = 'ring.conf'
+
+        timings = dict()
+        start = time.time()
+        sc = parse(args, lines)
+        timings['parse'] = time.time() - start
+
+        if len(sc.vms) > 8:
+            print("You want to run a lot of nodes, so it's better if I give "
+                  "each node some time to boot (since the boot is CPU-intensive)")
+
+        start = time.time()
+        pl = plan(sc, args, env_dict)
+        timings['plan'] = time.time() - start
+
+        for dif in pl.dif_ordering:
+            for enrollment in pl.enrollments[dif]:
+                print('I am going to enroll %s to DIF %s against neighbor %s, through '\
+                        'lower DIF %s' % (enrollment['enrollee'], dif,
+                                          enrollment['enroller'],
+                                          enrollment['lower_dif']))
+
+        for host in range(len(pl.hosts)):
+            print('Host %d (%s): %d nodes' % (host + 1, pl.hosts[host],
+                    len([vm for vm in pl.vms.values() if vm['host'] == host])))
+        if len(pl.hosts):
+            print('%d L2 domains span several hosts' % len(pl.tunnels))
+
+        # Only rewrite the artifacts that changed since the previous run,
+        # and generate a script to push those changes to the running nodes
+        manifest = Manifest()
+        topology = topology_hash(pl)
+        topology_changed = manifest.topology != topology
+        manifest.topology = topology
+        old_enrollments = manifest.enrollments
+        manifest.enrollments = enrollment_plan(pl)
+        changed = write_artifacts(producers(pl), manifest = manifest,
+                                  jobs = args.jobs, timings = timings)
+        write_artifacts({'delta.sh': emit_delta_script(pl, changed,
+                                                       topology_changed,
+                                                       old_enrollments)})
+
+        start = time.time()
+        write_bundles(pl)
+        write_initrds(pl)
+        timings['bundles'] = time.time() - start
+
+        print('Generation times: parse %.3fs, plan %.3fs, configurations '\
+              '%.3fs, scripts %.3fs, bundles %.3fs'
+              % (timings['parse'], timings['plan'], timings['configurations'],
+                 timings['scripts'], timings['bundles']))
+
+        if args.graphviz:
+            emit_graphviz(pl)
+
+        if args.run:
+            import gen_run
+            try:
+                gen_run.run(pl, args.provision_jobs, args.enroll_jobs)
+            except gen_run.RunError as e:
+                raise GenError(str(e))
+
+    except GenError as e:
+        print(e)
+        quit(1)
+
+
+if __name__ == '__main__':
+    main()
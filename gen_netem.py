@@ -0,0 +1,297 @@
+#
+# Copyright (C) 2014-2017 Nextworks
+# Author: Vincenzo Maffione <v.maffione@nextworks.it>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Validation of the arguments of netem directives, without the need to
+# run tc. The grammar follows tc-netem(8) (and the option parser of
+# iproute2's q_netem.c, which accepts the options in any order):
+#
+#   NETEM := [ limit PACKETS ] [ DELAY ] [ LOSS ] [ CORRUPT ]
+#            [ DUPLICATION ] [ REORDERING ] [ RATE ] [ SLOT ] [ seed SEED ]
+#
+#   DELAY := delay TIME [ JITTER [ CORRELATION ]]
+#            [ distribution { normal | pareto | paretonormal | experimental } ]
+#   LOSS := loss { random PERCENT [ CORRELATION ] |
+#                  state p13 [ p31 [ p32 [ p23 [ p14 ]]]] |
+#                  gemodel p [ r [ 1-h [ 1-k ]]] } [ ecn ]
+#   CORRUPT := corrupt PERCENT [ CORRELATION ]
+#   DUPLICATION := duplicate PERCENT [ CORRELATION ]
+#   REORDERING := reorder PERCENT [ CORRELATION ] [ gap DISTANCE ]
+#       (reordering needs some delay, and a gap needs a reordering)
+#   RATE := rate RATE [ PACKETOVERHEAD [ CELLSIZE [ CELLOVERHEAD ]]]
+#   SLOT := slot { MIN_DELAY [ MAX_DELAY ] |
+#                  distribution DIST DELAY JITTER }
+#               [ packets PACKETS ] [ bytes BYTES ]
+#
+# The distributions are the tables shipped with tc (e.g. in
+# /usr/lib/tc), and ecn needs a loss model.
+
+import subprocess
+import re
+import os
+
+
+time_re = re.compile(r'(\d+\.?\d*|\.\d+)(s|sec|secs|ms|msec|msecs|'
+                     r'us|usec|usecs|ns|nsec|nsecs)?$')
+percent_re = re.compile(r'(\d+\.?\d*|\.\d+)%?$')
+rate_re = re.compile(r'(\d+\.?\d*|\.\d+)([kmgt]i?)?(bit|bps)?$', re.IGNORECASE)
+uint_re = re.compile(r'\d+$')
+int_re = re.compile(r'[-+]?\d+$')
+
+distributions = ['normal', 'pareto', 'paretonormal', 'experimental']
+
+
+class NetemSyntaxError(Exception):
+    pass
+
+
+class Tokens:
+
+    def __init__(self, netem_args):
+        self.tokens = netem_args.split()
+        self.i = 0
+
+    def more(self):
+        return self.i < len(self.tokens)
+
+    def next(self, what):
+        if not self.more():
+            raise NetemSyntaxError('missing %s' % what)
+        self.i += 1
+        return self.tokens[self.i - 1]
+
+    # Consume the next token only if it matches the regular expression
+    def next_if(self, regex):
+        if self.more() and regex.match(self.tokens[self.i]):
+            self.i += 1
+            return self.tokens[self.i - 1]
+        return None
+
+    def expect(self, regex, what):
+        t = self.next(what)
+        if not regex.match(t):
+            raise NetemSyntaxError('invalid %s "%s"' % (what, t))
+        return t
+
+
+def check_percent(t):
+    if float(percent_re.match(t).group(1)) > 100.0:
+        raise NetemSyntaxError('percentage "%s" out of range' % t)
+
+
+def parse_percent_corr(tk, what):
+    percent = tk.expect(percent_re, what)
+    check_percent(percent)
+    corr = tk.next_if(percent_re)
+    if corr != None:
+        check_percent(corr)
+    return float(percent_re.match(percent).group(1))
+
+
+def parse_limit(tk, st):
+    tk.expect(uint_re, 'limit')
+
+
+def parse_delay(tk, st):
+    st['latency'] = time_re.match(tk.expect(time_re, 'delay')).group(1)
+    jitter = tk.next_if(time_re)
+    if jitter != None:
+        st['jitter'] = time_re.match(jitter).group(1)
+        corr = tk.next_if(percent_re)
+        if corr != None:
+            check_percent(corr)
+
+
+def parse_distribution(tk, st):
+    dist = tk.next('distribution')
+    if dist not in distributions:
+        raise NetemSyntaxError('unknown distribution "%s"' % dist)
+    st['distribution'] = dist
+
+
+def parse_loss(tk, st):
+    if tk.next_if(re.compile('random$')):
+        st['loss'] = parse_percent_corr(tk, 'loss probability') != 0.0
+    elif tk.next_if(re.compile('state$')):
+        st['loss'] = True
+        check_percent(tk.expect(percent_re, 'p13'))
+        for i in range(4):
+            p = tk.next_if(percent_re)
+            if p == None:
+                break
+            check_percent(p)
+    elif tk.next_if(re.compile('gemodel$')):
+        st['loss'] = True
+        check_percent(tk.expect(percent_re, 'p'))
+        for i in range(3):
+            p = tk.next_if(percent_re)
+            if p == None:
+                break
+            check_percent(p)
+    else:
+        # Legacy syntax, 'random' is implied
+        st['loss'] = parse_percent_corr(tk, 'loss probability') != 0.0
+    if tk.next_if(re.compile('ecn$')):
+        st['ecn'] = True
+
+
+def parse_ecn(tk, st):
+    st['ecn'] = True
+
+
+def parse_corrupt(tk, st):
+    parse_percent_corr(tk, 'corruption probability')
+
+
+def parse_duplicate(tk, st):
+    parse_percent_corr(tk, 'duplication probability')
+
+
+def parse_reorder(tk, st):
+    st['reorder'] = parse_percent_corr(tk, 'reordering probability')
+
+
+def parse_gap(tk, st):
+    st['gap'] = int(tk.expect(uint_re, 'gap'))
+
+
+def parse_rate(tk, st):
+    tk.expect(rate_re, 'rate')
+    if tk.next_if(int_re) != None:            # packet overhead
+        if tk.next_if(uint_re) != None:       # cell size
+            tk.next_if(int_re)                # cell overhead
+
+
+def parse_slot(tk, st):
+    if tk.next_if(re.compile('distribution$')):
+        dist = tk.next('slot distribution')
+        if dist not in distributions:
+            raise NetemSyntaxError('unknown distribution "%s"' % dist)
+        tk.expect(time_re, 'slot delay')
+        tk.expect(time_re, 'slot jitter')
+    else:
+        tk.expect(time_re, 'slot minimum delay')
+        tk.next_if(time_re)
+    if tk.next_if(re.compile('packets$')):
+        tk.expect(uint_re, 'slot packets')
+    if tk.next_if(re.compile('bytes$')):
+        tk.expect(uint_re, 'slot bytes')
+
+
+def parse_seed(tk, st):
+    tk.expect(uint_re, 'seed')
+
+
+option_parsers = {
+    'limit': parse_limit,
+    'delay': parse_delay,
+    'latency': parse_delay,
+    'distribution': parse_distribution,
+    'loss': parse_loss,
+    'drop': parse_loss,
+    'ecn': parse_ecn,
+    'corrupt': parse_corrupt,
+    'duplicate': parse_duplicate,
+    'reorder': parse_reorder,
+    'gap': parse_gap,
+    'rate': parse_rate,
+    'slot': parse_slot,
+    'seed': parse_seed,
+}
+
+
+# Return None if the netem arguments are valid, or a string describing
+# the first error found otherwise
+def netem_check(netem_args):
+    tk = Tokens(netem_args)
+    st = dict()
+
+    try:
+        if not tk.more():
+            raise NetemSyntaxError('no netem options')
+
+        while tk.more():
+            option = tk.next('option')
+            if option not in option_parsers:
+                raise NetemSyntaxError('unknown option "%s"' % option)
+            option_parsers[option](tk, st)
+
+        nonzero = lambda t: t != None and float(t) != 0.0
+
+        if 'distribution' in st and not (nonzero(st.get('latency')) and
+                                         nonzero(st.get('jitter'))):
+            raise NetemSyntaxError('distribution specified but no latency '
+                                   'and jitter values')
+
+        if st.get('gap', 0) > 0 and not st.get('reorder'):
+            raise NetemSyntaxError('gap specified without reorder '
+                                   'probability')
+
+        if st.get('reorder') and not nonzero(st.get('latency')):
+            raise NetemSyntaxError('reordering not possible without '
+                                   'specifying some delay')
+
+        if st.get('ecn') and not st.get('loss'):
+            raise NetemSyntaxError('ecn requested without loss model')
+
+    except NetemSyntaxError as e:
+        return str(e)
+
+    return None
+
+
+# Check the netem arguments by trying to use them on a probe TAP
+# interface (requires root privileges)
+def netem_probe(netem_args):
+    ret = True
+
+    try:
+        fdevnull = open(os.devnull, 'w')
+        subprocess.check_call('sudo ip tuntap add mode tap name tapiratiprobe'.split())
+        subprocess.check_call(('sudo tc qdisc add dev '\
+                               'tapiratiprobe root netem %s'\
+                                % netem_args).split(), stdout=fdevnull,
+                                stderr=fdevnull)
+        fdevnull.close()
+    except:
+        ret = False
+
+    subprocess.call('sudo ip tuntap del mode tap name tapiratiprobe'.split())
+
+    return ret
+
+
+# Validation results, indexed by the (whitespace normalized) arguments
+validation_cache = dict()
+
+
+def netem_validate(netem_args, probe = False):
+    """Return None if the netem arguments are valid, or a string describing
+       why they are not. Arguments rejected by the offline validator are
+       checked again with tc if probe is True. Results are cached, so that
+       identical arguments are only validated once."""
+    key = (' '.join(netem_args.split()), probe)
+    if key in validation_cache:
+        return validation_cache[key]
+
+    err = netem_check(netem_args)
+    if err != None and probe and netem_probe(netem_args):
+        err = None
+
+    validation_cache[key] = err
+
+    return err
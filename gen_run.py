@@ -0,0 +1,182 @@
+#
+# Copyright (C) 2014-2017 Nextworks
+# Author: Vincenzo Maffione <v.maffione@nextworks.it>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Bring up a scenario directly from a gen.py Plan (gen.py --run), as an
+# alternative to the up.sh script. The same commands are used, but the
+# phases are pipelined: each VM is provisioned as soon as it is reachable,
+# and each enrollment starts as soon as the nodes involved are provisioned
+# and the enrollments it depends on (see gen.compute_enrollment_dag()) are
+# complete. Each phase has its own concurrency limit.
+#
+# Requires Python 3.7 or later.
+
+import asyncio
+import time
+
+import gen
+
+
+class RunError(Exception):
+    pass
+
+
+class Runner:
+
+    def __init__(self, pl, provision_jobs, enroll_jobs, retries = 5):
+        self.pl = pl
+        self.retries = retries
+        self.admission_lock = asyncio.Lock()
+        self.booting = []
+        self.provision_sem = asyncio.Semaphore(provision_jobs)
+        self.enroll_sem = asyncio.Semaphore(enroll_jobs)
+        self.start = time.time()
+
+        # Events signaled when a VM has been provisioned, and when an
+        # enrollment task of the plan has completed
+        self.provisioned = dict()
+        for vmname in pl.vms:
+            self.provisioned[vmname] = asyncio.Event()
+        self.enrolled = [asyncio.Event() for task in pl.enrollment_tasks]
+
+    def log(self, msg):
+        print('[%7.1fs] %s' % (time.time() - self.start, msg))
+
+    # Run a shell script, returning its exit code and its output
+    async def shell(self, script):
+        proc = await asyncio.create_subprocess_exec('bash', '-c', script,
+                                    stdin = asyncio.subprocess.DEVNULL,
+                                    stdout = asyncio.subprocess.PIPE,
+                                    stderr = asyncio.subprocess.STDOUT)
+        out, _ = await proc.communicate()
+        return proc.returncode, out.decode('utf-8', 'replace')
+
+    # Start a long-running shell command (e.g. QEMU) in the background,
+    # without waiting for it. Its output goes to the output of the runner,
+    # as with up.sh, since a pipe would be kept open by the command.
+    async def detach(self, script):
+        proc = await asyncio.create_subprocess_exec('bash', '-c',
+                                    script + ' &',
+                                    stdin = asyncio.subprocess.DEVNULL)
+        return await proc.wait()
+
+    # Run a shell script until it succeeds, backing off exponentially
+    # between the attempts
+    async def shell_retry(self, script, what, retries = None, delay = 0.25,
+                          max_delay = 4.0):
+        if retries == None:
+            retries = self.retries
+        for attempt in range(retries):
+            ret, out = await self.shell(script)
+            if ret == 0:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+        raise RunError('%s failed after %d attempts:\n%s'
+                       % (what, retries, out))
+
+    async def boot(self, vmname):
+        vm = self.pl.vms[vmname]
+
+        # VMs are admitted to boot one at a time, according to the host
+        # load and to the number of VMs still booting
+        async with self.admission_lock:
+            ret, out = await self.shell(gen.emit_boot_admission(self.pl,
+                                            vmname, ' '.join(self.booting)))
+            if ret != 0:
+                raise RunError('Boot admission of VM %s failed:\n%s'
+                               % (vmname, out))
+            self.booting = out.split()
+
+            ret = await self.detach(gen.emit_qemu(self.pl, vmname))
+            if ret != 0:
+                raise RunError('Failed to start VM %s' % vmname)
+            self.booting.append(gen.boot_spec(self.pl, vmname))
+            self.log('%s: started' % vmname)
+
+        for probe in [gen.emit_boot_probe(self.pl, vmname),
+                      gen.emit_ssh_probe(self.pl, vm)]:
+            ret, out = await self.shell(probe)
+            if ret != 0:
+                raise RunError('VM %s is not ready: %s'
+                               % (vmname, out.strip()))
+        self.log('%s: reachable' % vmname)
+
+        # The provisioning commands are retried by the script itself
+        async with self.provision_sem:
+            ret, out = await self.shell(gen.emit_provisioning(self.pl, vmname))
+            if ret != 0:
+                raise RunError('Provisioning of VM %s failed:\n%s'
+                               % (vmname, out))
+            self.log('%s: provisioned' % vmname)
+
+        self.provisioned[vmname].set()
+
+    async def enroll(self, task):
+        enrollee = task['enrollee']
+        enroller = task['enroller']
+
+        await self.provisioned[enrollee].wait()
+        await self.provisioned[enroller].wait()
+        for dep in task['depends']:
+            await self.enrolled[dep].wait()
+
+        async with self.enroll_sem:
+            await self.shell_retry(gen.emit_enroll_command(self.pl,
+                                                           task['dif'], task),
+                                   'Enrollment of %s to DIF %s against %s'
+                                   % (enrollee, task['dif'], enroller))
+            self.log('%s: enrolled to DIF %s against %s'
+                     % (enrollee, task['dif'], enroller))
+
+        self.enrolled[task['id']].set()
+
+    async def run(self):
+        ret, out = await self.shell(''.join(gen.up_network_chunks(self.pl)))
+        if ret != 0:
+            raise RunError('Failed to set up the host network:\n%s' % out)
+        self.log('host network ready')
+
+        # With --clone, the nodes are restored from the state of their
+        # template VMs, which must be saved first
+        ret, out = await self.shell(''.join(gen.template_chunks(self.pl)))
+        if ret != 0:
+            raise RunError('Failed to save the state of the template VMs:\n%s'
+                           % out)
+        if len(self.pl.templates):
+            self.log('template VMs saved')
+
+        tasks = [self.boot(vmname) for vmname in sorted(self.pl.vms)]
+
+        # Each enrollment only waits for the tasks it depends on in the
+        # enrollment DAG
+        for task in self.pl.enrollment_tasks:
+            tasks.append(self.enroll(task))
+
+        await asyncio.gather(*tasks)
+        self.log('scenario up')
+
+
+def run(pl, provision_jobs = 8, enroll_jobs = 8):
+    """Bring up the scenario described by the Plan pl, raising RunError
+       if any step fails"""
+
+    async def main():
+        runner = Runner(pl, provision_jobs, enroll_jobs)
+        await runner.run()
+
+    asyncio.run(main())
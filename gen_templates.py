@@ -16,6 +16,9 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
+import copy
+
+
 # Template for a IPCM configuration file
 ipcmconf_base = {
     "configFileVersion": "1.4.1",
@@ -347,3 +350,72 @@ def translate_policy(difconf, path, ps, parms):
     else:
         policy_translator[path](difconf, ps, parms)
 
+
+# Copy-on-write view of a DIF configuration. The base configuration is
+# shared among many nodes and never modified: the first time a policy
+# modifies a container (dict or list) through the view, only that
+# container and its ancestors are copied, while all the other containers
+# remain shared with the base. The resulting configuration is available
+# as the 'data' attribute of the CowConf object.
+class CowView:
+
+    def __init__(self, root, parent, key):
+        self.root = root
+        self.parent = parent
+        self.key = key
+
+    def _get(self):
+        return self.parent._get()[self.key]
+
+    def _own(self):
+        d = self._get()
+        if id(d) in self.root.owned:
+            return d
+        d = copy.copy(d)
+        self.root.owned.add(id(d))
+        self.parent._own()[self.key] = d
+        return d
+
+    def __getitem__(self, k):
+        v = self._get()[k]
+        if isinstance(v, (dict, list)):
+            return CowView(self.root, self, k)
+        return v
+
+    def __setitem__(self, k, v):
+        self._own()[k] = v
+
+    def __delitem__(self, k):
+        del self._own()[k]
+
+    def __contains__(self, k):
+        return k in self._get()
+
+    def __len__(self):
+        return len(self._get())
+
+    def __iter__(self):
+        d = self._get()
+        if isinstance(d, dict):
+            return iter(list(d))
+        return iter([self[i] for i in range(len(d))])
+
+    def append(self, v):
+        self._own().append(v)
+
+
+class CowConf(CowView):
+
+    def __init__(self, base):
+        CowView.__init__(self, self, None, None)
+        self.data = base
+        self.owned = set()
+
+    def _get(self):
+        return self.data
+
+    def _own(self):
+        if id(self.data) not in self.owned:
+            self.data = copy.copy(self.data)
+            self.owned.add(id(self.data))
+        return self.data
@@ -0,0 +1,176 @@
+#
+# Author: Vincenzo Maffione <v.maffione@nextworks.it>
+#
+
+# Client for the IPCM console, the UNIX socket where IPCM accepts
+# commands (e.g. "list-ipcps", "enroll-to-dif"). The console sends a banner
+# when a client connects, and the "IPCM >>>" prompt at the end of each
+# response.
+
+import socket
+import stat
+import json
+import time
+import re
+import os
+
+
+prompt = b'IPCM >>>'
+
+
+class ConsoleError(Exception):
+    pass
+
+
+# IPCM did not answer in time (e.g. because it hung or crashed)
+class ConsoleTimeout(ConsoleError):
+    pass
+
+
+# Return the path of the console socket from an IPCM configuration file
+def console_path(ipcm_conf):
+    fin = open(ipcm_conf, 'r')
+    text = fin.read()
+    fin.close()
+
+    try:
+        return json.loads(text)['localConfiguration']['consoleSocket']
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    m = re.search(r'"(\S+ipcm-console.sock)', text)
+    if m == None:
+        raise ConsoleError('Cannot find the console socket in %s' % ipcm_conf)
+
+    return m.group(1)
+
+
+# Parse the output of the list-ipcps command, e.g.
+#
+#   Current IPC processes (id | name | type | state | ...)
+#       1 | a.300:1:: | shim-eth-vlan | ASSIGNED TO DIF 300 | ...
+#
+# into a list of dictionaries with the id, the (full) name, the
+# application process name, the type and the state of each IPCP
+def parse_ipcps(lines):
+    ipcps = []
+    for line in lines:
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) < 4 or not fields[0].isdigit():
+            continue
+        ipcps.append({'id': int(fields[0]), 'name': fields[1],
+                      'apname': fields[1].split(':')[0],
+                      'type': fields[2], 'state': fields[3]})
+    return ipcps
+
+
+# IPCM replies to enroll-to-dif with "DIF enrollment succesfully completed
+# in N ms" (sic) once the enrollment is complete, or else with a failure
+# (e.g. "Enrollment operation failed", "No such IPC process id", or the
+# usage of the command), so any other reply is a failure
+enrolled_re = re.compile(r'\s*DIF enrollment succ?ess?fully completed')
+
+
+# Return whether the response to enroll-to-dif reports a completed
+# enrollment
+def enrollment_completed(lines):
+    return any(enrolled_re.match(line) for line in lines)
+
+
+class Console:
+
+    def __init__(self, path, timeout = 30, response_timeout = 60):
+        """Connect to the console socket at path, waiting up to timeout
+           seconds for IPCM to create it, and receive the banner. Each
+           response must be received within response_timeout seconds, or
+           else a ConsoleTimeout is raised."""
+        self.path = path
+        self.response_timeout = response_timeout
+        self.partial = bytes()
+        self.ipcps = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        deadline = time.time() + timeout
+        delay = 0.05
+        while True:
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    self.sock.connect(path)
+                    break
+            except (OSError, socket.error):
+                pass
+            if time.time() + delay > deadline:
+                self.sock.close()
+                raise ConsoleError('IPCM console "%s" not available after %d '
+                                   'seconds (is ipcm running?)'
+                                   % (path, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        self.banner = self.response()
+
+    def close(self):
+        self.sock.close()
+
+    def response(self):
+        """Receive a response, returning its lines (without the prompt)"""
+        lines = []
+        deadline = time.time() + self.response_timeout
+        while True:
+            try:
+                self.sock.settimeout(max(deadline - time.time(), 0.001))
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                raise ConsoleTimeout('No response from the IPCM console "%s" '
+                                     'after %s seconds'
+                                     % (self.path, self.response_timeout))
+            if not chunk:
+                raise ConsoleError('IPCM console closed the connection')
+
+            # Only the new data is split into lines, the incomplete last
+            # line is kept aside until the rest of it is received
+            data = self.partial + chunk
+            complete = data.split(b'\n')
+            self.partial = complete.pop()
+            lines.extend([l.decode('utf-8', 'replace') for l in complete])
+
+            if prompt in self.partial:
+                self.partial = bytes()
+                return lines
+
+    def command(self, cmd):
+        """Run a command, returning the lines of the response and the
+           command latency in seconds"""
+        start = time.time()
+        self.sock.sendall((cmd + '\n').encode('ascii'))
+        lines = self.response()
+        return lines, time.time() - start
+
+    def list_ipcps(self, refresh = False):
+        """Return the parsed list-ipcps table, cached after the first call"""
+        if self.ipcps == None or refresh:
+            lines, latency = self.command('list-ipcps')
+            self.ipcps = parse_ipcps(lines)
+        return self.ipcps
+
+    def ipcp_id(self, name):
+        """Return the id of the IPCP with the given application process
+           name (or full name), or None"""
+        for refresh in [False, True]:
+            for ipcp in self.list_ipcps(refresh):
+                if name in [ipcp['apname'], ipcp['name']]:
+                    return ipcp['id']
+        return None
+
+    def enroll(self, enrollee, dif, lower_dif, enroller):
+        """Enroll the IPCP named enrollee to a DIF, through a lower DIF,
+           against the neighbor IPCP named enroller. Return whether the
+           enrollment succeeded, the response lines and the latency."""
+        ipcp_id = self.ipcp_id(enrollee)
+        if ipcp_id == None:
+            return False, ['Could not find the ID of enrollee IPCP %s'
+                           % enrollee], 0.0
+
+        lines, latency = self.command('enroll-to-dif %d %s %s %s 1'
+                                      % (ipcp_id, dif, lower_dif, enroller))
+        return enrollment_completed(lines), lines, latency
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+#
+# Merge the shared IPCP addresses file of a DIF (see the --shared-addresses
+# option of gen.py) into the normal DIF templates specified on the command
+# line. Must run on the node before IPCM is started.
+#
+
+import argparse
+import json
+
+
+description = "Python script to merge DIF address maps into DIF templates"
+
+argparser = argparse.ArgumentParser(description = description)
+argparser.add_argument('templates', help = "Normal DIF template files",
+                       type = str, nargs = '+')
+args = argparser.parse_args()
+
+addresses = dict()
+
+for template in args.templates:
+    fin = open(template, 'r')
+    difconf = json.load(fin)
+    fin.close()
+
+    if "knownIPCProcessAddressesFile" not in difconf:
+        continue
+
+    addresses_file = difconf.pop("knownIPCProcessAddressesFile")
+    if addresses_file not in addresses:
+        fin = open(addresses_file, 'r')
+        addresses[addresses_file] = json.load(fin)
+        fin.close()
+
+    difconf["knownIPCProcessAddresses"] = addresses[addresses_file]
+
+    fout = open(template, 'w')
+    fout.write(json.dumps(difconf, indent = 4, sort_keys = True))
+    fout.close()
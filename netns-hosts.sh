@@ -0,0 +1,62 @@
+#!/bin/bash
+
+# Emulate the hosts of a multi-host scenario (see the --hosts option of
+# gen.py) on this machine, with a network namespace for each host. The
+# namespaces are connected to a bridge of this machine, with the addresses
+# 10.255.0.N (10.255.0.254 for this machine), so that the tunnels and the
+# forwarded SSH ports of the nodes work as with separate hosts:
+#
+#   $ ./netns-hosts.sh up 3
+#   $ ./gen.py --hosts $(./netns-hosts.sh list 3)
+#   $ sudo ip netns exec rina-host1 ./up.host1.sh    (and so on)
+#   $ ./enroll.sh
+#   $ sudo ip netns exec rina-host1 ./down.host1.sh  (and so on)
+#   $ ./netns-hosts.sh down 3
+
+ACTION=$1
+NUM_HOSTS=$2
+if [ "$NUM_HOSTS" == "" ] || ! [ "$NUM_HOSTS" -ge 1 -a "$NUM_HOSTS" -le 250 ] 2> /dev/null; then
+	echo "usage: $0 up|down|list NUM_HOSTS"
+	exit 255
+fi
+
+PREFIX=${NETNS_PREFIX:-rina-host}
+BRIDGE=${PREFIX}s
+SUBNET=10.255.0
+
+SUDO=sudo
+if [ "$(id -u)" == "0" ]; then
+	SUDO=""
+fi
+
+case "$ACTION" in
+up)
+	set -e
+	$SUDO ip link add $BRIDGE type bridge
+	$SUDO ip addr add $SUBNET.254/24 dev $BRIDGE
+	$SUDO ip link set $BRIDGE up
+	for N in $(seq 1 $NUM_HOSTS); do
+		$SUDO ip netns add $PREFIX$N
+		$SUDO ip link add $PREFIX$N type veth peer name eth0 netns $PREFIX$N
+		$SUDO ip link set $PREFIX$N master $BRIDGE up
+		$SUDO ip -n $PREFIX$N link set lo up
+		$SUDO ip -n $PREFIX$N addr add $SUBNET.$N/24 dev eth0
+		$SUDO ip -n $PREFIX$N link set eth0 up
+	done
+	;;
+down)
+	for N in $(seq 1 $NUM_HOSTS); do
+		# The interfaces of a namespace are removed asynchronously
+		$SUDO ip link del $PREFIX$N
+		$SUDO ip netns del $PREFIX$N
+	done
+	$SUDO ip link del $BRIDGE
+	;;
+list)
+	seq -s , -f "$SUBNET.%g" 1 $NUM_HOSTS
+	;;
+*)
+	echo "usage: $0 up|down|list NUM_HOSTS"
+	exit 255
+	;;
+esac
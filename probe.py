@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+#
+# Copyright (C) 2014-2017 Nextworks
+# Author: Vincenzo Maffione <v.maffione@nextworks.it>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Readiness probes for the nodes of a scenario, used by up.sh (and by
+# gen.py --run) in place of fixed delays:
+#
+#   probe.py serial SOCKET LOGFILE   wait for the boot marker on the serial
+#                                    console of a VM, exported by QEMU on a
+#                                    unix socket (and logged to LOGFILE)
+#   probe.py ssh PORT                wait for the SSH server of a VM to send
+#                                    its banner on the forwarded PORT
+#   probe.py admit VM [BOOTING ...]  wait until the host can afford to boot
+#                                    another VM, given the VMs still booting
+#                                    (serial log files, or forwarded SSH
+#                                    ports for legacy VMs), and print those
+#                                    still booting
+#   probe.py snapshot QMP STATE      save the state of a booted (template)
+#                                    VM to the STATE file, through the QMP
+#                                    socket of QEMU, and terminate the VM
+#
+# Each probe fails with a non-zero exit status and an explanation if the
+# node is not ready within the timeout.
+#
+
+import multiprocessing
+import argparse
+import select
+import socket
+import json
+import time
+import os
+
+
+class ProbeError(Exception):
+    pass
+
+
+def wait_serial(socket_path, log_path, marker, timeout):
+    deadline = time.time() + timeout
+    marker = marker.encode('ascii')
+
+    # Connect first, so that no output is lost between the check of the
+    # log file and the connection
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    delay = 0.05
+    while True:
+        try:
+            s.connect(socket_path)
+            break
+        except socket.error:
+            if time.time() + delay > deadline:
+                s.close()
+                raise ProbeError('Serial console socket %s not available '
+                                 'after %d seconds (is QEMU running?)'
+                                 % (socket_path, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    try:
+        # The marker may have been printed before we connected
+        data = bytes()
+        if os.path.exists(log_path):
+            fin = open(log_path, 'rb')
+            data = fin.read()
+            fin.close()
+            if marker in data:
+                return
+        data = data[-len(marker):]
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ProbeError('Boot marker "%s" not seen on %s within %d '
+                                 'seconds' % (marker.decode('ascii'),
+                                              socket_path, timeout))
+            ready, _, _ = select.select([s], [], [], remaining)
+            if not ready:
+                continue
+            chunk = s.recv(4096)
+            if not chunk:
+                raise ProbeError('Serial console %s closed before the boot '
+                                 'marker "%s" was seen (did QEMU exit?)'
+                                 % (socket_path, marker.decode('ascii')))
+            # Keep a tail of the previous chunk, for markers across chunks
+            data = data[-len(marker):] + chunk
+            if marker in data:
+                return
+    finally:
+        s.close()
+
+
+def wait_ssh(port, timeout, host = 'localhost'):
+    deadline = time.time() + timeout
+    delay = 0.1
+    reason = 'no connection'
+
+    # The port forwarded by QEMU accepts connections even before the guest
+    # SSH server is up, so wait for its banner
+    while True:
+        s = None
+        try:
+            s = socket.create_connection((host, port),
+                                         max(deadline - time.time(), 0.1))
+            s.settimeout(max(min(5.0, deadline - time.time()), 0.1))
+            banner = s.recv(256)
+            if banner.startswith(b'SSH-'):
+                return
+            reason = 'unexpected banner %r' % banner[:32] if banner \
+                        else 'connection closed without banner'
+        except (socket.error, socket.timeout) as e:
+            reason = str(e)
+        finally:
+            if s != None:
+                s.close()
+
+        if time.time() + delay > deadline:
+            raise ProbeError('SSH server on %s:%d not ready after %d seconds '
+                             '(%s)' % (host, port, timeout, reason))
+        time.sleep(delay)
+        delay = min(delay * 2, 4.0)
+
+
+# Run a QMP command, returning its result (asynchronous events are skipped)
+def qmp_command(f, command, arguments = None):
+    request = {'execute': command}
+    if arguments != None:
+        request['arguments'] = arguments
+    f.write(json.dumps(request) + '\n')
+    f.flush()
+
+    while True:
+        line = f.readline()
+        if not line:
+            raise ProbeError('QMP connection closed during "%s"' % command)
+        response = json.loads(line)
+        if 'error' in response:
+            raise ProbeError('QMP command "%s" failed: %s'
+                             % (command, response['error'].get('desc')))
+        if 'return' in response:
+            return response['return']
+
+
+# Stop a VM and migrate its state to a file. The state is written to a
+# temporary file first, so that an incomplete state is never used.
+def save_snapshot(qmp_path, state_path, timeout):
+    deadline = time.time() + timeout
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    delay = 0.05
+    while True:
+        try:
+            s.connect(qmp_path)
+            break
+        except socket.error:
+            if time.time() + delay > deadline:
+                s.close()
+                raise ProbeError('QMP socket %s not available after %d '
+                                 'seconds (is QEMU running?)'
+                                 % (qmp_path, timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    s.settimeout(timeout)
+    f = s.makefile('rw')
+    tmp_path = state_path + '.tmp'
+    try:
+        f.readline()    # greeting
+        qmp_command(f, 'qmp_capabilities')
+        qmp_command(f, 'stop')
+        qmp_command(f, 'migrate', {'uri': 'exec:cat > %s' % tmp_path})
+
+        while True:
+            status = qmp_command(f, 'query-migrate').get('status')
+            if status == 'completed':
+                break
+            if status in ['failed', 'cancelled']:
+                raise ProbeError('Migration of the VM state to %s %s'
+                                 % (tmp_path, status))
+            if time.time() > deadline:
+                raise ProbeError('VM state not saved to %s within %d seconds'
+                                 % (state_path, timeout))
+            time.sleep(0.1)
+
+        os.rename(tmp_path, state_path)
+        try:
+            qmp_command(f, 'quit')
+        except (ProbeError, socket.error):
+            pass
+    except (socket.error, socket.timeout, ValueError) as e:
+        raise ProbeError('QMP error on %s: %s' % (qmp_path, e))
+    finally:
+        f.close()
+        s.close()
+
+
+# Return whether a VM has finished booting: spec is either the serial log
+# file of the VM or, for legacy VMs, the port forwarded to its SSH server
+def booted(spec, marker):
+    if spec.isdigit():
+        try:
+            s = socket.create_connection(('localhost', int(spec)), 1.0)
+            s.settimeout(1.0)
+            try:
+                return s.recv(256).startswith(b'SSH-')
+            finally:
+                s.close()
+        except (socket.error, socket.timeout):
+            return False
+
+    try:
+        fin = open(spec, 'rb')
+        data = fin.read()
+        fin.close()
+    except IOError:
+        return False
+
+    return marker.encode('ascii') in data
+
+
+# Return the "some avg10" value of a pressure stall information file, or
+# None if PSI is not available
+def pressure(resource):
+    try:
+        fin = open('/proc/pressure/%s' % resource, 'r')
+        lines = fin.readlines()
+        fin.close()
+    except IOError:
+        return None
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) and fields[0] == 'some':
+            for field in fields[1:]:
+                if field.startswith('avg10='):
+                    return float(field[len('avg10='):])
+    return None
+
+
+def host_state():
+    state = {'load': None, 'cpu': pressure('cpu'),
+             'memory': pressure('memory'), 'memavail': None}
+
+    try:
+        fin = open('/proc/loadavg', 'r')
+        state['load'] = float(fin.read().split()[0]) / multiprocessing.cpu_count()
+        fin.close()
+    except IOError:
+        pass
+
+    try:
+        fin = open('/proc/meminfo', 'r')
+        for line in fin:
+            if line.startswith('MemAvailable:'):
+                state['memavail'] = int(line.split()[1]) // 1024
+                break
+        fin.close()
+    except IOError:
+        pass
+
+    return state
+
+
+# Return the reason why a new VM cannot be admitted, or None
+def admission_blocker(booting, state, args):
+    if len(booting) >= args.ceiling:
+        return '%d VMs booting' % len(booting)
+
+    # Admit a VM anyway if no other one is booting, to make progress
+    if len(booting) == 0:
+        return None
+
+    if state['load'] != None and state['load'] > args.max_load:
+        return 'load %.2f per CPU' % state['load']
+    if state['cpu'] != None and state['cpu'] > args.max_cpu_pressure:
+        return 'CPU pressure %.1f%%' % state['cpu']
+    if state['memory'] != None and state['memory'] > args.max_memory_pressure:
+        return 'memory pressure %.1f%%' % state['memory']
+    if state['memavail'] != None and state['memavail'] < args.min_memory:
+        return '%d MB of memory available' % state['memavail']
+
+    return None
+
+
+def admit(vmname, booting, args):
+    start = time.time()
+    reason = None
+
+    while True:
+        booting = [spec for spec in booting if not booted(spec, args.marker)]
+        state = host_state()
+        blocker = admission_blocker(booting, state, args)
+        if blocker == None:
+            decision = 'admit'
+            break
+        reason = blocker
+        if time.time() - start > args.timeout:
+            decision = 'admit (timeout)'
+            break
+        time.sleep(0.5)
+
+    if args.record:
+        fmt = lambda v, f: f % v if v != None else '-'
+        fout = open(args.record, 'a')
+        fout.write('%.1f %s %s booting=%d load=%s cpu=%s memory=%s '
+                   'memavail=%s waited=%.1fs%s\n'
+                   % (time.time(), vmname, decision, len(booting),
+                      fmt(state['load'], '%.2f'), fmt(state['cpu'], '%.1f'),
+                      fmt(state['memory'], '%.1f'),
+                      fmt(state['memavail'], '%d'), time.time() - start,
+                      ' (%s)' % reason if reason else ''))
+        fout.close()
+
+    return booting
+
+
+description = "Python script to wait for the nodes of a scenario to be ready"
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description = description)
+    subparsers = argparser.add_subparsers(dest = 'probe')
+    p = subparsers.add_parser('serial', help = "Wait for a VM to boot")
+    p.add_argument('socket', help = "Serial console unix socket", type = str)
+    p.add_argument('log', help = "Serial console log file", type = str)
+    p.add_argument('--marker', help = "String printed at the end of the boot",
+                   type = str, default = 'login:')
+    p.add_argument('--timeout', help = "Timeout in seconds", type = int,
+                   default = 300)
+    p = subparsers.add_parser('ssh', help = "Wait for a VM SSH server")
+    p.add_argument('port', help = "Forwarded SSH port", type = int)
+    p.add_argument('--host', help = "Host forwarding the SSH port",
+                   type = str, default = 'localhost')
+    p.add_argument('--timeout', help = "Timeout in seconds", type = int,
+                   default = 120)
+    p = subparsers.add_parser('snapshot', help = "Save the state of a VM")
+    p.add_argument('qmp', help = "QMP unix socket", type = str)
+    p.add_argument('state', help = "File to save the VM state to", type = str)
+    p.add_argument('--timeout', help = "Timeout in seconds", type = int,
+                   default = 120)
+    p = subparsers.add_parser('admit', help = "Wait for a VM to be allowed "
+                              "to boot")
+    p.add_argument('vm', help = "Name of the VM to boot", type = str)
+    p.add_argument('booting', help = "Serial log files (or SSH ports) of "
+                   "the VMs which may still be booting", type = str,
+                   nargs = '*')
+    p.add_argument('--marker', help = "String printed at the end of the boot",
+                   type = str, default = 'login:')
+    p.add_argument('--ceiling', help = "Maximum number of VMs booting",
+                   type = int, default = 1)
+    p.add_argument('--max-load', help = "Maximum 1-minute load average per "
+                   "CPU", type = float, default = 1.0)
+    p.add_argument('--max-cpu-pressure', help = "Maximum CPU pressure "
+                   "(some avg10, in %%)", type = float, default = 50.0)
+    p.add_argument('--max-memory-pressure', help = "Maximum memory pressure "
+                   "(some avg10, in %%)", type = float, default = 10.0)
+    p.add_argument('--min-memory', help = "Minimum available memory (MB)",
+                   type = int, default = 0)
+    p.add_argument('--timeout', help = "Admit the VM anyway after this "
+                   "number of seconds", type = int, default = 600)
+    p.add_argument('--record', help = "Append the admission decision to "
+                   "this file", type = str)
+    args = argparser.parse_args()
+
+    try:
+        if args.probe == 'serial':
+            wait_serial(args.socket, args.log, args.marker, args.timeout)
+        elif args.probe == 'ssh':
+            wait_ssh(args.port, args.timeout, args.host)
+        elif args.probe == 'snapshot':
+            save_snapshot(args.qmp, args.state, args.timeout)
+        elif args.probe == 'admit':
+            print(' '.join(admit(args.vm, args.booting, args)))
+        else:
+            argparser.error('missing probe type')
+    except ProbeError as e:
+        print(e)
+        quit(1)
@@ -0,0 +1,30 @@
+#
+# Common setup of the tests, which import gen.py and the other modules of
+# the repository. Run from the repository root:
+#
+#   $ python -m pytest tests
+#
+
+import sys
+import os
+
+import pytest
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+import gen
+
+
+@pytest.fixture
+def make_plan(monkeypatch):
+    """Return a function computing the Plan of a scenario, given its
+       configuration file (relative to the repository root) and the
+       options of gen.py. The configuration lines can also be passed
+       directly, in place of the file content."""
+    def make(conf, opts = [], lines = None):
+        # Overlay and image paths are relative to the working directory
+        monkeypatch.chdir(root)
+        args = gen.argparser.parse_args(['-c', conf] + opts)
+        return gen.plan(gen.parse(args, lines), args, gen.parse_env(args))
+
+    return make
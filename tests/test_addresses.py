@@ -0,0 +1,103 @@
+#
+# Tests for the allocation of the addresses of the IPCPs of the normal
+# DIFs, with the flat and the hierarchical schemes.
+#
+
+import json
+import os
+
+import pytest
+
+from conftest import root
+import gen_templates
+import gen
+
+
+def seven_lines(extra = []):
+    return open(os.path.join(root, 'examples/seven.conf')).readlines() + extra
+
+
+def is_connected(graph, members):
+    members = set(members)
+    reached = [min(members)]
+    for cur in reached:
+        for (neigh, lower_dif) in graph.neighbors(cur):
+            if neigh in members and neigh not in reached:
+                reached.append(neigh)
+    return len(reached) == len(members)
+
+
+def test_flat_addresses(make_plan):
+    pl = make_plan('seven.conf', [], seven_lines())
+    addressing = pl.addressing['n1']
+    assert addressing['scheme'] == 'flat'
+    assert addressing['prefixes'] == None
+    assert addressing['addresses'] == \
+           dict([(vmname, (16 + pl.vms[vmname]['id'], None))
+                 for vmname in pl.scenario.difs['n1']])
+
+    # The prefixes of the template are kept
+    difconf = json.loads(gen.emit(pl)['normal.n1.dif'])
+    assert difconf['addressPrefixes'] == \
+           gen_templates.normal_dif_base['addressPrefixes']
+
+
+def test_hierarchical_addresses(make_plan):
+    pl = make_plan('ring.conf', ['--addressing', 'hierarchical'],
+                   gen.ring_conf_lines(100))
+    graph = pl.dif_graphs['n']
+    addressing = pl.addressing['n']
+    addresses = addressing['addresses']
+    prefixes = addressing['prefixes']
+    assert addressing['scheme'] == 'hierarchical'
+
+    # Regions of about sqrt(N) neighboring nodes, each one with its prefix.
+    # As with the flat scheme, the addresses below 16 are not used.
+    assert sorted(addresses) == sorted(graph)
+    assert len(set(addresses.values())) == len(addresses)
+    assert len(prefixes) == 10
+    for number, prefix in enumerate(prefixes, 1):
+        members = [vmname for vmname in addresses
+                   if addresses[vmname][1] == number]
+        assert 1 <= len(members) <= 10
+        assert is_connected(graph, members)
+        assert prefix['organization'] == 'region-%d' % number
+        assert prefix['addressPrefix'] >= 16
+        for vmname in members:
+            address = addresses[vmname][0]
+            assert address & ~15 == prefix['addressPrefix']
+            assert address & 15 != 0
+
+    difconf = json.loads(gen.emit(pl)['normal.n.dif'])
+    assert difconf['addressPrefixes'] == prefixes
+    assert sorted([(entry['apName'], entry['address'])
+                   for entry in difconf['knownIPCProcessAddresses']]) == \
+           sorted([('%s.n' % vmname, addresses[vmname][0])
+                   for vmname in addresses])
+
+
+def test_addressing_directive(make_plan):
+    lines = seven_lines(['addressing n1 hierarchical\n',
+                         'addressing n9 hierarchical\n'])
+    pl = make_plan('seven.conf', [], lines)
+    assert pl.addressing['n1']['scheme'] == 'hierarchical'
+
+    # The directive overrides the --addressing option
+    lines[-2] = 'addressing n1 flat\n'
+    pl = make_plan('seven.conf', ['--addressing', 'hierarchical'], lines)
+    assert pl.addressing['n1']['scheme'] == 'flat'
+
+    with pytest.raises(gen.GenError) as e:
+        make_plan('seven.conf', [], seven_lines(['addressing n1 random\n']))
+    assert 'invalid addressing directive' in str(e.value)
+
+
+def test_addresses_overflow(make_plan, monkeypatch):
+    monkeypatch.setitem(gen_templates.normal_dif_base['dataTransferConstants'],
+                        'addressLength', 1)
+    make_plan('ring.conf', [], gen.ring_conf_lines(200))
+
+    for opts in [[], ['--addressing', 'hierarchical']]:
+        with pytest.raises(gen.GenError) as e:
+            make_plan('ring.conf', opts, gen.ring_conf_lines(300))
+        assert 'addresses of DIF n do not fit in 1 bytes' in str(e.value)
@@ -0,0 +1,71 @@
+#
+# Tests for the in-process use of gen.py: the parse(), plan() and emit()
+# stages, and the errors they report.
+#
+
+import os
+
+import pytest
+
+import gen
+
+
+def compile_conf(make_plan, conf, opts = []):
+    return gen.emit(make_plan(conf, opts))
+
+
+def test_stages(make_plan, tmp_path):
+    pl = make_plan('examples/seven.conf')
+    assert isinstance(pl.scenario, gen.Scenario)
+    assert sorted(pl.vms) == sorted(pl.scenario.vms)
+
+    # The artifacts streamed to disk are the same as the ones built in
+    # memory
+    artifacts = gen.emit(pl)
+    written = gen.write_artifacts(gen.producers(pl), str(tmp_path))
+    assert sorted(written) == sorted(artifacts)
+    for name in artifacts:
+        assert (tmp_path / name).read_text() == artifacts[name]
+        assert os.access(str(tmp_path / name), os.X_OK) == \
+               name.endswith('.sh')
+
+
+def test_compilations_are_independent(make_plan):
+    # Compiling other scenarios (with policies, and with the manager) in
+    # the same process does not change the result
+    first = compile_conf(make_plan, 'examples/seven.conf')
+    compile_conf(make_plan, 'examples/isp-sec.conf', ['--manager'])
+    compile_conf(make_plan, 'examples/secure-two-layers.conf')
+    assert compile_conf(make_plan, 'examples/seven.conf') == first
+
+
+def test_plan_can_be_modified(make_plan):
+    pl = make_plan('examples/seven.conf')
+    pl.vms['a']['smp'] = 4
+
+    up = gen.emit(pl)['up.sh']
+    qemus = [line for line in up.split('\n')
+             if line.startswith('qemu-system-x86_64')]
+    assert len(qemus) == len(pl.vms)
+    for line in qemus:
+        assert (' -smp 4 ' in line) == ('-pidfile rina-%d.pid ' %
+                                        pl.vms['a']['id'] in line)
+
+
+def test_errors(make_plan, tmp_path):
+    with pytest.raises(gen.GenError) as e:
+        make_plan('examples/no-such.conf')
+    assert str(e.value) == 'Error: examples/no-such.conf not found'
+
+    conf = tmp_path / 'latin1.conf'
+    conf.write_bytes(b'eth 300 0Mbps a b\n# caf\xe9\n')
+    with pytest.raises(gen.GenError) as e:
+        make_plan(str(conf))
+    assert str(e.value).endswith('is not ASCII encoded')
+
+    # DIFs stacked on each other
+    with pytest.raises(gen.GenError) as e:
+        make_plan('loop.conf', [], ['eth 300 0Mbps a b\n',
+                                    'dif n1 a 300 n2\n', 'dif n1 b 300\n',
+                                    'dif n2 a n1\n', 'dif n2 b n1\n'])
+    assert 'circular dependencies' in str(e.value)
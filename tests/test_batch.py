@@ -0,0 +1,88 @@
+#
+# Tests for the ip and tc batch files of the host network, and for the
+# run_batch shell function applying them, with fake sudo and ip commands.
+#
+
+import subprocess
+import os
+
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+# Fail the commands on the given lines of the batch file, like ip -force
+fake_ip = '''#!/bin/bash
+[ "$1" = -force ] && [ "$2" = -batch ] || exit 2
+N=0 FAILED=0
+while read -r LINE; do
+    N=$((N + 1))
+    case " $FAILING " in
+    *" $N "*)
+        echo "RTNETLINK answers: File exists" >&2
+        echo "Command failed $3:$N" >&2
+        FAILED=1
+    esac
+done < "$3"
+exit $FAILED
+'''
+
+
+def run_batch(tmp_path, batch, failing):
+    bindir = tmp_path / 'bin'
+    os.makedirs(str(bindir))
+    for name, text in [('sudo', '#!/bin/sh\nexec "$@"\n'), ('ip', fake_ip)]:
+        (bindir / name).write_text(text)
+        os.chmod(str(bindir / name), 0o755)
+    (tmp_path / 'up.ip.batch').write_text(batch)
+
+    script = gen.run_batch_function + 'run_batch ip up.ip.batch\n'\
+                                      'echo "status $?"\n'
+    env = dict(os.environ, PATH = '%s:%s' % (bindir, os.environ['PATH']),
+               FAILING = ' '.join(map(str, failing)))
+    return subprocess.run(['bash', '-c', script], cwd = str(tmp_path),
+                          env = env, stdout = subprocess.PIPE,
+                          stderr = subprocess.STDOUT,
+                          universal_newlines = True).stdout
+
+
+def test_batch_chunks(make_plan):
+    pl = make_plan(conf)
+    commands = list(gen.up_network_commands(pl))
+    artifacts = gen.emit(pl)
+
+    # Each command is followed by the scenario line it comes from
+    for tool in ['ip', 'tc']:
+        assert artifacts[gen.batch_name('up', None, tool)] == \
+               ''.join(['%s # %s\n' % (cmd, origin)
+                        for (t, cmd, origin) in commands if t == tool])
+    tap = pl.vms['a']['ports'][0]['tap']
+    assert 'tuntap add mode tap name %s # %s:9 (eth 300)\n' % (tap, conf) \
+                in artifacts['up.ip.batch']
+
+    assert gen.batch_name('down', 1, 'ip') == 'down.host2.ip.batch'
+    pl = make_plan(conf, ['--hosts', '10.0.0.1,10.0.0.2'])
+    assert sorted([name for name in gen.emit(pl) if name.endswith('.batch')
+                   and name.startswith('up.')]) == \
+           ['up.host1.ip.batch', 'up.host1.tc.batch',
+            'up.host2.ip.batch', 'up.host2.tc.batch']
+
+
+def test_run_batch(make_plan, tmp_path):
+    batch = gen.emit(make_plan(conf))['up.ip.batch']
+    origins = [line.split(' # ')[1] for line in batch.split('\n')[:-1]]
+
+    # The failed commands are shown with their origin, and the rest of the
+    # batch is applied
+    out = run_batch(tmp_path, batch, [2, 7])
+    assert out.split('\n') == [
+        'RTNETLINK answers: File exists',
+        'Command failed up.ip.batch:2',
+        '    from %s' % origins[1],
+        'RTNETLINK answers: File exists',
+        'Command failed up.ip.batch:7',
+        '    from %s' % origins[6],
+        'status 1', '']
+
+    assert run_batch(tmp_path / 'ok', batch, []) == 'status 0\n'
@@ -0,0 +1,107 @@
+#
+# Tests for the per-node bundles, and for the global overlay archive
+# shared by all the nodes.
+#
+
+import tarfile
+import time
+import os
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+def make_overlay(path, content):
+    os.makedirs(str(path / 'etc'))
+    os.makedirs(str(path / 'var' / 'empty'))
+    (path / 'etc' / 'motd').write_text(content)
+    os.chmod(str(path / 'etc' / 'motd'), 0o640)
+    os.symlink('motd', str(path / 'etc' / 'issue'))
+
+
+def tar_list(path):
+    tar = tarfile.open(str(path))
+    members = dict([(m.name, m) for m in tar.getmembers()])
+    tar.close()
+    return members
+
+
+def bundles_plan(make_plan, tmp_path):
+    make_overlay(tmp_path / 'all', 'all nodes\n')
+    make_overlay(tmp_path / 'node', 'node a\n')
+    lines = open(os.path.join(root, conf)).readlines() + \
+            ['overlay a %s\n' % (tmp_path / 'node')]
+    os.makedirs(str(tmp_path / 'out'))
+    pl = make_plan(conf, ['--overlay', str(tmp_path / 'all')], lines)
+    gen.write_artifacts(gen.producers(pl), str(tmp_path / 'out'))
+    return pl
+
+
+def test_bundles(make_plan, tmp_path):
+    pl = bundles_plan(make_plan, tmp_path)
+    outdir = tmp_path / 'out'
+    written = gen.write_bundles(pl, str(outdir))
+    assert sorted(written) == sorted([pl.overlay_archive] +
+                                     [gen.bundle_name(vm) for vm in pl.vms])
+
+    for vmname in pl.vms:
+        bundle = pl.bundles[vmname]
+        members = tar_list(outdir / gen.bundle_name(vmname))
+        assert set([(m.uid, m.gid, m.uname, m.gname)
+                    for m in members.values()]) == set([(0, 0, 'root', 'root')])
+
+        names = ['etc/' + name for name in bundle['confs']] + \
+                ['usr/bin/' + name for name in bundle['bins']]
+        for name in bundle['bins']:
+            assert members['usr/bin/' + name].mode == \
+                   os.stat(os.path.join(root, name)).st_mode & 0o7777
+
+        # Only the first node has its own overlay, where only files, links
+        # and empty directories are archived
+        if vmname == 'a':
+            names += ['etc/motd', 'etc/issue', 'var/empty']
+            assert members['etc/motd'].mode == 0o640
+            assert members['etc/issue'].issym()
+            assert members['var/empty'].isdir()
+        assert sorted(members) == sorted(names)
+
+    # The global overlay is not part of the bundles
+    members = tar_list(outdir / pl.overlay_archive)
+    assert sorted(members) == ['etc/issue', 'etc/motd', 'var/empty']
+
+
+def test_bundles_rewrite(make_plan, tmp_path):
+    pl = bundles_plan(make_plan, tmp_path)
+    outdir = tmp_path / 'out'
+    gen.write_bundles(pl, str(outdir))
+    assert gen.write_bundles(pl, str(outdir)) == []
+
+    # The archives do not depend on when they are written
+    for name in [gen.bundle_name('b'), pl.overlay_archive]:
+        archive = (outdir / name).read_bytes()
+        os.unlink(str(outdir / name))
+        assert gen.write_bundles(pl, str(outdir)) == [name]
+        assert (outdir / name).read_bytes() == archive
+
+    # A bundle is only rewritten if any of its sources is newer
+    future = time.time() + 10
+    os.utime(str(outdir / 'b.ipcm.conf'), (future, future))
+    os.unlink(str(tmp_path / 'node' / 'etc' / 'issue'))
+    assert gen.write_bundles(pl, str(outdir)) == \
+           [gen.bundle_name('a'), gen.bundle_name('b')]
+    assert 'etc/issue' not in tar_list(outdir / gen.bundle_name('a'))
+
+
+def test_overlay_archive_name(make_plan, tmp_path):
+    names = []
+    for d, content in [('x', 'one\n'), ('y', 'one\n'), ('z', 'two\n')]:
+        make_overlay(tmp_path / d, content)
+        pl = make_plan(conf, ['--overlay', str(tmp_path / d)])
+        names.append(pl.overlay_archive)
+
+    # The archive is named after the content of the overlay
+    assert names[0] == names[1] != names[2]
+    assert make_plan(conf).overlay_archive == None
@@ -0,0 +1,91 @@
+#
+# Tests for --clone, with which the nodes are restored from the saved state
+# of template VMs rather than booted.
+#
+
+import os
+
+import pytest
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+def seven_lines(extra = []):
+    return open(os.path.join(root, conf)).readlines() + extra
+
+
+def test_clone_templates(make_plan):
+    pl = make_plan('seven.conf', ['--clone'], seven_lines(['smp a 4\n']))
+
+    # The nodes booting the same way share a template
+    groups = dict()
+    for vmname in sorted(pl.vms):
+        groups.setdefault(pl.vms[vmname]['template'], []).append(vmname)
+    assert sorted(groups.values()) == [['a'], ['b', 'd', 'e'], ['c'],
+                                       ['f', 'g']]
+    assert sorted(groups) == sorted(pl.templates)
+
+    node_macs = set([vm['mac'] for vm in pl.vms.values()] +
+                    [port['mac'] for port in pl.ports])
+    for name in pl.templates:
+        template = pl.templates[name]
+        vm = pl.vms[groups[name][0]]
+        assert template['smp'] == vm['smp']
+        assert template['mac'] == gen.template_mac(99) == '00:0a:0b:00:00:63'
+        assert [port['mac'] for port in template['ports']] == \
+               [gen.template_mac(port['idx']) for port in vm['ports']]
+        assert not node_macs & set([port['mac'] for port in template['ports']])
+
+
+def test_clone_scripts(make_plan):
+    pl = make_plan(conf, ['--clone'])
+    artifacts = gen.emit(pl)
+    up = artifacts['up.sh']
+
+    # Each template is booted once, and its state saved
+    for name in pl.templates:
+        template = pl.templates[name]
+        assert up.count('-qmp unix:%s,server=on,wait=off &\n'
+                        % template['qmp']) == 1
+        assert up.count('./probe.py snapshot %s %s ' % (template['qmp'],
+                                                        template['state'])) == 1
+
+    # The nodes restore it, and then set their own MAC addresses
+    for vmname in pl.vms:
+        vm = pl.vms[vmname]
+        template = pl.templates[vm['template']]
+        assert gen.emit_qemu(pl, vmname).endswith('-incoming "exec:cat %s" '
+                                                  % template['state'])
+        assert gen.emit_clone_macs(pl, vm) == \
+               ''.join(['$SUDO ip link set $(mac2ifname %s) address %s\n'
+                        % (tport['mac'], port['mac']) for (port, tport)
+                        in zip(vm['ports'], template['ports'])])
+        assert gen.emit_clone_macs(pl, vm) in up
+
+    assert all([vm['template'] == None for vm in make_plan(conf).vms.values()])
+
+
+def test_clone_image_changed(make_plan, tmp_path):
+    kernel = tmp_path / 'bzImage'
+    kernel.write_bytes(b'kernel')
+    opts = ['--clone', '--kernel', str(kernel)]
+    names = sorted(make_plan(conf, opts).templates)
+
+    # The state of the templates is not reused once the images change
+    os.utime(str(kernel), (0, 0))
+    assert sorted(make_plan(conf, opts).templates) != names
+    assert not set(make_plan(conf, opts).templates) & set(names)
+
+
+def test_clone_errors(make_plan):
+    for opts, message in [(['--legacy'], '--clone cannot be used with '
+                                         '--legacy'),
+                          (['--initrd-overlay'], '--clone cannot be used with '
+                                                 '--initrd-overlay')]:
+        with pytest.raises(gen.GenError) as e:
+            make_plan(conf, ['--clone'] + opts)
+        assert str(e.value) == message
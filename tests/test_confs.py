@@ -0,0 +1,93 @@
+#
+# Tests for the IPCM and normal DIF configurations of the nodes.
+#
+
+import subprocess
+import json
+import sys
+import os
+
+from conftest import root
+import gen
+
+
+conf = 'examples/isp-sec.conf'
+
+
+def normal_templates(artifacts):
+    return sorted([name for name in artifacts if name.startswith('normal.')])
+
+
+def test_known_addresses(make_plan):
+    pl = make_plan(conf)
+    artifacts = gen.emit(pl)
+
+    for dif in pl.difconfs:
+        # A single table for all the members of the DIF
+        table = pl.dif_addresses[dif]
+        addresses = pl.addressing[dif]['addresses']
+        assert sorted([(e['apName'], e['address']) for e in table]) == \
+               sorted([('%s.%s' % (vmname, dif), addresses[vmname][0])
+                       for vmname in pl.scenario.difs[dif]])
+        for template in pl.difconfs[dif]:
+            assert pl.difconfs[dif][template]['knownIPCProcessAddresses'] \
+                        is table
+            difconf = json.loads(artifacts[template])
+            assert difconf['knownIPCProcessAddresses'] == table
+
+
+def test_shared_addresses(make_plan, tmp_path):
+    spliced = gen.emit(make_plan(conf))
+    pl = make_plan(conf, ['--shared-addresses'])
+    artifacts = gen.emit(pl)
+    assert normal_templates(artifacts) == normal_templates(spliced)
+
+    # mergeaddrs.py turns the templates into the spliced ones, once the
+    # address files are where the templates expect them
+    templates = []
+    for name in normal_templates(artifacts):
+        difconf = json.loads(artifacts[name])
+        addresses = os.path.basename(difconf['knownIPCProcessAddressesFile'])
+        assert json.loads(artifacts[addresses]) == \
+               json.loads(spliced[name])['knownIPCProcessAddresses']
+        (tmp_path / addresses).write_text(artifacts[addresses])
+        difconf['knownIPCProcessAddressesFile'] = str(tmp_path / addresses)
+        (tmp_path / name).write_text(json.dumps(difconf))
+        templates.append(str(tmp_path / name))
+
+    subprocess.check_call([sys.executable,
+                           os.path.join(root, 'mergeaddrs.py')] + templates)
+    for name in normal_templates(artifacts):
+        assert json.loads((tmp_path / name).read_text()) == \
+               json.loads(spliced[name])
+
+
+def test_templates_per_policies(make_plan):
+    lines = open(os.path.join(root, 'examples/seven.conf')).readlines() + \
+            ['policy n1 * rmt.pff lfa\n',
+             'policy n1 a,c rmt.pff multipath\n',
+             'policy n1 b rmt.pff multipath\n',
+             'policy n1 d efcp.*.dtcp dtcp-ps-x k=v\n']
+    pl = make_plan('seven.conf', [], lines)
+    artifacts = gen.emit(pl)
+    templates = pl.dif_templates['n1']
+
+    # The nodes to which the same node-scoped policies apply share a
+    # configuration, the others use the one of the whole DIF
+    assert templates['a'] == templates['b'] == templates['c']
+    assert len(set(templates.values())) == 3
+    for vmname in ['e', 'f', 'g']:
+        assert templates[vmname] == 'normal.n1.dif'
+    assert normal_templates(artifacts) == sorted(set(templates.values()))
+
+    for vmname in templates:
+        ipcmconf = json.loads(artifacts['%s.ipcm.conf' % vmname])
+        assert {'name': 'n1', 'template': templates[vmname]} in \
+                    ipcmconf['difConfigurations']
+
+        difconf = json.loads(artifacts[templates[vmname]])
+        pff = difconf['rmtConfiguration']['pffConfiguration']['policySet']
+        assert pff['name'] == ('multipath' if vmname in 'abc' else 'lfa')
+        dtcp = difconf['qosCubes'][0]['efcpPolicies']['dtcpConfiguration']\
+                    ['dtcpPolicySet']
+        assert (dtcp['name'] == 'dtcp-ps-x') == (vmname == 'd')
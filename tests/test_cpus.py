@@ -0,0 +1,102 @@
+#
+# Tests for the placement of the nodes on the host CPUs (--pin), and for
+# the cgroups limiting the nodes (--cgroups).
+#
+
+import os
+
+import pytest
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+def smp_lines(extra = []):
+    return open(os.path.join(root, conf)).readlines() + extra
+
+
+def test_cpulist():
+    assert gen.parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert gen.parse_cpulist('5,') == [5]
+    assert gen.format_cpulist([0, 1, 2, 3, 8, 10, 11]) == '0-3,8,10-11'
+    assert gen.format_cpulist([7]) == '7'
+    for cpulist in ['0-3,8,10-11', '1,3,5', '0-63']:
+        assert gen.format_cpulist(gen.parse_cpulist(cpulist)) == cpulist
+
+    for cpulist in ['0-3-5', 'a', '1,-2']:
+        with pytest.raises(gen.GenError) as e:
+            gen.parse_cpulist(cpulist)
+        assert str(e.value) == 'Invalid CPU list "%s"' % cpulist
+
+
+def test_pin_proportional(make_plan):
+    pl = make_plan('seven.conf', ['--pin', '--host-cpus', '16-31'],
+                   smp_lines(['smp a 4\n']))
+
+    # Each node gets as many CPUs as vCPUs, since there are enough of them
+    cpus = []
+    for vmname in sorted(pl.vms):
+        vm = pl.vms[vmname]
+        assert vm['smp'] == (4 if vmname == 'a' else 2)
+        node_cpus = gen.parse_cpulist(vm['cpus'])
+        assert len(node_cpus) == vm['smp']
+        cpus += node_cpus
+    assert sorted(cpus) == list(range(16, 32))
+
+    assert gen.producers(pl)['cpus.map']() == \
+           ['%s %d %s\n' % (vmname, pl.vms[vmname]['smp'],
+                            pl.vms[vmname]['cpus']) for vmname in sorted(pl.vms)]
+
+
+def test_pin_shared(make_plan):
+    # Fewer CPUs than nodes: the nodes sharing L2 domains share the CPUs
+    pl = make_plan(conf, ['--pin', '--host-cpus', '2,6'])
+    placement = dict([(vmname, pl.vms[vmname]['cpus']) for vmname in pl.vms])
+    assert sorted(set(placement.values())) == ['2', '6']
+    spanning = set([shim for (shim, a) in pl.scenario.links
+                    for (other, b) in pl.scenario.links
+                    if shim == other and placement[a] != placement[b]])
+    assert len(spanning) == 1
+
+    pl = make_plan(conf)
+    assert all([vm['cpus'] == None for vm in pl.vms.values()])
+    assert 'cpus.map' not in gen.producers(pl)
+
+
+def test_cgroups(make_plan):
+    pl = make_plan('seven.conf', ['--cgroups', '--pin', '--host-cpus', '0-15',
+                                  '--cpu-max', '50'], smp_lines(['smp a 4\n']))
+    artifacts = gen.emit(pl)
+    up = artifacts['up.sh']
+    down = artifacts['down.sh']
+
+    assert 'sudo mkdir -p /sys/fs/cgroup/rina.slice\n'\
+           'echo "+cpu +memory +cpuset" | sudo tee '\
+           '/sys/fs/cgroup/cgroup.subtree_control '\
+           '/sys/fs/cgroup/rina.slice/cgroup.subtree_control > /dev/null\n' \
+                in up
+    for vmname in pl.vms:
+        vm = pl.vms[vmname]
+        cgroup = '/sys/fs/cgroup/rina.slice/%s' % vmname
+        limits = [('cpu.max', '%d 100000' % (vm['smp'] * 50000)),
+                  ('memory.max', '%dM' % (pl.args.memory +
+                                          pl.qemu_memory_overhead)),
+                  ('cpuset.cpus', vm['cpus'])]
+        assert 'sudo mkdir -p %s\n' % cgroup + \
+               ''.join(['echo "%s" | sudo tee %s/%s > /dev/null\n'
+                        % (value, cgroup, name) for (name, value) in limits]) \
+               + '(PID=$BASHPID; echo $PID | sudo tee %s/cgroup.procs '\
+                 '> /dev/null; exec taskset -c %s qemu-system-x86_64 ' \
+                    % (cgroup, vm['cpus']) in up
+        assert 'sudo rmdir %s\n' % cgroup in down
+    assert down.index('sudo rmdir /sys/fs/cgroup/rina.slice\n') > \
+           max([down.index('sudo rmdir /sys/fs/cgroup/rina.slice/%s\n'
+                           % vmname) for vmname in pl.vms])
+
+    # The CPU sets are only limited with --pin
+    up = gen.emit(make_plan(conf, ['--cgroups']))['up.sh']
+    assert 'echo "+cpu +memory" | sudo tee ' in up
+    assert 'cpuset.cpus' not in up and 'taskset' not in up
@@ -0,0 +1,33 @@
+#
+# Tests for delta.sh, the script that pushes the changes of a scenario to
+# the running nodes.
+#
+
+import gen
+
+
+def test_delta_nothing_changed(make_plan):
+    pl = make_plan('examples/seven.conf')
+    delta = gen.emit_delta_script(pl, [], False, gen.enrollment_plan(pl))
+    assert 'Nothing changed' in delta
+
+
+def test_delta_enrollments_changed(make_plan):
+    old = make_plan('examples/seven.conf', ['-e', 'minimal'])
+    pl = make_plan('examples/seven.conf', ['-e', 'full-mesh'])
+
+    # Only the enrollments changed, not the configuration files
+    delta = gen.emit_delta_script(pl, [], False, gen.enrollment_plan(old))
+    assert 'Nothing changed' not in delta
+
+    added = set(map(tuple, gen.enrollment_plan(pl))) - \
+            set(map(tuple, gen.enrollment_plan(old)))
+    assert len(added)
+    for (dif, enrollee, enroller, lower_dif) in added:
+        assert '--enrollee-name %s.%s --enroller-name %s.%s ' \
+                    % (enrollee, dif, enroller, dif) in delta
+
+
+def test_delta_topology_changed(make_plan):
+    pl = make_plan('examples/seven.conf')
+    assert 'run down.sh and up.sh' in gen.emit_delta_script(pl, [], True)
@@ -0,0 +1,90 @@
+#
+# Tests for the balanced enrollment strategy and for the dependencies among
+# the enrollments, on generated scenarios.
+#
+
+import collections
+
+import gen
+
+
+def lan_lines(n):
+    return ['eth 100 0Mbps %s\n' % ' '.join(['m%d' % i
+                                             for i in range(1, n + 1)])] + \
+           ['dif n m%d 100\n' % i for i in range(1, n + 1)]
+
+
+def chain_lines(n):
+    return ['eth %d 0Mbps m%d m%d\n' % (100 + i, i, i + 1)
+            for i in range(1, n)] + \
+           ['dif n m%d %s\n' % (i, ' '.join(['%d' % (100 + j)
+                                            for j in [i - 1, i]
+                                            if 1 <= j < n]))
+            for i in range(1, n + 1)]
+
+
+def enroller_load(pl, dif):
+    return collections.Counter([e['enroller'] for e in pl.enrollments[dif]])
+
+
+def test_balanced_lan(make_plan):
+    opts = ['-e', 'balanced', '--max-enrollees', '4']
+    pl = make_plan('lan.conf', opts, lan_lines(50))
+
+    # A tree where each node enrolls at most 4 nodes, so 3 levels below
+    # the root are needed
+    assert len(pl.enrollments['n']) == 49
+    assert len(set([e['enrollee'] for e in pl.enrollments['n']])) == 49
+    assert max(enroller_load(pl, 'n').values()) == 4
+    assert pl.critical_path == 3
+
+    # Each redundant enrollment only waits for the enrollee and the enroller
+    # to join the DIF, and for the previous enrollment of the enrollee
+    for redundant in [1, 2]:
+        pl = make_plan('lan.conf', opts + ['--redundant-enrollments',
+                                           str(redundant)], lan_lines(50))
+        assert len(pl.enrollments['n']) == 49 + 50 * redundant
+        assert max(enroller_load(pl, 'n').values()) <= 4
+        assert pl.critical_path == 3 + redundant
+
+
+def test_enrollment_dag(make_plan):
+    pl = make_plan('lan.conf', ['-e', 'balanced', '--redundant-enrollments',
+                                '1'], lan_lines(20))
+    tasks = pl.enrollment_tasks
+    joined = dict()
+    for task in tasks:
+        for dep in task['depends']:
+            assert dep < task['id']
+        assert task['depth'] == 1 + max([tasks[d]['depth']
+                                         for d in task['depends']] + [0])
+        if task['enrollee'] not in joined:
+            joined[task['enrollee']] = task['id']
+        elif task['enroller'] in joined:
+            # A redundant enrollment does not wait for the other enrollments
+            # of its enroller
+            assert [d for d in task['depends']
+                    if tasks[d]['enrollee'] == task['enroller']] == \
+                   [joined[task['enroller']]]
+
+
+def test_center(make_plan):
+    for n in [2, 7, 8]:
+        pl = make_plan('chain.conf', ['-e', 'balanced'], chain_lines(n))
+        assert pl.dif_graphs['n'].center() == 'm%d' % ((n + 1) // 2)
+
+
+def test_center_large_ring(make_plan, monkeypatch):
+    visits = []
+    depths = gen.DIFGraph.depths
+
+    def counted(self, root, limit = None):
+        visits.append(root)
+        return depths(self, root, limit)
+    monkeypatch.setattr(gen.DIFGraph, 'depths', counted)
+
+    # The center is found with a constant number of visits of the graph
+    pl = make_plan('ring.conf', ['-e', 'balanced'], gen.ring_conf_lines(2000))
+    assert len(visits) <= 3
+    assert pl.critical_path == 1000
+    assert max(enroller_load(pl, 'n').values()) == 2
@@ -0,0 +1,79 @@
+#
+# Tests for DIFGraph, the node <--> N-1-DIF membership relation of a DIF,
+# against the neighbor sets computed directly from the DIF members.
+#
+
+import collections
+import glob
+import os
+
+import pytest
+
+from conftest import root
+import gen
+
+
+members = collections.OrderedDict([('a', ['300']), ('b', ['300', '400']),
+                                   ('c', ['400', '500']), ('d', ['400']),
+                                   ('e', ['600'])])
+
+
+def test_graph_membership():
+    graph = gen.DIFGraph(members)
+    assert list(graph) == ['a', 'b', 'c', 'd', 'e']
+    assert len(graph) == 5
+    assert 'c' in graph and 'f' not in graph
+
+    assert graph.lower_difs_of('b') == ['300', '400']
+    assert graph.members_of('400') == ['b', 'c', 'd']
+    assert graph.members_of('500') == ['c']
+    assert graph.is_member('d', '400')
+    assert not graph.is_member('d', '300')
+    assert not graph.is_member('f', '300')
+    assert not graph.is_member('a', '700')
+
+
+def test_graph_neighbors():
+    graph = gen.DIFGraph(members)
+    assert sorted(graph.neighbors('b')) == [('a', '300'), ('c', '400'),
+                                            ('d', '400')]
+    assert list(graph.neighbors('e')) == []
+    assert sorted(graph.edges()) == [('a', 'b', '300'), ('b', 'c', '400'),
+                                     ('b', 'd', '400'), ('c', 'd', '400')]
+
+    # Each N-1-DIF in the skip set is traversed once
+    traversed = set()
+    assert sorted(graph.neighbors('c', traversed)) == [('b', '400'),
+                                                       ('d', '400')]
+    assert list(graph.neighbors('d', traversed)) == []
+    assert list(graph.neighbors('b', traversed)) == [('a', '300')]
+
+
+def test_graph_depths():
+    graph = gen.DIFGraph(members)
+    assert graph.depths('a') == {'a': 0, 'b': 1, 'c': 2, 'd': 2}
+    assert graph.depths('e') == {'e': 0}
+    assert graph.depths('a', 2) == None
+    assert graph.depths('a', 3) == graph.depths('a')
+
+
+confs = [os.path.relpath(conf, root) for conf in
+         sorted(glob.glob(os.path.join(root, 'examples', '*.conf')))]
+
+
+@pytest.mark.parametrize('conf', confs)
+def test_graph_examples(make_plan, conf):
+    pl = make_plan(conf)
+    for dif in pl.scenario.difs:
+        difs = pl.scenario.difs[dif]
+        graph = pl.dif_graphs[dif]
+
+        for vmname in difs:
+            expected = set([(neigh, lower_dif)
+                            for lower_dif in difs[vmname]
+                            for neigh in difs
+                            if neigh != vmname and
+                               lower_dif in difs[neigh]])
+            found = list(graph.neighbors(vmname))
+            assert len(found) == len(set(found))
+            assert set(found) == expected
@@ -0,0 +1,133 @@
+#
+# Tests for the multi-host mode of gen.py (--hosts). The hosts are emulated
+# on this machine with network namespaces (see netns-hosts.sh), which needs
+# root privileges: the tests that set them up are skipped otherwise.
+#
+
+import subprocess
+import shutil
+import sys
+import os
+
+import pytest
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+netns_prefix = 'gentest-h'
+
+
+def netns_hosts(action, nhosts):
+    return subprocess.run([os.path.join(root, 'netns-hosts.sh'), action,
+                           str(nhosts)],
+                          env = dict(os.environ, NETNS_PREFIX = netns_prefix),
+                          stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                          universal_newlines = True)
+
+
+@pytest.fixture
+def hosts():
+    if os.geteuid() != 0 or shutil.which('ip') == None:
+        pytest.skip('network namespaces need root privileges')
+    if netns_hosts('up', 2).returncode != 0:
+        netns_hosts('down', 2)
+        pytest.skip('cannot create network namespaces')
+
+    yield netns_hosts('list', 2).stdout.strip()
+
+    netns_hosts('down', 2)
+
+
+def netns_exec(host, cmd, **kwargs):
+    return subprocess.run(['ip', 'netns', 'exec', '%s%d' % (netns_prefix,
+                                                           host + 1)] + cmd,
+                          **kwargs)
+
+
+# Receive a UDP datagram in the namespace of a host, sent from another one
+receiver = '''
+import socket, sys
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.bind((sys.argv[1], 5000))
+s.settimeout(10)
+print(s.recv(100).decode())
+'''
+
+sender = '''
+import socket, sys, time
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+for i in range(50):
+    s.sendto(b'hello', (sys.argv[1], 5000))
+    time.sleep(0.1)
+'''
+
+
+@pytest.mark.parametrize('tunnel', ['vxlan', 'gretap'])
+def test_hosts_tunnels(make_plan, tmp_path, hosts, tunnel):
+    probe = {'vxlan': 'id 1 dstport 4789',
+             'gretap': 'key 1 local 10.255.0.1 remote 10.255.0.2'}[tunnel]
+    if netns_exec(0, ['ip', 'link', 'add', 'probe', 'type', tunnel] +
+                  probe.split(), stderr = subprocess.DEVNULL).returncode != 0:
+        pytest.skip('%s tunnels not supported by the kernel' % tunnel)
+    netns_exec(0, ['ip', 'link', 'del', 'probe'])
+
+    pl = make_plan(conf, ['--hosts', hosts, '--tunnel', tunnel])
+    gen.write_artifacts(gen.producers(pl), str(tmp_path))
+
+    sudo = tmp_path / 'sudo'
+    sudo.write_text('#!/bin/bash\nexec "$@"\n')
+    sudo.chmod(0o755)
+    env = dict(os.environ, PATH = '%s:%s' % (tmp_path, os.environ['PATH']))
+
+    # Set up the network of each host, without the nodes
+    for host in range(len(pl.hosts)):
+        script = ''.join(gen.up_network_chunks(pl, host))
+        assert netns_exec(host, ['bash', '-c', script], cwd = str(tmp_path),
+                          env = env, stdout = subprocess.DEVNULL,
+                          stderr = subprocess.DEVNULL).returncode == 0
+
+    # Stand-ins for two nodes of an L2 domain spanning both hosts
+    shim = sorted(pl.tunnels)[0]
+    assert pl.tunnels[shim]['hosts'] == [0, 1]
+    for host in [0, 1]:
+        for cmd in ['link add node type veth peer name node.br',
+                    'link set node.br master %s up' % pl.bridges[shim],
+                    'addr add 192.168.100.%d/24 dev node' % (host + 1),
+                    'link set node up']:
+            assert netns_exec(host, ['ip'] + cmd.split()).returncode == 0
+
+    recv = subprocess.Popen(['ip', 'netns', 'exec', netns_prefix + '2',
+                             sys.executable, '-c', receiver, '192.168.100.2'],
+                            stdout = subprocess.PIPE, universal_newlines = True)
+    send = subprocess.Popen(['ip', 'netns', 'exec', netns_prefix + '1',
+                             sys.executable, '-c', sender, '192.168.100.2'])
+    try:
+        out, _ = recv.communicate(timeout = 20)
+    finally:
+        send.kill()
+        send.wait()
+    assert recv.returncode == 0
+    assert out.strip() == 'hello'
+
+
+def test_hosts_pin(make_plan):
+    hosts = ['--hosts', '10.0.0.1,10.0.0.2', '--pin']
+
+    # The CPUs of remote hosts must be specified
+    with pytest.raises(gen.GenError):
+        make_plan(conf, hosts)
+    with pytest.raises(gen.GenError):
+        make_plan(conf, hosts + ['--host-cpus', '0-3/0-3/0-3'])
+
+    pl = make_plan(conf, hosts + ['--host-cpus', '0-1/8-15'])
+    for vmname in pl.vms:
+        vm = pl.vms[vmname]
+        cpus = gen.parse_cpulist(vm['cpus'])
+        assert set(cpus) <= set([[0, 1], range(8, 16)][vm['host']])
+
+    # A list for all the hosts
+    pl = make_plan(conf, hosts + ['--host-cpus', '4-5'])
+    for vmname in pl.vms:
+        assert set(gen.parse_cpulist(pl.vms[vmname]['cpus'])) <= set([4, 5])
@@ -0,0 +1,126 @@
+#
+# Tests for the initramfs overlays written with --initrd-overlay, built on
+# a small base image generated here, without root privileges.
+#
+
+import stat
+import os
+
+import pytest
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+# Return the (name, mode, uid, gid) of the entries of a "newc" cpio archive
+def cpio_list(data):
+    entries = []
+    pos = 0
+    while True:
+        assert data[pos:pos + 6] == gen.cpio_magic
+        fields = [int(data[pos + 6 + i * 8:pos + 14 + i * 8], 16)
+                  for i in range(13)]
+        mode, uid, gid, filesize, namesize = \
+            fields[1], fields[2], fields[3], fields[6], fields[11]
+        name = data[pos + 110:pos + 110 + namesize - 1].decode('utf-8')
+        if name == 'TRAILER!!!':
+            return entries
+        entries.append((name, mode, uid, gid))
+        pos += 110 + namesize
+        pos += -pos % 4
+        pos += filesize
+        pos += -pos % 4
+
+
+def overlay_opts(base):
+    return ['--initrd-overlay', '--initramfs', str(base)]
+
+
+def write_base(path, entries):
+    path.write_bytes(b''.join([gen.cpio_entry(name, mode, data, ino + 1)
+                               for ino, (name, mode, data)
+                               in enumerate(entries)])
+                     + gen.cpio_entry('TRAILER!!!', 0))
+
+
+def test_initrd_overlay(make_plan, tmp_path):
+    base = tmp_path / 'rootfs.cpio'
+    write_base(base, [('etc', stat.S_IFDIR | 0o700, b''),
+                      ('usr', stat.S_IFDIR | 0o750, b''),
+                      ('etc/inittab', stat.S_IFREG | 0o644, b'::sysinit\n')])
+    assert gen.cpio_names(str(base)) == set(['etc', 'usr', 'etc/inittab'])
+
+    pl = make_plan(conf, overlay_opts(base))
+    gen.write_artifacts(gen.producers(pl), str(tmp_path))
+    written = gen.write_initrds(pl, str(tmp_path))
+    assert sorted(written) == sorted(['%s.initrd' % vm for vm in pl.vms])
+
+    for vmname in pl.vms:
+        bundle = pl.bundles[vmname]
+        overlay = (tmp_path / pl.initrds[vmname]['overlay']).read_bytes()
+        entries = cpio_list(overlay)
+        modes = dict([(name, mode) for (name, mode, uid, gid) in entries])
+
+        # Everything is owned by root
+        assert set([(uid, gid) for (name, mode, uid, gid) in entries]) == \
+               set([(0, 0)])
+
+        # The existing directories are not added again, so that they keep
+        # the modes of the base image, and the missing ones are created
+        assert 'etc' not in modes
+        assert 'usr' not in modes
+        for d in ['etc/init.d', 'usr/bin']:
+            assert modes[d] == stat.S_IFDIR | 0o755
+
+        assert modes[gen.initrd_hook] == stat.S_IFREG | 0o755
+        for name in bundle['confs']:
+            assert stat.S_ISREG(modes['etc/' + name])
+        for name in bundle['bins']:
+            assert modes['usr/bin/' + name] == \
+                   os.lstat(os.path.join(root, name)).st_mode
+
+        # The image is the base image followed by the overlay
+        image = (tmp_path / pl.initrds[vmname]['image']).read_bytes()
+        assert image.startswith(base.read_bytes())
+        assert image.endswith(overlay)
+        assert gen.cpio_names(str(tmp_path / pl.initrds[vmname]['image'])) \
+               == gen.cpio_names(str(base)) | set([e[0] for e in entries])
+
+
+def test_initrd_base_not_newc(make_plan, tmp_path):
+    # A compressed base image
+    base = tmp_path / 'rootfs.cpio.gz'
+    base.write_bytes(b'\x1f\x8b\x08\x00' + b'\0' * 60)
+
+    pl = make_plan(conf, overlay_opts(base))
+    gen.write_artifacts(gen.producers(pl), str(tmp_path))
+    with pytest.raises(gen.GenError) as e:
+        gen.write_initrds(pl, str(tmp_path))
+    assert 'is not an uncompressed newc cpio archive' in str(e.value)
+
+
+def test_initrd_manager(make_plan, tmp_path):
+    base = tmp_path / 'rootfs.cpio'
+    write_base(base, [('etc', stat.S_IFDIR | 0o755, b'')])
+    manager_base = tmp_path / 'manager.cpio'
+    write_base(manager_base, [('usr', stat.S_IFDIR | 0o755, b'')])
+
+    pl = make_plan(conf, overlay_opts(base) +
+                         ['--manager', '--manager-initramfs', str(manager_base)])
+    mgr = gen.mgmt_node_name
+    assert pl.initrds[mgr]['base'] == str(manager_base)
+
+    # The manager boots its own image, with the manager kernel
+    qemu = gen.emit_qemu(pl, mgr)
+    assert '-initrd %s ' % pl.initrds[mgr]['image'] in qemu
+    assert '-kernel %s ' % pl.args.manager_kernel in qemu
+
+    gen.write_artifacts(gen.producers(pl), str(tmp_path))
+    gen.write_initrds(pl, str(tmp_path))
+    image = (tmp_path / pl.initrds[mgr]['image']).read_bytes()
+    assert image.startswith(manager_base.read_bytes())
+    assert gen.initrd_hook in gen.cpio_names(str(tmp_path /
+                                                 pl.initrds[mgr]['image']))
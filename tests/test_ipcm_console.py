@@ -0,0 +1,207 @@
+#
+# Tests for the IPCM console client and for enroll.py, against a fake IPCM
+# listening on a local UNIX socket. The fake IPCM splits its responses
+# across several writes, in the middle of the lines and of the prompt.
+#
+
+import subprocess
+import threading
+import socket
+import json
+import time
+import sys
+import os
+
+import pytest
+
+from conftest import root
+import ipcm_console
+
+
+ipcps = 'Current IPC processes (id | name | type | state | Registered ' \
+        'applications | Port-ids of flows provided)\n' \
+        '    1 | a.300:1:: | shim-eth-vlan | ASSIGNED TO DIF 300 | - | -\n' \
+        '    2 | a.error-dif:1:: | normal-ipc | ASSIGNED TO DIF error-dif ' \
+                '| - | -\n' \
+        '   13 | b.n1:1:: | normal-ipc | ASSIGNED TO DIF n1 | - | -\n'
+
+
+class FakeIPCM:
+    """An IPCM console at path, which enrolls the IPCPs whose id is in
+       'enrollable', hangs on the enrollments of the ones in 'hanging',
+       and fails the other enrollments"""
+
+    def __init__(self, path, enrollable, hanging = []):
+        self.enrollable = enrollable
+        self.hanging = hanging
+        self.commands = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Send a response in pieces, splitting the lines and the prompt
+    def send(self, conn, response):
+        data = (response + 'IPCM >>> ').encode('ascii')
+        for piece in [data[:7], data[7:-6], data[-6:-3], data[-3:]]:
+            conn.sendall(piece)
+            time.sleep(0.01)
+
+    def serve(self):
+        conn, addr = self.sock.accept()
+        self.send(conn, 'IPCM console\n')
+
+        fin = conn.makefile('r')
+        for line in fin:
+            cmd = line.split()
+            self.commands.append(line.strip())
+            if cmd[0] == 'list-ipcps':
+                self.send(conn, ipcps)
+            elif cmd[0] == 'enroll-to-dif' and len(cmd) >= 5:
+                if not cmd[1].isdigit():
+                    self.send(conn, 'Invalid IPC process id\n')
+                elif int(cmd[1]) in self.hanging:
+                    continue
+                elif int(cmd[1]) in self.enrollable:
+                    self.send(conn, 'DIF enrollment succesfully completed '
+                                    'in 12 ms\n')
+                else:
+                    self.send(conn, 'Enrollment operation failed\n')
+            else:
+                self.send(conn, 'Unknown command\n')
+        conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def fake_ipcm(tmp_path):
+    path = str(tmp_path / 'ipcm-console.sock')
+    ipcms = []
+
+    def start(enrollable, hanging = []):
+        ipcms.append(FakeIPCM(path, enrollable, hanging))
+        return path
+
+    yield start
+
+    for ipcm in ipcms:
+        ipcm.close()
+
+
+def test_parse_ipcps():
+    parsed = ipcm_console.parse_ipcps(ipcps.split('\n'))
+    assert [(i['id'], i['name'], i['apname'], i['type']) for i in parsed] == [
+                (1, 'a.300:1::', 'a.300', 'shim-eth-vlan'),
+                (2, 'a.error-dif:1::', 'a.error-dif', 'normal-ipc'),
+                (13, 'b.n1:1::', 'b.n1', 'normal-ipc')]
+
+
+def test_console_responses(fake_ipcm):
+    console = ipcm_console.Console(fake_ipcm([2]), timeout = 5)
+    try:
+        assert console.banner == ['IPCM console']
+        assert console.ipcp_id('b.n1') == 13
+        assert console.ipcp_id('a.300:1::') == 1
+        assert console.ipcp_id('c.n1') == None
+
+        lines, latency = console.command('bogus')
+        assert lines == ['Unknown command']
+    finally:
+        console.close()
+
+
+def test_console_enroll(fake_ipcm):
+    console = ipcm_console.Console(fake_ipcm([2]), timeout = 5)
+    try:
+        # An IPCP whose name contains "error"
+        ok, lines, latency = console.enroll('a.error-dif', 'error-dif', '300',
+                                            'b.error-dif')
+        assert ok
+        assert lines == ['DIF enrollment succesfully completed in 12 ms']
+
+        ok, lines, latency = console.enroll('b.n1', 'n1', '300', 'a.n1')
+        assert not ok
+        assert lines == ['Enrollment operation failed']
+
+        ok, lines, latency = console.enroll('c.n1', 'n1', '300', 'a.n1')
+        assert not ok
+        assert lines == ['Could not find the ID of enrollee IPCP c.n1']
+    finally:
+        console.close()
+
+
+def test_enrollment_completed():
+    assert ipcm_console.enrollment_completed(
+                ['DIF enrollment successfully completed in 3 ms'])
+
+    # The other lines do not matter, even if they mention a failure
+    assert ipcm_console.enrollment_completed(
+                ['Enrolling a.error-dif to DIF error-dif (not found in cache)',
+                 'DIF enrollment succesfully completed in 3 ms'])
+    for reply in [[], ['Enrollment operation failed'],
+                  ['No such IPC process id'], ['Invalid IPC process id']]:
+        assert not ipcm_console.enrollment_completed(reply)
+
+
+def test_console_hung(fake_ipcm):
+    console = ipcm_console.Console(fake_ipcm([2], [13]), timeout = 5,
+                                   response_timeout = 0.5)
+    try:
+        start = time.time()
+        with pytest.raises(ipcm_console.ConsoleTimeout):
+            console.enroll('b.n1', 'n1', '300', 'a.n1')
+        assert time.time() - start < 5
+    finally:
+        console.close()
+
+
+def test_console_not_available(tmp_path):
+    start = time.time()
+    with pytest.raises(ipcm_console.ConsoleError):
+        ipcm_console.Console(str(tmp_path / 'missing.sock'), timeout = 0.5)
+    assert time.time() - start < 5
+
+
+def run_enroll(tmp_path, sock_path, batch, opts = []):
+    conf = tmp_path / 'a.ipcm.conf'
+    conf.write_text(json.dumps({'localConfiguration':
+                                {'consoleSocket': sock_path}}))
+    return subprocess.run([sys.executable, os.path.join(root, 'enroll.py'),
+                           '--ipcm-conf', str(conf), '--batch', '-',
+                           '--timeout', '5'] + opts, input = batch,
+                          stdout = subprocess.PIPE, universal_newlines = True)
+
+
+def test_enroll_batch(fake_ipcm, tmp_path):
+    proc = run_enroll(tmp_path, fake_ipcm([2, 13]),
+                      '# enrollee dif lower-dif enroller\n'
+                      'a.error-dif error-dif 300 b.error-dif\n'
+                      'b.n1 n1 300 a.n1\n')
+    assert proc.returncode == 0
+    assert proc.stdout.count('OK: enrollment of') == 2
+
+
+def test_enroll_batch_failure(fake_ipcm, tmp_path):
+    proc = run_enroll(tmp_path, fake_ipcm([13]),
+                      'a.error-dif error-dif 300 b.error-dif\n'
+                      'b.n1 n1 300 a.n1\n')
+    assert proc.returncode == 1
+    assert 'FAILED: enrollment of a.error-dif to DIF error-dif' in proc.stdout
+    assert 'OK: enrollment of b.n1 to DIF n1' in proc.stdout
+
+
+def test_enroll_batch_hung(fake_ipcm, tmp_path):
+    # enroll.py gives up, so that the enrollment can be retried
+    start = time.time()
+    proc = run_enroll(tmp_path, fake_ipcm([2], [13]),
+                      'b.n1 n1 300 a.n1\n'
+                      'a.error-dif error-dif 300 b.error-dif\n',
+                      ['--response-timeout', '1'])
+    assert time.time() - start < 10
+    assert proc.returncode == 1
+    assert 'No response from the IPCM console' in proc.stdout
+    assert 'enrollment of a.error-dif' not in proc.stdout
@@ -0,0 +1,90 @@
+#
+# Tests for --direct-links, with which the L2 domains with two members are
+# emulated by cross-connecting their TAP interfaces rather than by a bridge.
+# The generated batches are also applied in a network namespace, which needs
+# root privileges: that test is skipped otherwise.
+#
+
+import subprocess
+import shutil
+import os
+
+import pytest
+
+import gen
+
+
+def lines():
+    return ['eth 300 0Mbps a b c\n', 'eth 400 10Mbps c d\n',
+            'eth 500 0Mbps d e\n',
+            'dif n a 300\n', 'dif n b 300\n', 'dif n c 300 400\n',
+            'dif n d 400 500\n', 'dif n e 500\n']
+
+
+def test_direct_link_commands(make_plan):
+    pl = make_plan('links.conf', ['--direct-links'], lines())
+
+    # Only the L2 domain with three members keeps its bridge
+    assert sorted(pl.direct_links) == ['400', '500']
+    assert list(pl.bridges) == ['300']
+    for port in pl.ports:
+        assert (port['br'] == None) == (port['vlan'] != '300')
+
+    c, d = [port['tap'] for port in pl.direct_links['400']]
+    assert gen.direct_link_commands(pl, '400') == [
+        'qdisc add dev %s handle ffff: ingress' % c,
+        'filter add dev %s parent ffff: protocol all u32 match u32 0 0 '
+            'action mirred egress redirect dev %s' % (c, d),
+        'qdisc add dev %s handle ffff: ingress' % d,
+        'filter add dev %s parent ffff: protocol all u32 match u32 0 0 '
+            'action mirred egress redirect dev %s' % (d, c)]
+
+    artifacts = gen.emit(pl)
+    assert artifacts['up.ip.batch'].count(' type bridge') == 1
+    assert artifacts['down.ip.batch'].count('link del rbr') == 1
+    for cmd in gen.direct_link_commands(pl, '500'):
+        assert '%s # ' % cmd in artifacts['up.tc.batch']
+
+    # Without the option, each L2 domain has a bridge
+    pl = make_plan('links.conf', [], lines())
+    assert pl.direct_links == dict()
+    assert sorted(pl.bridges) == ['300', '400', '500']
+
+
+def test_direct_links_hosts(make_plan):
+    # The L2 domains spanning hosts are connected by tunnels to a bridge
+    pl = make_plan('examples/seven.conf', ['--direct-links', '--hosts',
+                                           '10.0.0.1,10.0.0.2'])
+    assert len(pl.tunnels)
+    assert sorted(pl.bridges) == sorted(pl.tunnels)
+    assert sorted(list(pl.bridges) + list(pl.direct_links)) == \
+           sorted(pl.scenario.shims)
+
+
+def test_direct_links_apply(make_plan):
+    if os.geteuid() != 0 or shutil.which('tc') == None:
+        pytest.skip('network namespaces need root privileges')
+    pl = make_plan('links.conf', ['--direct-links'], lines())
+    artifacts = gen.emit(pl)
+
+    netns = 'gentest-links'
+    if subprocess.call(['ip', 'netns', 'add', netns]) != 0:
+        pytest.skip('cannot create network namespaces')
+    try:
+        def batch(tool, name):
+            return subprocess.run([tool, '-n', netns, '-batch', '-'],
+                                  input = artifacts[name],
+                                  universal_newlines = True).returncode
+
+        assert batch('ip', 'up.ip.batch') == 0
+        assert batch('tc', 'up.tc.batch') == 0
+        for (src, dst) in [(0, 1), (1, 0)]:
+            ports = pl.direct_links['400']
+            filters = subprocess.check_output(['tc', '-n', netns, 'filter',
+                                               'show', 'dev',
+                                               ports[src]['tap'], 'ingress'],
+                                              universal_newlines = True)
+            assert 'Redirect to device %s' % ports[dst]['tap'] in filters
+        assert batch('ip', 'down.ip.batch') == 0
+    finally:
+        subprocess.call(['ip', 'netns', 'del', netns])
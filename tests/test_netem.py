@@ -0,0 +1,115 @@
+#
+# Tests for the offline validator of the netem arguments. The expected
+# results are those of tc (iproute2, 6.5 or later for seed), which parses
+# the options before talking to the kernel.
+#
+
+import pytest
+
+import gen_netem
+
+
+valid = [
+    'delay 10ms',
+    'delay 10ms 1ms',
+    'delay 10ms 1ms 25%',
+    'delay 10ms 1ms distribution normal',
+    'delay 10ms 1ms 25% distribution paretonormal',
+    'distribution pareto delay 1s 100us',
+    'delay 10ms 1ms distribution experimental',
+    'latency 1.5ms',
+    'limit 1000 delay 10ms',
+    'loss 1%',
+    'loss 0.5% 25%',
+    'loss random 1%',
+    'drop 1%',
+    'loss 1% ecn',
+    'ecn loss 1%',
+    'loss state 1%',
+    'loss state 1% 2% 3% 4% 5%',
+    'loss gemodel 1%',
+    'loss gemodel 1% 2% 3% 4%',
+    'loss gemodel 1% ecn',
+    'loss state 1% ecn',
+    'corrupt 0.1%',
+    'duplicate 1% 10%',
+    'delay 10ms reorder 25% 50%',
+    'delay 10ms reorder 25% gap 5',
+    'delay 10ms reorder 10% gap 0',
+    'delay 10ms gap 5 reorder 10%',
+    'reorder 0%',
+    'rate 1mbit',
+    'rate 1Mibit',
+    'rate 100kbps',
+    'rate 1gbit 20',
+    'rate 1gbit -20 100 5',
+    'slot 1ms',
+    'slot 1ms 2ms packets 3',
+    'slot 1ms packets 3 bytes 1500',
+    'slot 1ms bytes 1500',
+    'slot distribution pareto 1ms 2ms',
+    'seed 42 delay 10ms',
+    'delay 100ms 10ms loss 1% corrupt 0.1% duplicate 1% rate 10mbit',
+]
+
+invalid = [
+    'bogus 10',
+    'delay',
+    'delay ten',
+    'delay 10ms distribution normal',
+    'delay 10ms 0ms distribution normal',
+    'distribution normal',
+    'delay 10ms 1ms distribution gaussian',
+    'delay 10ms 1ms distribution uniform',
+    'reorder 25%',
+    'reorder 25% delay 0ms',
+    'reorder 25% gap 5',
+    'gap 5',
+    'delay 10ms gap 5',
+    'delay 10ms reorder 0% gap 5',
+    'loss 101%',
+    'loss',
+    'loss random',
+    'loss state',
+    'loss state 1% 2% 3% 4% 5% 6%',
+    'loss gemodel',
+    'loss gemodel 1% 2% 3% 4% 5%',
+    'ecn',
+    'delay 10ms ecn',
+    'loss 0% ecn',
+    'rate',
+    'rate fast',
+    'rate 1mbyte',
+    'slot',
+    'slot packets 3',
+    'slot 1ms packets',
+    'slot 1ms bytes 1500 packets 3',
+    'slot distribution normal 1ms',
+    'slot distribution gaussian 1ms 2ms',
+    'limit many',
+    'seed',
+]
+
+
+@pytest.mark.parametrize('netem_args', valid)
+def test_netem_valid(netem_args):
+    assert gen_netem.netem_check(netem_args) == None
+
+
+@pytest.mark.parametrize('netem_args', invalid)
+def test_netem_invalid(netem_args):
+    assert gen_netem.netem_check(netem_args) != None
+
+
+def test_netem_ecn_message():
+    assert gen_netem.netem_check('delay 10ms ecn') == \
+                'ecn requested without loss model'
+
+
+def test_netem_validate_cache():
+    gen_netem.validation_cache.clear()
+    assert gen_netem.netem_validate('delay  10ms') == None
+    assert gen_netem.netem_validate('ecn') != None
+    assert gen_netem.validation_cache == {
+                ('delay 10ms', False): None,
+                ('ecn', False): 'ecn requested without loss model'}
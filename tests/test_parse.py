@@ -0,0 +1,174 @@
+#
+# Tests for the gen.conf parser: the keyword-dispatched parser must produce
+# the same scenario as the line-by-line regex parser it replaced, on all the
+# shipped examples, and report all the errors of a file in a single pass.
+#
+
+import glob
+import os
+import re
+
+import pytest
+
+from conftest import root
+import gen
+
+
+# The regex parser of the original gen.py, reduced to the state it built
+def baseline_parse(lines, manager, strategy):
+    sc = {'vms': dict(), 'shims': dict(), 'links': [], 'difs': dict(),
+          'dif_policies': dict(), 'app_mappings': [], 'overlays': dict(),
+          'netems': dict(), 'manual_enrollments': dict()}
+
+    lines = list(lines)
+    injected = False
+    linecnt = 0
+    while len(lines):
+        line = lines.pop(0)
+        linecnt += 1
+        line = line.replace('\n', '')
+
+        if len(lines) == 0 and manager and not injected:
+            injected = True
+            vm_list = sorted(sc['vms']) + [gen.mgmt_node_name]
+            lines.append('eth %s 0Mbps %s' % (gen.mgmt_shim_dif_name,
+                                              ' '.join(vm_list)))
+            for vmname in vm_list:
+                lines.append('dif %s %s %s' % (gen.mgmt_dif_name, vmname,
+                                               gen.mgmt_shim_dif_name))
+
+        if line.startswith('#') or re.match(r'\s*$', line):
+            continue
+
+        m = re.match(r'\s*eth\s+(\d+)\s+(\d+)([GMK])bps\s+(\w.*)$', line)
+        if m:
+            vlan = m.group(1)
+            if vlan in sc['shims']:
+                continue
+            sc['shims'][vlan] = {'vlan': vlan, 'speed': int(m.group(2)),
+                                 'speed_unit': m.group(3).lower()}
+            for vm in m.group(4).split():
+                if vm not in sc['vms']:
+                    sc['vms'][vm] = {'name': vm}
+                sc['links'].append((vlan, vm))
+            continue
+
+        m = re.match(r'\s*dif\s+([\w-]+)\s+([\w-]+)\s+([\w-].*)$', line)
+        if m:
+            dif, vm = m.group(1), m.group(2)
+            if vm not in sc['vms']:
+                sc['vms'][vm] = {'name': vm}
+            if dif not in sc['difs']:
+                sc['difs'][dif] = dict()
+            if vm not in sc['difs'][dif]:
+                sc['difs'][dif][vm] = m.group(3).split()
+            continue
+
+        m = re.match(r'\s*policy\s+([\w-]+)\s+(\*|(?:(?:[\w-]+,)*[\w-]+))\s+'
+                     r'([*\w.-]+)\s+([\w-]+)((?:\s+[\w.-]+\s*=\s*[/\w.-]+)*)'
+                     r'\s*$', line)
+        if m:
+            parms = list()
+            if m.group(5) != None and m.group(5).strip() != '':
+                parms = m.group(5).strip().split(' ')
+            nodes = [] if m.group(2) == '*' else m.group(2).split(',')
+            sc['dif_policies'].setdefault(m.group(1), []).append(
+                    {'path': m.group(3), 'nodes': nodes, 'ps': m.group(4),
+                     'parms': parms})
+            continue
+
+        m = re.match(r'\s*appmap\s+([\w-]+)\s+([\w.]+)\s+(\d+)\s*$', line)
+        if m:
+            sc['app_mappings'].append({'name': '%s-%s--' % (m.group(2),
+                                                            m.group(3)),
+                                       'dif': m.group(1)})
+            continue
+
+        m = re.match(r'\s*overlay\s+([\w-]+)\s+([\w.-/]+\s*$)', line)
+        if m:
+            opath = os.path.abspath(m.group(2))
+            if os.path.isdir(opath):
+                sc['overlays'][m.group(1)] = opath
+            continue
+
+        m = re.match(r'\s*netem\s+(\d+)\s+([\w-]+)\s+(\w.*)$', line)
+        if m:
+            sc['netems'].setdefault(m.group(1), dict())[m.group(2)] = \
+                    {'args': m.group(3), 'linecnt': linecnt}
+            continue
+
+        m = re.match(r'\s*enroll\s+([\w.-]+)\s+([\w.-]+)\s+([\w.-]+)\s+'
+                     r'([\w.-]+)\s*$', line)
+        if m:
+            if strategy == 'manual':
+                sc['manual_enrollments'].setdefault(m.group(1), []).append(
+                        {'enrollee': m.group(2), 'enroller': m.group(3),
+                         'lower_dif': m.group(4), 'linecnt': linecnt})
+            continue
+
+        raise Exception('line %d not recognized' % linecnt)
+
+    return sc
+
+
+# The part of a Scenario that the baseline parser also built
+def scenario_state(sc):
+    return {'vms': sc.vms,
+            'shims': dict((vlan, {'vlan': s['vlan'], 'speed': s['speed'],
+                                  'speed_unit': s['speed_unit']})
+                          for vlan, s in sc.shims.items()),
+            'links': sc.links, 'difs': sc.difs,
+            # parse() gives an empty policy list to each DIF
+            'dif_policies': dict((dif, p) for dif, p in sc.dif_policies.items()
+                                 if len(p)),
+            'app_mappings': sc.app_mappings, 'overlays': sc.overlays,
+            'netems': sc.netems, 'manual_enrollments': sc.manual_enrollments}
+
+
+confs = [os.path.relpath(conf, root) for conf in
+         [os.path.join(root, 'gen.conf')] +
+         sorted(glob.glob(os.path.join(root, 'examples', '*.conf')))]
+
+
+@pytest.mark.parametrize('conf', confs)
+@pytest.mark.parametrize('opts', [[], ['--manager'], ['-e', 'manual']])
+def test_parse_matches_baseline(conf, opts, monkeypatch, capsys):
+    # Overlay paths are relative to the working directory
+    monkeypatch.chdir(root)
+    args = gen.argparser.parse_args(['-c', conf] + opts)
+    lines = gen.read_conf_lines(conf)
+
+    expected = baseline_parse(lines, args.manager, args.enrollment_strategy)
+    assert scenario_state(gen.parse(args)) == expected
+
+
+def test_parse_reports_all_errors():
+    lines = ['eth 300 10Mbps a b\n',
+             'bogus directive\n',
+             'eth 4096 10Mbps a b\n',
+             '# comment\n',
+             'dif n1 a\n',
+             'eth 400 10Mbit c d\n',
+             'policy n1 * no.such.component ps\n',
+             'dif n1 a 300\n']
+    args = gen.argparser.parse_args([])
+
+    with pytest.raises(gen.GenError) as e:
+        gen.parse(args, lines)
+
+    assert str(e.value).split('\n') == [
+        'Error: line 2 not recognized',
+        'Error: line 3: invalid VLAN id 4096 (must be between 1 and 4095)',
+        'Error: line 5: invalid dif directive',
+        'Error: line 6: invalid link speed "10Mbit"',
+        'Error: line 7: unknown component path "no.such.component"']
+
+
+def test_parse_manager_lines():
+    lines = ['eth 300 0Mbps b a\n', 'dif n1 a 300\n', 'dif n1 b 300\n']
+    args = gen.argparser.parse_args(['--manager'])
+
+    sc = gen.parse(args, lines)
+    assert sc.conf_lines == 3
+    assert sc.shims[gen.mgmt_shim_dif_name]['linecnt'] == 4
+    assert sorted(sc.difs[gen.mgmt_dif_name]) == ['a', 'b', gen.mgmt_node_name]
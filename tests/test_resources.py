@@ -0,0 +1,76 @@
+#
+# Tests for Resources, through which the MAC addresses, interface names,
+# forwarded ports and pidfiles are handed out to the nodes.
+#
+
+import pytest
+
+import gen
+
+
+def test_claim():
+    resources = gen.Resources(2222)
+    assert resources.pidfile(1) == 'rina-1.pid'
+    with pytest.raises(gen.GenError) as e:
+        resources.pidfile(1)
+    assert str(e.value) == 'Pidfile rina-1.pid is assigned twice'
+
+    # Each space is separate
+    assert resources.claim('other', 'rina-1.pid', 'Other') == 'rina-1.pid'
+
+
+def test_mac_and_port_limits():
+    resources = gen.Resources(65530)
+    assert resources.mac(1, 99) == '00:0a:0a:0a:01:63'
+    assert resources.mac(0x101, 99) == '00:0a:0a:0b:01:63'
+    assert resources.mac((0xff - 0x0a) << 8 | 0xff, 0xff) == \
+           '00:0a:0a:ff:ff:ff'
+    for vmid, nic in [((0xff - 0x09) << 8, 1), (1, 0x100)]:
+        with pytest.raises(gen.GenError) as e:
+            resources.mac(vmid, nic)
+        assert str(e.value).startswith('No MAC address left')
+
+    assert resources.forward_port(5) == 65535
+    with pytest.raises(gen.GenError) as e:
+        resources.forward_port(6)
+    assert str(e.value) == 'No forwarded port left for node 6 (baseport ' \
+                           'is 65530)'
+
+
+def test_ifname():
+    resources = gen.Resources(2222)
+    assert resources.ifname('a.01', 'rtap.') == 'a.01'
+
+    # Names in use or too long are replaced by the first free name made of
+    # the prefix and a counter
+    resources.claim('ifname', 'rtap.2', 'Interface name')
+    assert resources.ifname('a.01', 'rtap.') == 'rtap.1'
+    assert resources.ifname('x' * 16, 'rtap.') == 'rtap.3'
+    assert resources.ifname('x' * 15, 'rtap.') == 'x' * 15
+
+    # The counter is shared by all the prefixes
+    prefix = 'p' * 14
+    names = [resources.ifname('a.01', prefix) for i in range(4, 16)]
+    assert names == ['%s%x' % (prefix, i) for i in range(4, 16)]
+    with pytest.raises(gen.GenError) as e:
+        resources.ifname('a.01', prefix)
+    assert str(e.value) == 'No interface name left for a.01'
+
+
+def test_resources_unique(make_plan):
+    # More than 255 nodes, with long node names
+    lines = [line.replace(' m', ' node-number-') for line in
+             gen.ring_conf_lines(300)]
+    pl = make_plan('ring.conf', [], lines)
+
+    macs = [vm['mac'] for vm in pl.vms.values()] + \
+           [port['mac'] for port in pl.ports]
+    ifnames = list(pl.bridges.values()) + [port['tap'] for port in pl.ports]
+    ports = [vm['ssh'] for vm in pl.vms.values()]
+    pidfiles = [vm['pidfile'] for vm in pl.vms.values()]
+    for values in [macs, ifnames, ports, pidfiles]:
+        assert len(set(values)) == len(values)
+    assert len(ports) == 300 and len(macs) == 900
+
+    assert all([len(name) <= gen.ifname_max for name in ifnames])
+    assert len(set([mac[:12] for mac in macs])) == 2
@@ -0,0 +1,67 @@
+#
+# Tests for the runner of gen.py --run, with stub commands in place of the
+# VMs and of the commands run on them.
+#
+
+import asyncio
+import signal
+import time
+import os
+
+import gen
+import gen_run
+
+
+def test_boot_does_not_wait_for_qemu(make_plan, monkeypatch, tmp_path):
+    pl = make_plan('examples/seven.conf')
+    vmname = sorted(pl.vms)[0]
+    pidfile = tmp_path / 'qemu.pid'
+
+    # A QEMU that writes to its standard output, and keeps running
+    monkeypatch.setattr(gen, 'emit_qemu', lambda pl, vmname:
+                        'sh -c \'echo $$ > %s; echo started; exec sleep 30\''
+                        % pidfile)
+    monkeypatch.setattr(gen, 'emit_boot_admission',
+                        lambda pl, vmname, booting: 'echo %s' % booting)
+    for name in ['emit_boot_probe', 'emit_ssh_probe', 'emit_provisioning']:
+        monkeypatch.setattr(gen, name, lambda *args: 'true')
+
+    async def boot():
+        runner = gen_run.Runner(pl, 1, 1)
+        await asyncio.wait_for(runner.boot(vmname), 10)
+        return runner
+
+    start = time.time()
+    try:
+        runner = asyncio.run(boot())
+        assert time.time() - start < 10
+        assert runner.provisioned[vmname].is_set()
+        assert runner.booting == [gen.boot_spec(pl, vmname)]
+
+        # The stub is still running
+        for i in range(50):
+            if pidfile.exists() and pidfile.read_text().strip():
+                break
+            time.sleep(0.1)
+        os.kill(int(pidfile.read_text()), 0)
+    finally:
+        if pidfile.exists() and pidfile.read_text().strip():
+            os.kill(int(pidfile.read_text()), signal.SIGTERM)
+
+
+def test_boot_reports_failed_probe(make_plan, monkeypatch):
+    pl = make_plan('examples/seven.conf')
+    vmname = sorted(pl.vms)[0]
+
+    monkeypatch.setattr(gen, 'emit_qemu', lambda pl, vmname: 'true')
+    monkeypatch.setattr(gen, 'emit_boot_admission',
+                        lambda pl, vmname, booting: 'true')
+    monkeypatch.setattr(gen, 'emit_boot_probe',
+                        lambda pl, vmname: 'echo no login prompt; false')
+
+    try:
+        asyncio.run(gen_run.Runner(pl, 1, 1).boot(vmname))
+    except gen_run.RunError as e:
+        assert str(e) == 'VM %s is not ready: no login prompt' % vmname
+    else:
+        assert False
@@ -0,0 +1,118 @@
+#
+# Tests for the shell scripts generated by gen.py, run with stub commands in
+# place of the ones carried out on the VMs.
+#
+
+import subprocess
+import os
+
+import probe
+import gen
+
+
+conf = 'examples/dc-vpns.conf'
+
+
+# Run the enrollment part of up.sh, with each enrollment logging when it
+# starts and ends. Return the exit code and the log.
+def run_enrollments(monkeypatch, tmp_path, pl, failing = None):
+    log = tmp_path / 'enroll.log'
+
+    def stub(pl, dif, enrollment):
+        name = '%s/%s/%s' % (dif, enrollment['enrollee'],
+                             enrollment['enroller'])
+        return 'echo "start %(name)s" >> %(log)s; sleep 0.1; '\
+               'echo "end %(name)s" >> %(log)s; %(ret)s\n' \
+                    % {'name': name, 'log': log,
+                       'ret': 'false' if name == failing else 'true'}
+    monkeypatch.setattr(gen, 'emit_enroll_command', stub)
+    monkeypatch.setattr(pl, 'ssh_retries', 1)
+
+    script = ''.join(gen.enrollment_chunks(pl))
+    ret = subprocess.call(['bash', '-c', script], stdout = subprocess.DEVNULL,
+                          stderr = subprocess.DEVNULL)
+    return ret, log.read_text().split('\n')[:-1]
+
+
+def test_enrollment_waves(make_plan, monkeypatch, tmp_path):
+    pl = make_plan(conf, ['--enroll-jobs', '3'])
+    ret, log = run_enrollments(monkeypatch, tmp_path, pl)
+    assert ret == 0
+
+    names = ['%s/%s/%s' % (t['dif'], t['enrollee'], t['enroller'])
+             for t in pl.enrollment_tasks]
+    assert sorted([l for l in log if l.startswith('end')]) == \
+           sorted(['end ' + name for name in names])
+
+    # Each enrollment starts after the ones it depends on have ended,
+    # and some of them overlap
+    running = 0
+    overlapped = False
+    for task, name in zip(pl.enrollment_tasks, names):
+        start = log.index('start ' + name)
+        for dep in task['depends']:
+            assert log.index('end ' + names[dep]) < start
+    for line in log:
+        running += 1 if line.startswith('start') else -1
+        assert running <= 3
+        overlapped = overlapped or running > 1
+    assert overlapped
+
+
+def test_enrollment_failure(make_plan, monkeypatch, tmp_path):
+    pl = make_plan(conf)
+    task = pl.enrollment_tasks[0]
+    failing = '%s/%s/%s' % (task['dif'], task['enrollee'], task['enroller'])
+
+    ret, log = run_enrollments(monkeypatch, tmp_path, pl, failing)
+    assert ret == 1
+
+    # The following waves are not started
+    later = [t for t in pl.enrollment_tasks if t['depth'] > task['depth']]
+    assert len(later)
+    for t in later:
+        assert 'start %s/%s/%s' % (t['dif'], t['enrollee'], t['enroller']) \
+                    not in log
+
+
+def test_stale_boot_log(make_plan, monkeypatch, tmp_path):
+    pl = make_plan(conf)
+    vmname = sorted(pl.vms)[0]
+
+    # The serial console log left by the previous run of the node
+    log = tmp_path / gen.boot_spec(pl, vmname)
+    log.write_text('Welcome\n%s\n' % pl.boot_marker)
+    monkeypatch.chdir(tmp_path)
+    assert probe.booted(gen.boot_spec(pl, vmname), pl.boot_marker)
+
+    # A QEMU which has not printed anything yet
+    qemu = tmp_path / 'qemu-system-x86_64'
+    qemu.write_text('#!/bin/sh\nexit 0\n')
+    qemu.chmod(0o755)
+    env = dict(os.environ, PATH = '%s:%s' % (tmp_path, os.environ['PATH']))
+
+    assert subprocess.call(['bash', '-c', gen.emit_qemu(pl, vmname)],
+                           env = env) == 0
+    assert not probe.booted(gen.boot_spec(pl, vmname), pl.boot_marker)
+
+
+# Commands standing in for ssh (which runs the here document locally),
+# sudo and the programs run on the nodes
+def fake_node(tmp_path, programs):
+    programs = dict(programs, ssh = 'exec bash', sudo = 'exec "$@"')
+    for name in programs:
+        path = tmp_path / name
+        path.write_text('#!/bin/bash\n%s\n' % programs[name])
+        path.chmod(0o755)
+    return dict(os.environ, PATH = '%s:%s' % (tmp_path, os.environ['PATH']))
+
+
+def test_enroll_command_status(make_plan, tmp_path):
+    pl = make_plan(conf)
+    task = pl.enrollment_tasks[0]
+    cmd = gen.emit_enroll_command(pl, task['dif'], task)
+
+    for (status, ret) in [('exit 0', 0), ('exit 1', 1)]:
+        env = fake_node(tmp_path, {'enroll.py': status})
+        assert subprocess.call(['bash', '-c', cmd], env = env,
+                               stderr = subprocess.DEVNULL) == ret
@@ -0,0 +1,72 @@
+#
+# Tests for the copy-on-write views of the DIF templates, through which
+# the policies are applied to the configurations of the nodes.
+#
+
+import copy
+
+import gen_templates
+import gen
+
+
+def test_cow_policy_isolation():
+    base = copy.deepcopy(gen_templates.normal_dif_base)
+    snapshot = copy.deepcopy(base)
+
+    a = gen_templates.CowConf(base)
+    gen_templates.translate_policy(a, 'rmt.pff', 'lfa', [])
+    gen_templates.translate_policy(a, 'efcp.*.dtcp', 'dtcp-ps-x', ['k=v'])
+    b = gen_templates.CowConf(base)
+    gen_templates.translate_policy(b, 'security-manager.auth.default',
+                                   'PSOC_authentication-ssh2', ['keyExchangeAlg=EDH'])
+
+    # The base is not modified, and the configurations do not see each
+    # other's policies
+    assert base == snapshot
+    assert a.data['rmtConfiguration']['pffConfiguration']['policySet']\
+                ['name'] == 'lfa'
+    assert b.data['rmtConfiguration'] == base['rmtConfiguration']
+    for cube in a.data['qosCubes']:
+        dtcp = cube['efcpPolicies']['dtcpConfiguration']['dtcpPolicySet']
+        assert dtcp['name'] == 'dtcp-ps-x'
+        assert dtcp['parameters'] == [{'name': 'k', 'value': 'v'}]
+    assert 'authSDUProtProfiles' not in \
+                a.data['securityManagerConfiguration']
+    assert b.data['securityManagerConfiguration']['authSDUProtProfiles']\
+                ['default']['authPolicy']['name'] == 'PSOC_authentication-ssh2'
+
+    # Only the modified containers and their ancestors are copied
+    assert a.data is not base and b.data is not base
+    assert a.data['rmtConfiguration'] is not base['rmtConfiguration']
+    assert a.data['rmtConfiguration']['policySet'] is \
+                base['rmtConfiguration']['policySet']
+    assert a.data['flowAllocatorConfiguration'] is \
+                base['flowAllocatorConfiguration']
+    assert b.data['qosCubes'] is base['qosCubes']
+
+
+def test_cow_view():
+    base = {'l': [{'x': 1}, {'x': 2}], 'd': {'y': 1}, 'n': 0}
+    conf = gen_templates.CowConf(base)
+
+    assert len(conf) == 3 and 'd' in conf
+    assert [item['x'] for item in conf['l']] == [1, 2]
+    conf['l'][1]['x'] = 3
+    conf['l'].append({'x': 4})
+    del conf['d']['y']
+    conf['n'] = 5
+
+    assert conf.data == {'l': [{'x': 1}, {'x': 3}, {'x': 4}], 'd': {},
+                         'n': 5}
+    assert base == {'l': [{'x': 1}, {'x': 2}], 'd': {'y': 1}, 'n': 0}
+    assert conf.data['l'][0] is base['l'][0]
+
+
+def test_compile_leaves_templates(make_plan):
+    snapshot = copy.deepcopy([gen_templates.normal_dif_base,
+                              gen_templates.ipcmconf_base,
+                              gen_templates.da_map_base])
+    for conf in ['examples/isp-sec.conf', 'examples/secure-two-layers.conf']:
+        gen.emit(make_plan(conf, ['--manager']))
+    assert [gen_templates.normal_dif_base, gen_templates.ipcmconf_base,
+            gen_templates.da_map_base] == snapshot
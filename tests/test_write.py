@@ -0,0 +1,78 @@
+#
+# Tests for the streaming writer of the artifacts, and for the manifest
+# through which unchanged artifacts are not rewritten.
+#
+
+import os
+
+from conftest import root
+import gen
+
+
+conf = 'examples/seven.conf'
+
+
+def conf_lines(extra = []):
+    return open(os.path.join(root, conf)).readlines() + extra
+
+
+def test_write_manifest(make_plan, tmp_path):
+    outdir = str(tmp_path)
+    pl = make_plan(conf)
+    artifacts = gen.emit(pl)
+
+    manifest = gen.Manifest(outdir)
+    assert manifest.artifacts == dict() and manifest.topology == None
+    manifest.topology = gen.topology_hash(pl)
+    written = gen.write_artifacts(gen.producers(pl), outdir, manifest)
+    assert written == sorted(artifacts)
+
+    # The manifest is saved, with the hashes of the artifacts
+    loaded = gen.Manifest(outdir)
+    assert loaded.topology == manifest.topology
+    assert loaded.artifacts == dict([(name, gen.content_hash(artifacts[name]))
+                                     for name in artifacts])
+
+    # Nothing to rewrite, unless an artifact changes or is missing
+    assert gen.write_artifacts(gen.producers(pl), outdir, loaded) == []
+    os.unlink(str(tmp_path / 'down.sh'))
+    artifacts['a.ipcm.conf'] += '\n'
+    assert gen.write_artifacts(artifacts, outdir, loaded) == \
+           ['a.ipcm.conf', 'down.sh']
+    for name in artifacts:
+        assert (tmp_path / name).read_text() == artifacts[name]
+    assert not [name for name in os.listdir(outdir) if '.tmp' in name]
+
+
+def test_write_jobs(make_plan, tmp_path, monkeypatch):
+    pl = make_plan('examples/isp-sec.conf')
+    artifacts = gen.emit(pl)
+
+    # Write the configuration files through a pool of processes
+    monkeypatch.setattr(gen, 'pool_min_artifacts', 1)
+    timings = dict()
+    written = gen.write_artifacts(gen.producers(pl), str(tmp_path),
+                                  jobs = 4, timings = timings)
+    assert written == sorted(artifacts)
+    assert sorted(timings) == ['configurations', 'scripts']
+    for name in artifacts:
+        assert (tmp_path / name).read_text() == artifacts[name]
+        assert os.access(str(tmp_path / name), os.X_OK) == \
+               name.endswith('.sh')
+
+
+def test_topology_hash(make_plan):
+    topology = gen.topology_hash(make_plan(conf, [], conf_lines()))
+
+    # Policies and enrollments are changed without rebooting the nodes
+    for opts, extra in [([], ['policy n1 * rmt.pff lfa\n']),
+                        (['-e', 'full-mesh'], [])]:
+        pl = make_plan(conf, opts, conf_lines(extra))
+        assert gen.topology_hash(pl) == topology
+
+    # The links and the VMs are not
+    pl = make_plan(conf, [], conf_lines(['eth 900 0Mbps a g\n']))
+    assert gen.topology_hash(pl) != topology
+    pl = make_plan(conf, [], conf_lines())
+    pl.vms['a']['smp'] = 4
+    assert gen.topology_hash(pl) != topology